@@ -3,15 +3,33 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
+import json
 import frappe
 from frappe.model.document import Document
+from frappe.utils import cint, get_datetime
+from circularo.circularo.doctype.circularo_integration.circularo_integration import get_settings
+
+# Page size of history API
+DEFAULT_HISTORY_PAGE_SIZE = 20
+MAX_HISTORY_PAGE_SIZE = 500
+
+# Fields returned by history API
+HISTORY_FIELDS = ["name", "target_doctype", "target_docname", "action", "author", "date", "is_sign", "is_autosign", "is_signed",
+	"is_downloaded", "file_url", "target_document_id", "page_ranges", "circularo_preview_url"]
+
+# Filters of history statuses
+HISTORY_STATUSES = {
+	"downloaded": {"is_downloaded": 1},
+	"not_downloaded": {"is_downloaded": 0},
+	"pending_signature": {"is_sign": 1, "is_autosign": 0, "is_signed": 0}
+}
 
 class CircularoDocuments(Document):
 	"""
 	Circularo Documents DocType backend
 	Represents Circularo actions history
 	"""
-	def initialize(self, doctype, docname, document_id, preview_url, sign_url, is_sign, is_autosign):
+	def initialize(self, doctype, docname, document_id, preview_url, sign_url, is_sign, is_autosign, page_ranges=None):
 		"""
 		Initializes Circularo document (history)
 
@@ -29,6 +47,8 @@ class CircularoDocuments(Document):
 		:type is_sign: int
 		:param is_autosign: 1 if was autosign action, 0 otherwise
 		:type is_autosign: int
+		:param page_ranges: Optional page ranges of documents combined in one Circularo document
+		:type page_ranges: list | None
 		:return:
 		"""
 		self.target_docname = docname
@@ -49,9 +69,31 @@ class CircularoDocuments(Document):
 		if is_autosign == 1:
 			self.action = "Automatic sign"
 
-		self.target_url = "/desk#Form/" + doctype
-		if docname is not None:
-			self.target_url += "/" + docname
+		if page_ranges:
+			self.page_ranges = json.dumps(page_ranges)
+		self.target_url = get_target_url(doctype, docname, bool(page_ranges))
+
+
+def get_target_url(doctype, docname, is_combined=False):
+	"""
+	Returns Frappe URL of the document
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param is_combined: True if more documents were combined (URL of DocType list is returned)
+	:type is_combined: bool
+	:return:
+	"""
+	if is_combined:
+		return "/desk#List/" + doctype + "/List"
+
+	target_url = "/desk#Form/" + doctype
+	if docname is not None:
+		target_url += "/" + docname
+
+	return target_url
 
 
 @frappe.whitelist()
@@ -112,3 +154,108 @@ def view_file(doctype, docname):
 		"message": file_url
 	}
 
+
+@frappe.whitelist()
+def get_history(doctype=None, docname=None, author=None, document_id=None, status=None, cursor=None, limit=DEFAULT_HISTORY_PAGE_SIZE,
+				archived=0):
+	"""
+	Returns page of Circularo actions history, newest first
+	Pages are addressed by cursor (keyset pagination), so deep pages are as fast as the first one
+	Records are read by frappe.get_list, so user permissions and "if owner" restrictions apply
+	Recent history is read by default, history older than retention period with archived=1
+
+	:param doctype: Optional Frappe DocType
+	:type doctype: str | None
+	:param docname: Optional Frappe DocName (with doctype)
+	:type docname: str | None
+	:param author: Optional user
+	:type author: str | None
+	:param document_id: Optional Circularo document ID
+	:type document_id: str | None
+	:param status: Optional status (key of HISTORY_STATUSES)
+	:type status: str | None
+	:param cursor: Cursor of requested page returned with previous page, None for the first page
+	:type cursor: str | None
+	:param limit: Page size
+	:type limit: int
+	:param archived: 1 to read archived history
+	:type archived: int
+	:return: History records and cursor of the next page (None on the last page)
+	"""
+	archived = cint(archived)
+	history_doctype = "Circularo Documents Archive" if archived else "Circularo Documents"
+	frappe.has_permission(history_doctype, "read", throw=True)
+
+	if (status is not None) and (status not in HISTORY_STATUSES):
+		return {
+			"status": 1,
+			"message": "Unknown status '" + str(status) + "'."
+		}
+
+	try:
+		limit = min(max(int(limit), 1), MAX_HISTORY_PAGE_SIZE)
+	except (TypeError, ValueError):
+		return {
+			"status": 1,
+			"message": "Invalid limit '" + str(limit) + "'."
+		}
+
+	filters = {}
+	for field, value in (("target_doctype", doctype), ("target_docname", docname), ("author", author), ("target_document_id", document_id)):
+		if value:
+			filters[field] = value
+
+	if status:
+		filters.update(HISTORY_STATUSES.get(status))
+
+	or_filters = None
+	if cursor:
+		# Records after the cursor in (date, name) order, the date condition allows index range scan
+		try:
+			cursor_date, cursor_name = cursor.rsplit("|", 1)
+			cursor_date = get_datetime(cursor_date)
+		except (TypeError, ValueError, OverflowError):
+			return {
+				"status": 1,
+				"message": "Invalid cursor '" + str(cursor) + "'."
+			}
+		filters["date"] = ["<=", cursor_date]
+		or_filters = [["date", "<", cursor_date], ["name", "<", cursor_name]]
+
+	# Date is always set, ifnull() around it would prevent index range scan
+	records = frappe.get_list(history_doctype,
+		fields=[field for field in HISTORY_FIELDS if not (archived and (field == "circularo_preview_url"))],
+		filters=filters,
+		or_filters=or_filters,
+		order_by="date desc, name desc",
+		limit_page_length=limit + 1,
+		ignore_ifnull=True)
+
+	if archived:
+		# Archive does not store URLs
+		circularo_integration = get_settings()
+		for record in records:
+			record.circularo_preview_url = circularo_integration.get_preview_url(record.target_document_id)
+
+	next_cursor = None
+	if len(records) > limit:
+		records = records[:limit]
+		next_cursor = str(records[-1].date) + "|" + records[-1].name
+
+	return {
+		"status": 0,
+		"message": {
+			"records": records,
+			"next_cursor": next_cursor
+		}
+	}
+
+
+def on_doctype_update():
+	"""
+	Adds composite indexes of history lookups sorted by date and name (no filesort)
+
+	:return:
+	"""
+	frappe.db.add_index("Circularo Documents", ["target_doctype", "target_docname", "date", "name"])
+	frappe.db.add_index("Circularo Documents", ["author", "date", "name"])
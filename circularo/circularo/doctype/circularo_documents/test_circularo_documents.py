@@ -3,8 +3,69 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
+import datetime
+import frappe
 import unittest
+from unittest import mock
+from circularo.circularo.doctype.circularo_documents import circularo_documents
+from circularo.circularo.doctype.circularo_documents.circularo_documents import get_history
+
+
+def make_record(name, date):
+	"""
+	Create history record as returned by frappe.get_list
+	"""
+	return frappe._dict(name=name, date=date, target_document_id="doc-" + name)
+
 
 class TestCircularoDocuments(unittest.TestCase):
-	pass
+	def test_history_validation(self):
+		with mock.patch.object(frappe, "has_permission"), mock.patch.object(frappe, "get_list") as get_list:
+			for kwargs in ({"limit": "abc"}, {"limit": None}, {"cursor": "no-separator"}, {"cursor": "not a date|HIST-1"},
+					{"status": "unknown"}):
+				r = get_history(**kwargs)
+				self.assertEqual(r.get("status"), 1, kwargs)
+
+			get_list.assert_not_called()
+
+	def test_history_pages(self):
+		date = datetime.datetime(2021, 6, 1, 12, 0, 0)
+		records = [make_record("HIST-3", date), make_record("HIST-2", date), make_record("HIST-1", date - datetime.timedelta(days=1))]
+
+		with mock.patch.object(frappe, "has_permission") as has_permission, mock.patch.object(frappe, "get_list") as get_list:
+			get_list.return_value = [frappe._dict(record) for record in records]
+			r = get_history(doctype="Sales Invoice", status="downloaded", limit="2")
+
+			self.assertEqual(r.get("status"), 0)
+			self.assertEqual([record.name for record in r.get("message").get("records")], ["HIST-3", "HIST-2"])
+			next_cursor = r.get("message").get("next_cursor")
+			self.assertEqual(next_cursor, "2021-06-01 12:00:00|HIST-2")
+			has_permission.assert_called_with("Circularo Documents", "read", throw=True)
+
+			# Permissions are applied by get_list
+			args, kwargs = get_list.call_args
+			self.assertEqual(args, ("Circularo Documents",))
+			self.assertEqual(kwargs.get("filters"), {"target_doctype": "Sales Invoice", "is_downloaded": 1})
+			self.assertIsNone(kwargs.get("or_filters"))
+			self.assertEqual(kwargs.get("order_by"), "date desc, name desc")
+			self.assertEqual(kwargs.get("limit_page_length"), 3)
+
+			get_list.return_value = [frappe._dict(records[2])]
+			r = get_history(doctype="Sales Invoice", status="downloaded", limit=2, cursor=next_cursor)
+
+			self.assertIsNone(r.get("message").get("next_cursor"))
+			kwargs = get_list.call_args[1]
+			self.assertEqual(kwargs.get("filters").get("date"), ["<=", date])
+			self.assertEqual(kwargs.get("or_filters"), [["date", "<", date], ["name", "<", "HIST-2"]])
+
+	def test_archived_history(self):
+		settings = frappe._dict(get_preview_url=lambda document_id: "https://sign.example.com/#!/" + document_id)
+		with mock.patch.object(frappe, "has_permission") as has_permission, mock.patch.object(frappe, "get_list") as get_list, \
+				mock.patch.object(circularo_documents, "get_settings", return_value=settings):
+			get_list.return_value = [make_record("HIST-1", datetime.datetime(2020, 1, 1))]
+			r = get_history(archived="1")
+
+		has_permission.assert_called_with("Circularo Documents Archive", "read", throw=True)
+		self.assertEqual(get_list.call_args[0], ("Circularo Documents Archive",))
+		self.assertNotIn("circularo_preview_url", get_list.call_args[1].get("fields"))
+		self.assertEqual(r.get("message").get("records")[0].circularo_preview_url, "https://sign.example.com/#!/doc-HIST-1")
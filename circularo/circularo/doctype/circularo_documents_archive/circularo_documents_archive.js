@@ -0,0 +1,61 @@
+// Copyright (c) 2021, Circularo and contributors
+// For license information, please see license.txt
+
+/**
+ * Circularo Documents Archive doctype frontend
+ */
+frappe.ui.form.on('Circularo Documents Archive', {
+    /**
+     * Opens document
+     * @param frm {Object}
+     */
+    open_in_app: function(frm) {
+        frappe.call({
+            method: "circularo.circularo.doctype.circularo_documents.circularo_documents.get_app_url",
+            args: {
+                doctype: frm.doctype,
+                docname: frm.docname
+            },
+            callback: function(val) {
+                const args = val.message;
+                openNewTab(args.message);
+            }
+        });
+    },
+
+    /**
+     * Opens document in Circularo
+     * @param frm {Object}
+     */
+    open_in_circularo: function(frm) {
+        frappe.call({
+            method: "circularo.circularo.doctype.circularo_documents.circularo_documents.get_circularo_url",
+            args: {
+                doctype: frm.doctype,
+                docname: frm.docname
+            },
+            callback: function(val) {
+                const args = val.message;
+                openNewTab(args.message);
+            }
+        });
+    },
+
+    /**
+     * Opens downloaded PDF file
+     * @param frm {Object}
+     */
+    view_file: function(frm) {
+        frappe.call({
+            method: "circularo.circularo.doctype.circularo_documents.circularo_documents.view_file",
+            args: {
+                doctype: frm.doctype,
+                docname: frm.docname
+            },
+            callback: function(val) {
+                const args = val.message;
+                openNewTab(args.message);
+            }
+        });
+    }
+});
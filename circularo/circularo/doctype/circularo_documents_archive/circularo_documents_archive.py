@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+from circularo.circularo.doctype.circularo_documents.circularo_documents import get_target_url
+from circularo.circularo.doctype.circularo_integration.circularo_integration import get_settings
+
+class CircularoDocumentsArchive(Document):
+	"""
+	Circularo Documents Archive DocType backend
+	Represents archived Circularo actions history, URLs are not stored, they are computed on read
+	"""
+	@property
+	def target_url(self):
+		"""
+		Frappe URL of the document
+
+		:return:
+		"""
+		return get_target_url(self.target_doctype, self.target_docname, bool(self.page_ranges))
+
+	@property
+	def circularo_preview_url(self):
+		"""
+		Circularo preview URL of the document
+
+		:return:
+		"""
+		return get_settings().get_preview_url(self.target_document_id)
+
+	@property
+	def circularo_sign_url(self):
+		"""
+		Circularo sign URL of the document
+
+		:return:
+		"""
+		return get_settings().get_sign_url(self.target_document_id)
+
+
+def on_doctype_update():
+	"""
+	Adds composite indexes of history lookups sorted by date and name (same as Circularo Documents)
+
+	:return:
+	"""
+	frappe.db.add_index("Circularo Documents Archive", ["target_doctype", "target_docname", "date", "name"])
+	frappe.db.add_index("Circularo Documents Archive", ["author", "date", "name"])
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import unittest
+
+class TestCircularoDocumentsArchive(unittest.TestCase):
+	pass
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+Offline micro-benchmarks of Circularo integration
+
+Run with e.g.:
+	bench --site {site_name} execute circularo.circularo.doctype.circularo_integration.circularo_benchmark.benchmark_page_count
+	bench --site {site_name} execute circularo.circularo.doctype.circularo_integration.circularo_benchmark.benchmark_pipeline --kwargs "{'latency': 0.05}"
+	bench --site {site_name} execute circularo.circularo.doctype.circularo_integration.circularo_benchmark.benchmark_rendering --kwargs "{'doctype': 'Sales Invoice'}"
+"""
+
+from __future__ import unicode_literals
+import io
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from PyPDF2 import PdfFileWriter
+from circularo.circularo.doctype.circularo_integration.circularo_pdf import get_page_count, get_page_count_fast, get_page_count_full, \
+	render_batch_pdf, spool_pdf
+from circularo.circularo.doctype.circularo_integration.circularo_stand_in import StandInServer
+from circularo.circularo.doctype.circularo_integration.circularo_utils import stream_to_file
+
+# Benchmarked document sizes (number of pages)
+PAGE_COUNT_SIZES = {
+	"small": 1,
+	"medium": 20,
+	"large": 500
+}
+
+
+def benchmark_page_count(repeat=20):
+	"""
+	Compare fast page counting with full PyPDF2 parse
+
+	:param repeat: Count of measured runs per document
+	:type repeat: int
+	:return: Average duration (ms) of both methods per document size
+	"""
+	repeat = int(repeat)
+	results = {}
+
+	for size, num_pages in PAGE_COUNT_SIZES.items():
+		pdf_bytes = make_pdf(num_pages)
+
+		fast = timeit.timeit(lambda: get_page_count_fast(pdf_bytes), number=repeat) / repeat
+		full = timeit.timeit(lambda: get_page_count_full(pdf_bytes), number=repeat) / repeat
+
+		results[size] = {
+			"pages": num_pages,
+			"bytes": len(pdf_bytes),
+			"fast_ms": round(fast * 1000, 3),
+			"full_ms": round(full * 1000, 3),
+			"speedup": round(full / fast, 1) if fast > 0 else None
+		}
+
+	return results
+
+
+def benchmark_pipeline(count=50, concurrency=4, num_pages=20, latency=0.02, jitter=0.0, failure_rate=0.0):
+	"""
+	Measure upload/create/download pipeline against local Circularo stand-in
+	Documents are sent one by one (single) and by a thread pool (bulk)
+
+	:param count: Count of sent documents per mode
+	:type count: int
+	:param concurrency: Count of threads of bulk mode
+	:type concurrency: int
+	:param num_pages: Number of pages of sent document
+	:type num_pages: int
+	:param latency: Delay of every stand-in response (seconds)
+	:type latency: float
+	:param jitter: Maximal random delay added to latency (seconds)
+	:type jitter: float
+	:param failure_rate: Probability of failed stand-in response
+	:type failure_rate: float
+	:return: Documents per second, p50 and p99 latency (ms) and count of failures per mode
+	"""
+	count, concurrency, num_pages = int(count), int(concurrency), int(num_pages)
+	pdf_bytes = make_pdf(num_pages)
+
+	with StandInServer(float(latency), float(jitter), float(failure_rate), seed=0) as server:
+		circularo_integration = _get_stand_in_settings(server, concurrency)
+
+		results = {
+			"single": _run_pipeline(circularo_integration, pdf_bytes, num_pages, count, 1),
+			"bulk": _run_pipeline(circularo_integration, pdf_bytes, num_pages, count, concurrency)
+		}
+		results["requests"] = dict(server.requests)
+
+	return results
+
+
+def benchmark_rendering(doctype, count=20, batch_size=10):
+	"""
+	Compare batched rendering with rendering documents one by one
+	Prints of the latest documents of given DocType are rendered both ways, rendered PDF cache and optimization are not used
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param count: Count of rendered documents
+	:type count: int
+	:param batch_size: Count of documents rendered in one run of the PDF engine
+	:type batch_size: int
+	:return: Duration per document (ms) of both ways, count of documents in batches which could not be split and page counts check
+	"""
+	import frappe
+	from frappe.utils.pdf import get_pdf
+
+	count, batch_size = int(count), max(int(batch_size), 1)
+	docnames = [document.name for document in frappe.get_all(doctype, order_by="modified desc", limit_page_length=count)]
+	html_documents = [frappe.get_print(doctype, docname) for docname in docnames]
+	if not html_documents:
+		return {"documents": 0}
+
+	start = time.time()
+	single_pages = [get_page_count(get_pdf(html)) for html in html_documents]
+	single = time.time() - start
+
+	start = time.time()
+	batched_pages = []
+	for first in range(0, len(html_documents), batch_size):
+		batch = html_documents[first:first + batch_size]
+		parts = render_batch_pdf(batch, get_pdf) if len(batch) > 1 else [get_pdf(batch[0])]
+		batched_pages.extend([get_page_count(part) for part in parts] if parts else [None] * len(batch))
+	batched = time.time() - start
+
+	return {
+		"documents": len(html_documents),
+		"batch_size": batch_size,
+		"single_ms": round(single * 1000 / len(html_documents), 1),
+		"batched_ms": round(batched * 1000 / len(html_documents), 1),
+		"speedup": round(single / batched, 2) if batched > 0 else None,
+		"not_split": batched_pages.count(None),
+		"page_counts_match": single_pages == batched_pages
+	}
+
+
+def send_pipeline(circularo_integration, pdf_bytes, num_pages, docname):
+	"""
+	Send one document through upload/create/download pipeline (without Frappe records)
+	Calls get neither into metrics nor into circuit breaker state of configured server
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param num_pages: Number of PDF file pages
+	:type num_pages: int
+	:param docname: Document title
+	:type docname: str
+	:return: Size of downloaded file
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import _upload_pdf, _create_circularo_document, _get_document_details, \
+		_download_file, _override_request_options
+
+	with _override_request_options(breaker=None, notify_listeners=False):
+		with spool_pdf(pdf_bytes) as pdf_file:
+			file_id = _upload_pdf(circularo_integration, pdf_file, docname + ".pdf")
+
+		document_id = _create_circularo_document(circularo_integration, docname, file_id, num_pages, 1)
+		document_details = _get_document_details(document_id, circularo_integration)
+
+		with io.BytesIO() as signed_file:
+			file_size, _ = stream_to_file(_download_file(document_details.get("pdfFile").get("content"), circularo_integration), signed_file)
+
+	return file_size
+
+
+def _run_pipeline(circularo_integration, pdf_bytes, num_pages, count, concurrency):
+	"""
+	Send documents and summarize durations
+
+	:return: Documents per second, p50 and p99 latency (ms) and count of failures
+	"""
+	def send(i):
+		start = time.time()
+		try:
+			send_pipeline(circularo_integration, pdf_bytes, num_pages, "BENCH-{0}".format(i))
+			return time.time() - start, None
+		except Exception as e:
+			return time.time() - start, e
+
+	start = time.time()
+	if concurrency > 1:
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			outcomes = list(executor.map(send, range(count)))
+	else:
+		outcomes = [send(i) for i in range(count)]
+	total = time.time() - start
+
+	durations = sorted(duration for duration, error in outcomes if error is None)
+
+	return {
+		"documents": count,
+		"concurrency": concurrency,
+		"docs_per_sec": round(len(durations) / total, 2) if total > 0 else None,
+		"p50_ms": _percentile_ms(durations, 50),
+		"p99_ms": _percentile_ms(durations, 99),
+		"failures": len([error for duration, error in outcomes if error is not None])
+	}
+
+
+def _get_stand_in_settings(server, pool_size):
+	"""
+	Create in-memory Circularo Integration settings pointing to stand-in server
+
+	:param server: Running stand-in server
+	:type server: StandInServer
+	:param pool_size: Size of HTTP connection pool
+	:type pool_size: int
+	:return: Settings object
+	"""
+	import frappe
+
+	return frappe._dict({
+		"circularo_url": server.url,
+		"circularo_api_token": "benchmark",
+		"circularo_document_type": "d_default",
+		"circularo_definition_type": "d_default",
+		"circularo_workflow_type": "wf_archive",
+		"signature_id": "stand-in-signature",
+		"http_pool_size": max(pool_size, 1),
+		# Every document is uploaded, no deduplication
+		"upload_index_ttl": 0
+	})
+
+
+def _percentile_ms(durations, percentile):
+	"""
+	Get percentile of sorted durations (nearest-rank)
+
+	:param durations: Sorted durations (seconds)
+	:type durations: list
+	:param percentile: Percentile (0-100)
+	:type percentile: int
+	:return: Duration in milliseconds or None if there are no durations
+	"""
+	if not durations:
+		return None
+
+	index = max(int(-(-len(durations) * percentile // 100)) - 1, 0)
+	return round(durations[index] * 1000, 1)
+
+
+def make_pdf(num_pages):
+	"""
+	Create PDF file with given number of blank A4 pages
+
+	:param num_pages: Number of pages
+	:type num_pages: int
+	:return: PDF file bytes
+	"""
+	writer = PdfFileWriter()
+	for _ in range(num_pages):
+		writer.addBlankPage(595, 842)
+
+	output = io.BytesIO()
+	writer.write(output)
+	return output.getvalue()
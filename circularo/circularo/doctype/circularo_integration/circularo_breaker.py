@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+Circuit breaker of Circularo calls, shared by all workers through Redis
+After repeated failures calls fail fast for a cooldown window, then a single probe call decides whether the circuit closes again
+When Redis is not available, every call is let through
+"""
+
+from __future__ import unicode_literals
+import math
+import time
+import frappe
+
+# Count of consecutive failures opening the circuit
+DEFAULT_FAILURE_THRESHOLD = 5
+
+# Duration of open circuit (seconds)
+DEFAULT_COOLDOWN = 30
+
+# Raw Redis keys (shared by all sites using the same Circularo server)
+BREAKER_KEY_PREFIX = "circularo_breaker|"
+PROBE_KEY_PREFIX = "circularo_breaker_probe|"
+
+# State of servers not called anymore expires (seconds)
+BREAKER_TTL = 24 * 60 * 60
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+	"""
+	Circuit breaker of one Circularo server
+	"""
+	def __init__(self, url, failure_threshold=None, cooldown=None):
+		"""
+		:param url: Circularo server URL
+		:type url: str
+		:param failure_threshold: Count of consecutive failures opening the circuit
+		:type failure_threshold: int | None
+		:param cooldown: Duration of open circuit (seconds)
+		:type cooldown: int | None
+		"""
+		self.url = url
+		self.failure_threshold = int(failure_threshold or DEFAULT_FAILURE_THRESHOLD)
+		self.cooldown = int(cooldown or DEFAULT_COOLDOWN)
+
+		self._key = BREAKER_KEY_PREFIX + url
+		self._probe_key = PROBE_KEY_PREFIX + url
+		self._tripped = True
+
+	def allow(self):
+		"""
+		Checks if request can be sent
+
+		:return: False if circuit is open
+		"""
+		try:
+			pipeline = frappe.cache().pipeline()
+			pipeline.hmget(self._key, "failures", "opened_until")
+			failures, opened_until = pipeline.execute()[0]
+			self._tripped = bool(failures or opened_until)
+			if not opened_until:
+				return True
+
+			if time.time() < float(opened_until):
+				return False
+
+			# Cooldown is over, let through single probe request
+			pipeline.set(self._probe_key, 1, nx=True, ex=self.cooldown)
+			return bool(pipeline.execute()[0])
+		except Exception:
+			# Redis failure must not stop Circularo calls
+			self._tripped = False
+			return True
+
+	def record_success(self):
+		"""
+		Records successful request, circuit is closed
+
+		:return:
+		"""
+		if not self._tripped:
+			# Nothing to reset, skip Redis write
+			return
+
+		try:
+			# Trips and the last error stay visible
+			pipeline = frappe.cache().pipeline()
+			pipeline.hdel(self._key, "failures", "opened_until")
+			pipeline.delete(self._probe_key)
+			pipeline.execute()
+			self._tripped = False
+		except Exception:
+			pass
+
+	def record_failure(self, error):
+		"""
+		Records failed request, circuit is opened after repeated failures
+
+		:param error: Raised exception
+		:type error: Exception
+		:return:
+		"""
+		now = time.time()
+
+		try:
+			pipeline = frappe.cache().pipeline()
+			pipeline.hincrby(self._key, "failures", 1)
+			pipeline.hget(self._key, "opened_until")
+			pipeline.hset(self._key, "last_failure", now)
+			pipeline.hset(self._key, "last_error", str(error)[:200])
+			pipeline.expire(self._key, BREAKER_TTL)
+			failures, opened_until = pipeline.execute()[:2]
+			self._tripped = True
+
+			# Open circuit (again when probe request failed)
+			if (failures >= self.failure_threshold) and ((not opened_until) or (now >= float(opened_until))):
+				pipeline.hset(self._key, "opened_until", now + self.cooldown)
+				pipeline.hincrby(self._key, "trips", 1)
+				pipeline.delete(self._probe_key)
+				pipeline.execute()
+		except Exception:
+			pass
+
+	def get_state(self):
+		"""
+		Get current state of the circuit
+
+		:return: State, failures and trips counts, remaining cooldown (seconds) and the last error
+		"""
+		pipeline = frappe.cache().pipeline()
+		pipeline.hgetall(self._key)
+		state = dict((frappe.safe_decode(key), frappe.safe_decode(value)) for key, value in pipeline.execute()[0].items())
+
+		opened_until = float(state.get("opened_until") or 0)
+		if not opened_until:
+			circuit_state = STATE_CLOSED
+		elif time.time() < opened_until:
+			circuit_state = STATE_OPEN
+		else:
+			circuit_state = STATE_HALF_OPEN
+
+		return {
+			"url": self.url,
+			"state": circuit_state,
+			"failures": int(state.get("failures") or 0),
+			"failure_threshold": self.failure_threshold,
+			"cooldown": self.cooldown,
+			"remaining_cooldown": max(int(math.ceil(opened_until - time.time())), 0) if opened_until else 0,
+			"trips": int(state.get("trips") or 0),
+			"last_failure": float(state.get("last_failure") or 0) or None,
+			"last_error": state.get("last_error")
+		}
+
+	def reset(self):
+		"""
+		Close the circuit and forget its history
+
+		:return:
+		"""
+		pipeline = frappe.cache().pipeline()
+		pipeline.delete(self._key, self._probe_key)
+		pipeline.execute()
+		self._tripped = False
+
+
+def get_circuit_breaker(circularo_integration):
+	"""
+	Get circuit breaker of configured Circularo server
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:return: Circuit breaker or None if server is not configured
+	"""
+	if not circularo_integration.circularo_url:
+		return None
+
+	return CircuitBreaker(circularo_integration.circularo_url, circularo_integration.breaker_failure_threshold, circularo_integration.breaker_cooldown)
+
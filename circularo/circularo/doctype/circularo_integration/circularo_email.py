@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+E-mails with automatically signed documents
+E-mails are sent through Frappe e-mail queue, signed PDF files are attached as references to Files of the documents
+"""
+
+from __future__ import unicode_literals
+import frappe
+from frappe.utils import now_datetime, escape_html
+
+# Default window of e-mail digest (minutes)
+DEFAULT_EMAIL_DIGEST_WINDOW = 15
+
+# Maximal count of files attached to one digest, other documents are only listed
+MAX_DIGEST_ATTACHMENTS = 20
+
+# E-mail states of Circularo documents (history) records
+EMAIL_PENDING = "Pending"
+EMAIL_QUEUED = "Queued"
+
+
+def queue_signed_document_email(history_record, saved_file, circularo_integration):
+	"""
+	Queue e-mail with signed document or leave it for the next digest
+	Every document is e-mailed only once
+
+	:param history_record: Circularo documents (history) record
+	:type history_record: CircularoDocuments
+	:param saved_file: Stored signed PDF file
+	:type saved_file: File
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:return:
+	"""
+	# Row lock, concurrent downloads of the same document must not e-mail it twice
+	if frappe.db.get_value("Circularo Documents", history_record.name, "email_status", for_update=True):
+		return
+
+	if circularo_integration.email_digest:
+		frappe.db.set_value("Circularo Documents", history_record.name, {
+			"email_status": EMAIL_PENDING,
+			"email_pending_since": now_datetime()
+		}, update_modified=False)
+		return
+
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import get_email
+
+	frappe.sendmail(
+		recipients=get_email(history_record.author),
+		subject="Document signed",
+		message="Your document has been signed.",
+		attachments=[{
+			"fid": saved_file.name
+		}])
+	frappe.db.set_value("Circularo Documents", history_record.name, "email_status", EMAIL_QUEUED, update_modified=False)
+
+
+def send_digest(author):
+	"""
+	Queue one e-mail with all pending signed documents of given user
+
+	:param author: User
+	:type author: str
+	:return: Count of documents in the digest
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import get_email
+
+	rows = frappe.db.sql("""
+		select name, target_doctype, target_docname, file_url
+		from `tabCircularo Documents`
+		where author = %(author)s and email_status = %(pending)s
+		order by email_pending_since
+		for update""", {"author": author, "pending": EMAIL_PENDING}, as_dict=True)
+	if not rows:
+		return 0
+
+	# Every document has its own File, documents with identical content share one stored file, which is attached once
+	attached_rows = [row for row in rows[:MAX_DIGEST_ATTACHMENTS] if row.file_url]
+	file_names = dict(((attached_to_name, file_url), name) for attached_to_name, file_url, name in frappe.get_all("File",
+		filters={"attached_to_doctype": "Circularo Documents", "attached_to_name": ["in", [row.name for row in attached_rows]]},
+		fields=["attached_to_name", "file_url", "name"], as_list=True)) if attached_rows else {}
+
+	attachments = []
+	file_urls = set()
+	for row in attached_rows:
+		file_name = file_names.get((row.name, row.file_url))
+		if file_name and (row.file_url not in file_urls):
+			file_urls.add(row.file_url)
+			attachments.append({"fid": file_name})
+	documents = "".join("<li>{0} {1}</li>".format(escape_html(row.target_doctype), escape_html(row.target_docname)) for row in rows)
+
+	frappe.sendmail(
+		recipients=get_email(author),
+		subject="{0} documents signed".format(len(rows)) if len(rows) > 1 else "Document signed",
+		message="<p>Your documents have been signed:</p><ul>{0}</ul>".format(documents),
+		attachments=attachments)
+
+	frappe.db.sql("""
+		update `tabCircularo Documents`
+		set email_status = %(queued)s
+		where name in %(names)s""", {"queued": EMAIL_QUEUED, "names": [row.name for row in rows]})
+
+	return len(rows)
+
+
+def discard_pending_emails():
+	"""
+	Forget pending documents, e.g. when e-mails were turned off, so they are neither e-mailed later nor kept from archiving
+
+	:return: Count of discarded documents
+	"""
+	names = frappe.db.sql_list("""
+		select name
+		from `tabCircularo Documents`
+		where email_status = %(pending)s
+		for update""", {"pending": EMAIL_PENDING})
+	if not names:
+		return 0
+
+	frappe.db.sql("""
+		update `tabCircularo Documents`
+		set email_status = null, email_pending_since = null
+		where name in %(names)s""", {"names": names})
+
+	return len(names)
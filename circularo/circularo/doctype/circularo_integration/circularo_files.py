@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import os
+import tempfile
+import frappe
+from frappe.utils import get_files_path
+from circularo.circularo.doctype.circularo_integration.circularo_utils import stream_to_file
+
+# Prefix of downloaded files stored by content hash (in public files directory)
+STORED_FILE_PREFIX = "circularo-"
+
+
+def save_response_as_file(response, file_name, attached_to_doctype, attached_to_name, deadline=None):
+	"""
+	Stream response body to disk and register it as public Frappe File attached to given document
+	Body is written chunk by chunk, it is never held in memory as a whole
+	Files are stored by content hash, identical content is kept on disk once
+	Every document still gets its own File with readable name (e-mail attachments, file list), pointing to the stored file
+
+	:param response: Response of streamed request
+	:type response: requests.Response
+	:param file_name: Name of the File
+	:type file_name: str
+	:param attached_to_doctype: DocType of the document the File is attached to
+	:type attached_to_doctype: str
+	:param attached_to_name: DocName of the document the File is attached to
+	:type attached_to_name: str
+	:param deadline: Optional time (as time.time()) by which the body must be downloaded
+	:type deadline: float | None
+	:return: Saved File
+	"""
+	files_path = get_files_path()
+	temp_fd, temp_path = tempfile.mkstemp(prefix=".circularo-", suffix=".part", dir=files_path)
+
+	try:
+		with os.fdopen(temp_fd, "wb") as temp_file:
+			file_size, content_hash = stream_to_file(response, temp_file, deadline=deadline)
+
+		stored_name = get_stored_file_name(content_hash)
+		stored_path = get_files_path(stored_name)
+		if os.path.exists(stored_path):
+			# Same content is already stored
+			os.remove(temp_path)
+		else:
+			os.rename(temp_path, stored_path)
+	except Exception:
+		if os.path.exists(temp_path):
+			os.remove(temp_path)
+		raise
+
+	file_url = "/files/" + stored_name
+	attached_file = {
+		"file_url": file_url,
+		"attached_to_doctype": attached_to_doctype,
+		"attached_to_name": attached_to_name
+	}
+
+	# Row lock of the document, concurrent downloads of it must not register the file twice
+	frappe.db.get_value(attached_to_doctype, attached_to_name, "name", for_update=True)
+	existing_file = frappe.db.get_value("File", attached_file, "name")
+	if existing_file:
+		return frappe.get_doc("File", existing_file)
+
+	saved_file = frappe.get_doc(dict(attached_file, **{
+		"doctype": "File",
+		"file_name": file_name,
+		"file_size": file_size,
+		"content_hash": content_hash,
+		"is_private": 0
+	}))
+	saved_file.flags.ignore_permissions = True
+	# Frappe looks for the file by its name, the stored file is named by content and it was just written
+	saved_file.flags.ignore_file_validate = True
+	try:
+		saved_file.insert()
+	except frappe.DuplicateEntryError:
+		# Same content is already attached to the document under another URL
+		return frappe.get_doc("File", {
+			"content_hash": content_hash,
+			"attached_to_doctype": attached_to_doctype,
+			"attached_to_name": attached_to_name
+		})
+
+	return saved_file
+
+
+def get_stored_file_name(content_hash):
+	"""
+	Get name of stored file with given content
+
+	:param content_hash: Content hash (as computed by stream_to_file)
+	:type content_hash: str
+	:return: File name in public files directory
+	"""
+	return STORED_FILE_PREFIX + content_hash + ".pdf"
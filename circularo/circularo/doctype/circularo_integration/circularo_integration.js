@@ -5,6 +5,16 @@
  * Circularo Integration doctype frontend
  */
 frappe.ui.form.on('Circularo Integration', {
+    /**
+     * Shows circuit breaker status
+     * @param frm {Object}
+     */
+    refresh: function(frm) {
+        if (frm.doc.enabled && frm.doc.circularo_url) {
+            renderCircuitBreakerStatus(frm);
+        }
+    },
+
     /**
      * Creates Circularo API token
      * @param frm {Object}
@@ -64,6 +74,19 @@ frappe.ui.form.on('Circularo Integration', {
         });
     },
 
+    /**
+     * Closes circuit breaker, so Circularo requests are sent again
+     * @param frm {Object}
+     */
+    reset_circuit_breaker: function(frm) {
+        frappe.call({
+            method: "circularo.circularo.doctype.circularo_integration.circularo_integration.reset_circuit_breaker",
+            callback: function() {
+                renderCircuitBreakerStatus(frm);
+            }
+        });
+    },
+
     /**
      * Restores Circularo settings
      */
@@ -76,3 +99,34 @@ frappe.ui.form.on('Circularo Integration', {
         });
     }
 });
+
+/**
+ * Renders circuit breaker status into the form
+ * @param frm {Object}
+ */
+function renderCircuitBreakerStatus(frm) {
+    frappe.call({
+        method: "circularo.circularo.doctype.circularo_integration.circularo_integration.get_circuit_breaker_state",
+        callback: function(val) {
+            const args = val.message;
+            const wrapper = frm.get_field("circuit_breaker_status").$wrapper;
+            if (args.status !== 0) {
+                wrapper.html("");
+                return;
+            }
+
+            const state = args.message;
+            const indicators = {"closed": "green", "half-open": "orange", "open": "red"};
+            let html = `<p><span class="indicator ${indicators[state.state]}">Circuit breaker: ${state.state}</span></p>`
+                + `<p class="text-muted">Consecutive failures: ${state.failures} / ${state.failure_threshold}, trips: ${state.trips}`;
+            if (state.state === "open") {
+                html += `, requests suspended for ${state.remaining_cooldown} s`;
+            }
+            html += "</p>";
+            if (state.last_error) {
+                html += `<p class="text-muted">Last error: ${frappe.utils.escape_html(state.last_error)}</p>`;
+            }
+            wrapper.html(html);
+        }
+    });
+}
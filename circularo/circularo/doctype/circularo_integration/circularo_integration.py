@@ -3,13 +3,31 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
-import io
+import hmac
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import frappe
+import requests
 from frappe.model.document import Document
 from frappe.utils.pdf import get_pdf
-from frappe.utils.file_manager import save_file
-from PyPDF2 import PdfFileReader
-from circularo.circularo.doctype.circularo_integration.circularo_utils import create_circularo_url, call_rest_api
+from circularo.circularo.doctype.circularo_integration.circularo_utils import create_circularo_url, call_rest_api, \
+	get_pool_stats as _get_pool_stats, hash_file, add_request_listener, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from circularo.circularo.doctype.circularo_integration.circularo_breaker import get_circuit_breaker, DEFAULT_FAILURE_THRESHOLD, \
+	DEFAULT_COOLDOWN
+from circularo.circularo.doctype.circularo_integration.circularo_email import queue_signed_document_email, DEFAULT_EMAIL_DIGEST_WINDOW
+from circularo.circularo.doctype.circularo_integration.circularo_files import save_response_as_file
+from circularo.circularo.doctype.circularo_integration.circularo_jobs import DEFAULT_BULK_CONCURRENCY, DEFAULT_HISTORY_RETENTION_DAYS
+from circularo.circularo.doctype.circularo_integration.circularo_metrics import record_request, record_pdf_optimization
+from circularo.circularo.doctype.circularo_integration.circularo_pdf import get_page_count, merge_pdfs, optimize_pdf, render_batch_pdf, \
+	spool_pdf, DEFAULT_IMAGE_RESOLUTION
+from circularo.circularo.doctype.circularo_integration.circularo_pdf_cache import get_cache_key, get_cached_pdf, put_pdf, \
+	DEFAULT_PDF_CACHE_SIZE
+from circularo.circularo.doctype.circularo_integration.circularo_progress import ProgressReporter, get_stages, report, STAGE_RENDERED, \
+	STAGE_UPLOADED, STAGE_CREATED, STAGE_SIGNED, STAGE_DOWNLOADED
+from circularo.circularo.doctype.circularo_integration.circularo_render import DEFAULT_RENDER_POOL_SIZE, DEFAULT_RENDER_BATCH_SIZE
+from circularo.circularo.doctype.circularo_integration.circularo_uploads import get_uploaded_file_id, remember_uploaded_file, \
+	forget_uploaded_file, DEFAULT_UPLOAD_INDEX_TTL
 
 # Sign during document creation
 QUICK_SIGN = True
@@ -19,9 +37,36 @@ DEFAULT_DOCUMENT_TYPE = "d_default"
 DEFAULT_DEFINITION_TYPE = "ext"
 DEFAULT_WORKFLOW_TYPE = "wf_archive"
 
+# Circularo actions (same as CIRCULARO_ACTIONS in circularo_doctype_hooks.js)
+ACTION_SEND = 0
+ACTION_SIGN = 1
+ACTION_AUTOSIGN = 2
+
+# Timeout of bulk send background job (seconds)
+BULK_SEND_TIMEOUT = 4 * 60 * 60
+
+# Default time budget of one Circularo operation incl. all its requests (seconds)
+DEFAULT_OPERATION_TIMEOUT = 120
+
+# Responses of servers which do not support HEAD requests
+HEAD_UNSUPPORTED_STATUS_CODES = (405, 501)
+
+# Timeouts of REST calls setting up the integration (seconds)
+# Typed server URL may differ from the configured one, so neither settings nor circuit breaker are involved
+SETUP_TIMEOUT = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+
 # Required user rights
 REQUIRED_RIGHTS = ["use_file_management", "use_document_management"]
 
+# Redis key of current settings version (shared by all workers)
+SETTINGS_VERSION_KEY = "circularo_settings_version"
+
+# Process-wide settings cache, site -> (version, settings)
+_settings_cache = {}
+
+# Record metrics of all Circularo REST calls
+add_request_listener(record_request)
+
 
 class CircularoIntegration(Document):
 	"""
@@ -31,12 +76,31 @@ class CircularoIntegration(Document):
 	def validate(self):
 		"""
 		If integration is not enabled, delete API token
+		Generate webhook token if missing
 
 		:return:
 		"""
 		if not self.enabled:
 			self.logout_api_token()
 
+		if not self.webhook_token:
+			self.webhook_token = frappe.generate_hash(length=32)
+
+		clear_settings_cache()
+
+	def on_update(self):
+		"""
+		Invalidate cached settings in all workers
+		Invalidated once more after commit, so no worker keeps settings read before the commit
+
+		:return:
+		"""
+		clear_settings_cache()
+		frappe.enqueue(
+			"circularo.circularo.doctype.circularo_integration.circularo_integration.clear_settings_cache",
+			queue="short",
+			enqueue_after_commit=True)
+
 	def get_preview_url(self, document_id):
 		"""
 		Get Circularo document preview URL
@@ -72,22 +136,23 @@ class CircularoIntegration(Document):
 		if self.circularo_api_token is not None:
 			try:
 				logout_url = create_circularo_url(self.circularo_url, "api/key/" + self.circularo_api_token)
-				call_rest_api("delete", logout_url)
+				call_rest_api("delete", logout_url, **_request_options(self))
 			except:
 				pass
 
 		self.circularo_api_token = None
 
-	def is_enabled(self, doctype, view, docname):
+	def is_enabled(self, doctype, view, docname=None):
 		"""
 		Check if Circularo integration is enabled for current doctype and view
+		Uses precomputed DocType allow-list and DocType meta, document itself is never loaded
 
 		:param doctype: Frappe DocType
 		:type doctype: str
 		:param view: Frappe View
 		:type view: str
-		:param docname: Frappe DocName
-		:type docname: str
+		:param docname: Frappe DocName (unused, kept for compatibility)
+		:type docname: str | None
 		:return: True if enabled
 		"""
 		# Do not show for Circularo Documents (history)
@@ -110,24 +175,73 @@ class CircularoIntegration(Document):
 
 		if self.show_in_all_doctypes == 0:
 			# Not enabled for all DocTypes
-			split_doctypes = self.show_in_doctypes.split(",")
-			my_doctypes = []
-			for doc in split_doctypes:
-				my_doctypes.append(doc.lower().strip())
-
-			check_doctype = doctype.lower().strip()
-			if check_doctype not in my_doctypes:
+			if doctype.lower().strip() not in self.get_allowed_doctypes():
 				return False
 
 		elif (view.lower() == "form") and (self.show_in_single == 0):
 			# Enabled for all DocTypes without singletons
-			issingle = frappe.get_doc(doctype, docname)._meta.issingle
-			if issingle == 1:
+			if frappe.get_meta(doctype).issingle == 1:
 				return False
 
 		#  Pass
 		return True
 
+	def get_allowed_doctypes(self):
+		"""
+		Get normalized set of chosen DocTypes
+		Computed once for each value of show_in_doctypes, cached settings therefore split it only once
+
+		:return: Lowercase DocTypes
+		"""
+		cached = getattr(self, "_allowed_doctypes", None)
+		if (cached is None) or (cached[0] != self.show_in_doctypes):
+			allowed_doctypes = frozenset(doc.lower().strip() for doc in (self.show_in_doctypes or "").split(","))
+			cached = (self.show_in_doctypes, allowed_doctypes)
+			self._allowed_doctypes = cached
+
+		return cached[1]
+
+
+def get_settings():
+	"""
+	Get cached Circularo Integration settings
+	Settings are cached per request and per process, process cache is validated against version shared by all workers
+	Returned document must not be modified, use frappe.get_doc to change settings
+
+	:return: Circularo Integration settings
+	"""
+	settings = getattr(frappe.local, "circularo_settings", None)
+	if settings is not None:
+		return settings
+
+	site = frappe.local.site
+	version = frappe.cache().get_value(SETTINGS_VERSION_KEY)
+	cached = _settings_cache.get(site)
+
+	if (version is not None) and (cached is not None) and (cached[0] == version):
+		settings = cached[1]
+	else:
+		if version is None:
+			version = frappe.generate_hash(length=10)
+			frappe.cache().set_value(SETTINGS_VERSION_KEY, version)
+
+		settings = frappe.get_doc("Circularo Integration")
+		_settings_cache[site] = (version, settings)
+
+	frappe.local.circularo_settings = settings
+	return settings
+
+
+def clear_settings_cache():
+	"""
+	Invalidate cached Circularo Integration settings in all workers
+
+	:return:
+	"""
+	frappe.cache().delete_value(SETTINGS_VERSION_KEY)
+	_settings_cache.pop(frappe.local.site, None)
+	frappe.local.circularo_settings = None
+
 
 @frappe.whitelist()
 def restore_settings():
@@ -141,6 +255,22 @@ def restore_settings():
 	circularo_integration.circularo_definition_type = DEFAULT_DEFINITION_TYPE
 	circularo_integration.circularo_workflow_type = DEFAULT_WORKFLOW_TYPE
 	circularo_integration.send_to_email = 0
+	circularo_integration.email_digest = 0
+	circularo_integration.email_digest_window = DEFAULT_EMAIL_DIGEST_WINDOW
+	circularo_integration.http_pool_size = DEFAULT_POOL_SIZE
+	circularo_integration.bulk_send_concurrency = DEFAULT_BULK_CONCURRENCY
+	circularo_integration.render_pool_size = DEFAULT_RENDER_POOL_SIZE
+	circularo_integration.render_batch_size = DEFAULT_RENDER_BATCH_SIZE
+	circularo_integration.pdf_cache_size = DEFAULT_PDF_CACHE_SIZE
+	circularo_integration.optimize_pdf = 0
+	circularo_integration.pdf_image_resolution = DEFAULT_IMAGE_RESOLUTION
+	circularo_integration.upload_index_ttl = DEFAULT_UPLOAD_INDEX_TTL
+	circularo_integration.breaker_failure_threshold = DEFAULT_FAILURE_THRESHOLD
+	circularo_integration.breaker_cooldown = DEFAULT_COOLDOWN
+	circularo_integration.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+	circularo_integration.read_timeout = DEFAULT_READ_TIMEOUT
+	circularo_integration.operation_timeout = DEFAULT_OPERATION_TIMEOUT
+	circularo_integration.history_retention_days = DEFAULT_HISTORY_RETENTION_DAYS
 	circularo_integration.save()
 
 	return {
@@ -150,7 +280,7 @@ def restore_settings():
 
 
 @frappe.whitelist()
-def is_enabled(doctype, view, docname):
+def is_enabled(doctype, view, docname=None):
 	"""
 	Check if Circularo integration is enabled for given DocType and view
 
@@ -158,11 +288,11 @@ def is_enabled(doctype, view, docname):
 	:type doctype: str
 	:param view: Frappe View
 	:type view: str
-	:param docname: Frappe DocName
-	:type docname: str
+	:param docname: Frappe DocName (unused, kept for compatibility)
+	:type docname: str | None
 	:return:
 	"""
-	circularo_integration = frappe.get_doc("Circularo Integration")
+	circularo_integration = get_settings()
 	if circularo_integration.is_enabled(doctype, view, docname):
 		return {
 			"status": 0,
@@ -175,6 +305,30 @@ def is_enabled(doctype, view, docname):
 		}
 
 
+@frappe.whitelist()
+def is_enabled_batch(items):
+	"""
+	Check if Circularo integration is enabled for many DocTypes and views in one call
+
+	:param items: JSON list of [doctype, view] pairs
+	:type items: str | list
+	:return: List of booleans in order of given items
+	"""
+	circularo_integration = get_settings()
+
+	results = []
+	for doctype, view in frappe.parse_json(items):
+		try:
+			results.append(circularo_integration.is_enabled(doctype, view))
+		except frappe.DoesNotExistError:
+			results.append(False)
+
+	return {
+		"status": 0,
+		"message": results
+	}
+
+
 @frappe.whitelist()
 def create_api_token(url, tenant, email, password):
 	"""
@@ -256,6 +410,62 @@ def remove_api_token():
 	}
 
 
+@frappe.whitelist()
+def get_pool_stats():
+	"""
+	Get statistics of pooled Circularo connections in current process
+
+	:return:
+	"""
+	frappe.only_for("System Manager")
+
+	return {
+		"status": 0,
+		"message": _get_pool_stats()
+	}
+
+
+@frappe.whitelist()
+def get_circuit_breaker_state():
+	"""
+	Get state of circuit breaker of configured Circularo server
+
+	:return:
+	"""
+	frappe.only_for("System Manager")
+
+	circuit_breaker = get_circuit_breaker(get_settings())
+	if circuit_breaker is None:
+		return {
+			"status": 1,
+			"message": "Circularo server is not configured"
+		}
+
+	return {
+		"status": 0,
+		"message": circuit_breaker.get_state()
+	}
+
+
+@frappe.whitelist()
+def reset_circuit_breaker():
+	"""
+	Close circuit breaker of configured Circularo server, so requests are sent again
+
+	:return:
+	"""
+	frappe.only_for("System Manager")
+
+	circuit_breaker = get_circuit_breaker(get_settings())
+	if circuit_breaker is not None:
+		circuit_breaker.reset()
+
+	return {
+		"status": 0,
+		"message": {}
+	}
+
+
 @frappe.whitelist()
 def upload_file(doctype, docname):
 	"""
@@ -268,17 +478,13 @@ def upload_file(doctype, docname):
 	:return: Circularo file info
 	"""
 	try:
-		circularo_integration = frappe.get_doc("Circularo Integration")
-		create_file_url = create_circularo_url(circularo_integration.circularo_url, "files/saveFile", {"token": circularo_integration.circularo_api_token})
-
-		# Crete PDF file from document
-		pdf_bytes, num_pages = _print_to_pdf(doctype, docname)
-		r = call_rest_api("post", create_file_url, {"fileName": docname + ".pdf"}, {"file": pdf_bytes})
+		with _operation_deadline():
+			file_id, num_pages = _upload_file(doctype, docname)
 
 		return {
 			"status": 0,
 			"message": {
-				"file_id": r.get("file").get("hash"),
+				"file_id": file_id,
 				"num_pages": num_pages
 			}
 		}
@@ -310,104 +516,12 @@ def create_document(doctype, docname, file_hash, sign_page, is_sign, is_autosign
 	:return: Circularo document info
 	"""
 	try:
-		is_sign = int(is_sign)
-		is_autosign = int(is_autosign)
-
-		circularo_integration = frappe.get_doc("Circularo Integration")
-		create_document_url = create_circularo_url(circularo_integration.circularo_url, "documents", {"token": circularo_integration.circularo_api_token})
-
-		# Base JSON to create document
-		json = {
-			"body": {
-				"documentType": circularo_integration.circularo_document_type,
-				"documentTitle": docname,
-				"pdfFile": {
-					"content": file_hash
-				}
-			},
-			"definitionType": circularo_integration.circularo_definition_type,
-			"workflow": circularo_integration.circularo_workflow_type
-		}
-
-		if is_autosign == 1:
-			# Sign document
-
-			if QUICK_SIGN:
-				# Quick sign (in one request)
-
-				# Append new data to existing JSON
-				json["optionalData"] = {
-					"signatures": [{
-						"type": "signature",
-						"blob": circularo_integration.signature_id,
-						"page":  sign_page,
-						"position": {
-							"percentX": 0.53,
-							"percentY": 0.81,
-							"percentWidth": 0.40,
-							"percentHeight": 0.10
-						},
-						"decorationType": "empty"
-					}],
-					"annotations": [{
-						"align": "left",
-						"backgroundColor": "#ffffff",
-						"bold": False,
-						"color": "#000000",
-						"fontSize": 10,
-						"page": sign_page,
-						"position": {
-							"percentX": 0.55,
-							"percentY": 0.92,
-							"percentWidth": 0.35,
-							"percentHeight": 0.015
-						},
-						"subtype": "docId",
-						"text": "{{{documentId}}}"
-					}]
-				}
-				r = call_rest_api("post", create_document_url, json)
-				document_id = r.get("results")[0].get("documentId")
-
-			else:
-				# "Slow" sign
-
-				# 1. Create document
-				r = call_rest_api("post", create_document_url, json)
-				document_id = r.get("results")[0].get("documentId")
-
-				# 2. Check document version
-				document_version = str(_get_document_details(document_id).get("_version"))
-
-				# 3. Sign document
-				_sign_document(document_id, document_version, sign_page)
-
-		else:
-			# Not signing
-			r = call_rest_api("post", create_document_url, json)
-			document_id = r.get("results")[0].get("documentId")
-
-		preview_url = circularo_integration.get_preview_url(document_id)
-		sign_url = circularo_integration.get_sign_url(document_id)
-
-		# Create history record
-		history_record = frappe.new_doc("Circularo Documents")
-		history_record.initialize(doctype, docname, document_id, preview_url, sign_url, is_sign, is_autosign)
-		history_record.save()
-
-		history_url = history_record.get_url()
-		history_name = history_record.name
+		with _operation_deadline():
+			history_record = _create_document(doctype, docname, file_hash, sign_page, int(is_sign), int(is_autosign))
 
 		return {
 			"status": 0,
-			"message": {
-				"docname": docname,
-				"document_id": document_id,
-				"preview_url": preview_url,
-				"sign_url": sign_url,
-				"history_url": history_url,
-				"history_name": history_name
-			}
+			"message": _get_document_message(history_record)
 		}
 
 	except Exception as e:
@@ -429,71 +543,251 @@ def download_file(history_name, download_manual_sign):
 	:return: Info if file was downloaded
 	"""
 	try:
-		download_manual_sign = int(download_manual_sign)
 		history_record = frappe.get_doc("Circularo Documents", history_name)
 
-		if (download_manual_sign == 0) and (history_record.is_sign == 1) and (history_record.is_autosign == 0):
-			# Manual sign and we don't want to download -> return
+		with _operation_deadline():
 			return {
 				"status": 0,
-				"message": {
-					"downloaded": False
-				}
+				"message": _download_history_file(history_record, int(download_manual_sign))
 			}
 
-		# Fetch document details
-		document_details = _get_document_details(history_record.target_document_id)
-		file_id = document_details.get("pdfFile").get("content")
-		is_signed = document_details.get("isSigned")
+	except Exception as e:
+		return {
+			"status": 1,
+			"message": str(e)
+		}
 
-		if (download_manual_sign == 1) and (not is_signed) and (history_record.is_sign == 1) and (history_record.is_autosign == 0):
-			# Manual sign and we want to download, but not signed yet -> return sign URL
-			return {
-				"status": 0,
-				"message": {
-					"downloaded": False,
-					"sign_url": history_record.circularo_sign_url
-				}
-			}
 
-		file_name = history_record.target_docname + ".pdf"
-		# Download signed PDF file from Circularo
-		file_data = _download_file(file_id)
-		# Save downloaded file
-		saved_file = save_file(file_name, file_data.content, None, None)
+@frappe.whitelist()
+def send_document(doctype, docname, action, progress_id=None):
+	"""
+	Send Frappe document to Circularo in one request (upload, create and download)
 
-		# Update history record
-		history_record.file_url = saved_file.file_url
-		history_record.is_downloaded = True
-		history_record.save()
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param action: Circularo action (ACTION_SEND, ACTION_SIGN or ACTION_AUTOSIGN)
+	:type action: int
+	:param progress_id: Optional ID to publish progress of the stages under (as "circularo_progress" realtime events)
+	:type progress_id: str | None
+	:return: Circularo document info with durations of the stages (seconds)
+	"""
+	progress = None
+	try:
+		action = int(action)
+		if progress_id:
+			# Single document, every stage is published
+			progress = ProgressReporter(progress_id, frappe.session.user, 1, get_stages(*_get_action_flags(action)), interval=0)
 
-		circularo_integration = frappe.get_doc("Circularo Integration")
-		if (history_record.is_autosign == 1) and (circularo_integration.send_to_email == 1):
-			# Send e-mail with signed document
-			recipient = get_email(frappe.session.user)
-			frappe.sendmail(
-				recipients=recipient,
-				subject="Document signed",
-				message="Your document has been signed.",
-				attachments=[{
-					"fname": file_name,
-					"fcontent": file_data.content
-				}],
-				delayed=False)
+		message = _send_document(doctype, docname, action, progress=progress)
+		if progress is not None:
+			progress.complete(True)
 
 		return {
 			"status": 0,
-			"message": {
-				"downloaded": True
-			}
+			"message": message
 		}
 
+	except Exception as e:
+		if progress is not None:
+			progress.complete(False)
+
+		return {
+			"status": 1,
+			"message": str(e)
+		}
+
+	finally:
+		if progress is not None:
+			progress.finish()
+
+
+@frappe.whitelist(allow_guest=True)
+def signature_webhook(token=None, document_id=None, **kwargs):
+	"""
+	Receive "document signed" event from Circularo
+	Marks matching history record as signed and queues download of the signed file
+
+	:param token: Webhook token (or X-Circularo-Token header)
+	:type token: str | None
+	:param document_id: Circularo document ID (or documentId)
+	:type document_id: str | None
+	:return:
+	"""
+	circularo_integration = get_settings()
+	token = token or frappe.get_request_header("X-Circularo-Token")
+	if (not circularo_integration.webhook_token) or (not token) or \
+				(not hmac.compare_digest(frappe.as_unicode(circularo_integration.webhook_token), frappe.as_unicode(token))):
+		frappe.throw("Invalid webhook token.", frappe.AuthenticationError)
+
+	document_id = document_id or kwargs.get("documentId")
+	history_record = frappe.db.get_value("Circularo Documents", {"target_document_id": document_id}, ["name", "is_downloaded"], as_dict=True) \
+		if document_id else None
+	if history_record is None:
+		return {
+			"status": 1,
+			"message": "Unknown Circularo document."
+		}
+
+	frappe.db.set_value("Circularo Documents", history_record.name, "is_signed", 1)
+	if not history_record.is_downloaded:
+		frappe.enqueue(
+			"circularo.circularo.doctype.circularo_integration.circularo_jobs.download_signed_document",
+			queue="short",
+			enqueue_after_commit=True,
+			history_name=history_record.name)
+
+	return {
+		"status": 0,
+		"message": {}
+	}
+
+
+@frappe.whitelist()
+def bulk_send(doctype, docnames, action, combined=0):
+	"""
+	Send many Frappe documents to Circularo in one background job
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docnames: JSON list of Frappe DocNames
+	:type docnames: str | list
+	:param action: Circularo action (ACTION_SEND, ACTION_SIGN or ACTION_AUTOSIGN)
+	:type action: int
+	:param combined: 1 to archive all documents as one combined Circularo document (only ACTION_SEND)
+	:type combined: int
+	:return: Background job ID, summary is published as "circularo_bulk_send" realtime event
+		and progress as "circularo_progress" realtime events (see get_job_progress)
+	"""
+	try:
+		docnames = frappe.parse_json(docnames)
+		action = int(action)
+		combined = int(combined)
+		_get_action_flags(action)
+
+		if not isinstance(docnames, list) or (len(docnames) < 1):
+			frappe.throw("No documents selected.")
+		if combined and (action != ACTION_SEND):
+			frappe.throw("Only archived documents can be combined.")
+
+		# Results of the job are keyed by DocName, every document is sent once
+		docnames = list(OrderedDict.fromkeys(docnames))
+
+		job_id = frappe.generate_hash(length=10)
+		frappe.enqueue(
+			"circularo.circularo.doctype.circularo_integration.circularo_jobs.bulk_send_job",
+			queue="long",
+			timeout=BULK_SEND_TIMEOUT,
+			job_name="circularo_bulk_send_" + job_id,
+			job_id=job_id,
+			doctype=doctype,
+			docnames=docnames,
+			action=action,
+			user=frappe.session.user,
+			combined=combined)
+
 	except Exception as e:
 		return {
 			"status": 1,
 			"message": str(e)
 		}
 
+	return {
+		"status": 0,
+		"message": {
+			"job_id": job_id,
+			"total": len(docnames)
+		}
+	}
+
+
+def _send_document(doctype, docname, action, rendered=None, progress=None):
+	"""
+	Send Frappe document to Circularo (upload, create and download)
+	Download is skipped for manual sign, the document is not signed yet
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param action: Circularo action (ACTION_SEND, ACTION_SIGN or ACTION_AUTOSIGN)
+	:type action: int
+	:param rendered: Optional already rendered PDF file and number of pages
+	:type rendered: tuple | None
+	:param progress: Optional progress reporter of the stages
+	:type progress: ProgressReporter | None
+	:return: Circularo document info with durations of the stages
+	"""
+	is_sign, is_autosign = _get_action_flags(action)
+	timings = {}
+
+	# One time budget for all stages
+	with _operation_deadline():
+		file_id, num_pages = _upload_file(doctype, docname, timings, rendered, progress)
+
+		with _measure(timings, "create"):
+			history_record = _create_document(doctype, docname, file_id, num_pages, is_sign, is_autosign)
+		report(progress, STAGE_CREATED)
+		if is_autosign == 1:
+			report(progress, STAGE_SIGNED)
+
+		if (is_sign == 0) or (is_autosign == 1):
+			with _measure(timings, "download"):
+				_download_history_file(history_record, 0)
+			report(progress, STAGE_DOWNLOADED)
+
+	message = _get_document_message(history_record)
+	message["timings"] = timings
+	return message
+
+
+def _send_combined_document(doctype, parts, action, progress=None):
+	"""
+	Send many rendered Frappe documents to Circularo as one combined document (merge, upload, create and download)
+	History record keeps page ranges of the documents
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param parts: List of (DocName, rendered PDF file path, number of pages) tuples
+	:type parts: list
+	:param action: Circularo action (ACTION_SEND, ACTION_SIGN or ACTION_AUTOSIGN)
+	:type action: int
+	:param progress: Optional progress reporter of the stages
+	:type progress: ProgressReporter | None
+	:return: Circularo document info with page ranges and durations of the stages
+	"""
+	circularo_integration = get_settings()
+	is_sign, is_autosign = _get_action_flags(action)
+	timings = {}
+
+	title = parts[0][0] if len(parts) == 1 else "{0} - {1} ({2})".format(parts[0][0], parts[-1][0], len(parts))
+
+	with _measure(timings, "merge"):
+		pdf_file, page_ranges = merge_pdfs(parts)
+
+	# One time budget for all requests, merging is local work
+	with _operation_deadline(len(parts)):
+		with pdf_file, _measure(timings, "upload"):
+			file_id = _upload_pdf(circularo_integration, pdf_file, title + ".pdf")
+		report(progress, STAGE_UPLOADED, len(parts))
+
+		with _measure(timings, "create"):
+			history_record = _create_document(doctype, title, file_id, page_ranges[-1].get("to"), is_sign, is_autosign, page_ranges)
+		report(progress, STAGE_CREATED, len(parts))
+		if is_autosign == 1:
+			report(progress, STAGE_SIGNED, len(parts))
+
+		if (is_sign == 0) or (is_autosign == 1):
+			with _measure(timings, "download"):
+				_download_history_file(history_record, 0)
+			report(progress, STAGE_DOWNLOADED, len(parts))
+
+	message = _get_document_message(history_record)
+	message["page_ranges"] = page_ranges
+	message["timings"] = timings
+	return message
+
 
 def get_email(user):
 	"""
@@ -506,36 +800,348 @@ def get_email(user):
 	return frappe.db.get_value("User", user, ["email"], as_dict=True).get("email")
 
 
-def _download_file(file_id):
+def _get_action_flags(action):
+	"""
+	Translate Circularo action into history flags
+
+	:param action: Circularo action (ACTION_SEND, ACTION_SIGN or ACTION_AUTOSIGN)
+	:type action: int
+	:return: is_sign and is_autosign flags
+	"""
+	if action == ACTION_SEND:
+		return 0, 0
+	elif action == ACTION_SIGN:
+		return 1, 0
+	elif action == ACTION_AUTOSIGN:
+		return 1, 1
+
+	frappe.throw("Unknown Circularo action '" + str(action) + "'.")
+
+
+def _upload_file(doctype, docname, timings=None, rendered=None, progress=None):
+	"""
+	Print Frappe document to PDF and upload it into Circularo
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param timings: Optional dictionary to store durations of "render" and "upload" stages into
+	:type timings: dict | None
+	:param rendered: Optional already rendered PDF file and number of pages, it is closed after upload
+	:type rendered: tuple | None
+	:param progress: Optional progress reporter of the stages
+	:type progress: ProgressReporter | None
+	:return: Circularo file ID and number of pages
+	"""
+	circularo_integration = get_settings()
+
+	if rendered is None:
+		# Crete PDF file from document
+		with _measure(timings, "render"):
+			pdf_file, num_pages = _print_to_pdf(doctype, docname)
+		report(progress, STAGE_RENDERED)
+	else:
+		pdf_file, num_pages = rendered
+
+	with pdf_file, _measure(timings, "upload"):
+		file_id = _upload_pdf(circularo_integration, pdf_file, docname + ".pdf")
+	report(progress, STAGE_UPLOADED)
+
+	return file_id, num_pages
+
+
+def _upload_pdf(circularo_integration, pdf_file, file_name):
+	"""
+	Upload PDF file into Circularo
+	Identical content is uploaded only once
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:param pdf_file: PDF file opened for reading
+	:type pdf_file: file
+	:param file_name: File name
+	:type file_name: str
+	:return: Circularo file ID
+	"""
+	create_file_url = create_circularo_url(circularo_integration.circularo_url, "files/saveFile", {"token": circularo_integration.circularo_api_token})
+
+	content_hash, file_size = hash_file(pdf_file)
+	file_id = get_uploaded_file_id(circularo_integration, content_hash, file_size)
+
+	if (file_id is not None) and (not _is_file_available(circularo_integration, file_id)):
+		# Index entry outlived the file in Circularo
+		forget_uploaded_file(circularo_integration, file_id)
+		file_id = None
+
+	if file_id is None:
+		r = call_rest_api("post", create_file_url, {"fileName": file_name}, {"file": (file_name, pdf_file)}, **_request_options(circularo_integration))
+		file_id = r.get("file").get("hash")
+		remember_uploaded_file(circularo_integration, content_hash, file_size, file_id)
+
+	return file_id
+
+
+def _is_file_available(circularo_integration, file_id):
+	"""
+	Check if file uploaded earlier is still available in Circularo
+	Only headers are requested (HEAD), the file is not downloaded
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:param file_id: Circularo file ID
+	:type file_id: str
+	:return: False if Circularo does not know the file
+	"""
+	load_file_url = create_circularo_url(circularo_integration.circularo_url, "files/loadFile/hash/" + file_id, {"token": circularo_integration.circularo_api_token})
+
+	try:
+		call_rest_api("head", load_file_url, None, None, False, **_request_options(circularo_integration))
+	except requests.HTTPError as e:
+		if (e.response is not None) and (e.response.status_code in HEAD_UNSUPPORTED_STATUS_CODES):
+			# Cannot be checked, invalid file is detected when the document is created
+			return True
+		if (e.response is not None) and (400 <= e.response.status_code < 500):
+			return False
+		raise
+
+	return True
+
+
+def _create_document(doctype, docname, file_hash, sign_page, is_sign, is_autosign, page_ranges=None):
+	"""
+	Create Circularo document from uploaded file and its history record
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param file_hash: Circularo file ID
+	:type file_hash: str
+	:param sign_page: Number of PDF fie pages
+	:type sign_page: int
+	:param is_sign: 1 if is sign action, 0 otherwise
+	:type is_sign: int
+	:param is_autosign: 1 if is autosign action, 0 otherwise
+	:type is_autosign: int
+	:param page_ranges: Optional page ranges of documents combined in the file
+	:type page_ranges: list | None
+	:return: Circularo documents (history) record
+	"""
+	circularo_integration = get_settings()
+
+	try:
+		document_id = _create_circularo_document(circularo_integration, docname, file_hash, sign_page, is_autosign)
+	except requests.HTTPError as e:
+		if (e.response is not None) and (400 <= e.response.status_code < 500):
+			# File reused from upload index may have become invalid since it was checked
+			forget_uploaded_file(circularo_integration, file_hash)
+		raise
+
+	preview_url = circularo_integration.get_preview_url(document_id)
+	sign_url = circularo_integration.get_sign_url(document_id)
+
+	# Create history record
+	history_record = frappe.new_doc("Circularo Documents")
+	history_record.initialize(doctype, docname, document_id, preview_url, sign_url, is_sign, is_autosign, page_ranges)
+	history_record.save()
+
+	return history_record
+
+
+def _create_circularo_document(circularo_integration, docname, file_hash, sign_page, is_autosign):
+	"""
+	Create Circularo document from uploaded file
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:param docname: Frappe DocName
+	:type docname: str
+	:param file_hash: Circularo file ID
+	:type file_hash: str
+	:param sign_page: Number of PDF fie pages
+	:type sign_page: int
+	:param is_autosign: 1 if is autosign action, 0 otherwise
+	:type is_autosign: int
+	:return: Circularo document ID
+	"""
+	create_document_url = create_circularo_url(circularo_integration.circularo_url, "documents", {"token": circularo_integration.circularo_api_token})
+
+	# Base JSON to create document
+	json = {
+		"body": {
+			"documentType": circularo_integration.circularo_document_type,
+			"documentTitle": docname,
+			"pdfFile": {
+				"content": file_hash
+			}
+		},
+		"definitionType": circularo_integration.circularo_definition_type,
+		"workflow": circularo_integration.circularo_workflow_type
+	}
+
+	if is_autosign == 1:
+		# Sign document
+
+		if QUICK_SIGN:
+			# Quick sign (in one request)
+
+			# Append new data to existing JSON
+			json["optionalData"] = {
+				"signatures": [{
+					"type": "signature",
+					"blob": circularo_integration.signature_id,
+					"page":  sign_page,
+					"position": {
+						"percentX": 0.53,
+						"percentY": 0.81,
+						"percentWidth": 0.40,
+						"percentHeight": 0.10
+					},
+					"decorationType": "empty"
+				}],
+				"annotations": [{
+					"align": "left",
+					"backgroundColor": "#ffffff",
+					"bold": False,
+					"color": "#000000",
+					"fontSize": 10,
+					"page": sign_page,
+					"position": {
+						"percentX": 0.55,
+						"percentY": 0.92,
+						"percentWidth": 0.35,
+						"percentHeight": 0.015
+					},
+					"subtype": "docId",
+					"text": "{{{documentId}}}"
+				}]
+			}
+			r = call_rest_api("post", create_document_url, json, **_request_options(circularo_integration))
+			document_id = r.get("results")[0].get("documentId")
+
+		else:
+			# "Slow" sign
+
+			# 1. Create document
+			r = call_rest_api("post", create_document_url, json, **_request_options(circularo_integration))
+			document_id = r.get("results")[0].get("documentId")
+
+			# 2. Check document version
+			document_version = str(_get_document_details(document_id, circularo_integration).get("_version"))
+
+			# 3. Sign document
+			_sign_document(document_id, document_version, sign_page, circularo_integration)
+
+	else:
+		# Not signing
+		r = call_rest_api("post", create_document_url, json, **_request_options(circularo_integration))
+		document_id = r.get("results")[0].get("documentId")
+
+	return document_id
+
+
+def _get_document_message(history_record):
+	"""
+	Get Circularo document info of given history record
+
+	:param history_record: Circularo documents (history) record
+	:type history_record: CircularoDocuments
+	:return: Circularo document info
+	"""
+	return {
+		"docname": history_record.target_docname,
+		"document_id": history_record.target_document_id,
+		"preview_url": history_record.circularo_preview_url,
+		"sign_url": history_record.circularo_sign_url,
+		"history_url": history_record.get_url(),
+		"history_name": history_record.name
+	}
+
+
+def _download_history_file(history_record, download_manual_sign):
+	"""
+	Download PDF file of given history record from Circularo
+
+	:param history_record: Circularo documents (history) record
+	:type history_record: CircularoDocuments
+	:param download_manual_sign: If manual sign action was chosen, use 1 to download signed file or 0 to return immediately
+	:type download_manual_sign: int
+	:return: Info if file was downloaded
+	"""
+	if (download_manual_sign == 0) and (history_record.is_sign == 1) and (history_record.is_autosign == 0):
+		# Manual sign and we don't want to download -> return
+		return {
+			"downloaded": False
+		}
+
+	# Fetch document details
+	document_details = _get_document_details(history_record.target_document_id)
+	file_id = document_details.get("pdfFile").get("content")
+	is_signed = document_details.get("isSigned")
+	if is_signed:
+		history_record.is_signed = True
+
+	if (download_manual_sign == 1) and (not is_signed) and (history_record.is_sign == 1) and (history_record.is_autosign == 0):
+		# Manual sign and we want to download, but not signed yet -> return sign URL
+		return {
+			"downloaded": False,
+			"sign_url": history_record.circularo_sign_url
+		}
+
+	# Download signed PDF file from Circularo and stream it to disk
+	saved_file = save_response_as_file(_download_file(file_id), history_record.target_docname + ".pdf", history_record.doctype,
+		history_record.name, _get_deadline())
+
+	# Update history record
+	history_record.file_url = saved_file.file_url
+	history_record.is_downloaded = True
+	history_record.save()
+
+	circularo_integration = get_settings()
+	if (history_record.is_autosign == 1) and (circularo_integration.send_to_email == 1):
+		# Queue e-mail with signed document
+		queue_signed_document_email(history_record, saved_file, circularo_integration)
+
+	return {
+		"downloaded": True
+	}
+
+
+def _download_file(file_id, circularo_integration=None):
 	"""
 	Download file from Circularo
 
 	:param file_id: Circularo file ID
 	:type file_id: str
-	:return: Downloaded file bytes
+	:param circularo_integration: Optional Circularo Integration settings (for threads without Frappe context)
+	:type circularo_integration: CircularoIntegration | None
+	:return: Streamed response, read it with stream_to_file
 	"""
-	circularo_integration = frappe.get_doc("Circularo Integration")
+	circularo_integration = circularo_integration or get_settings()
 	download_file_url = create_circularo_url(circularo_integration.circularo_url, "files/loadFile/hash/" + file_id, {"token": circularo_integration.circularo_api_token})
 
-	return call_rest_api("get", download_file_url, None, None, False)
+	return call_rest_api("get", download_file_url, None, None, False, stream=True, **_request_options(circularo_integration))
 
 
-def _get_document_details(document_id):
+def _get_document_details(document_id, circularo_integration=None):
 	"""
 	Get details about Circularo document
 
 	:param document_id: Circularo document id
 	:type document_id: str
+	:param circularo_integration: Optional Circularo Integration settings (for threads without Frappe context)
+	:type circularo_integration: CircularoIntegration | None
 	:return: Document information
 	"""
-	circularo_integration = frappe.get_doc("Circularo Integration")
+	circularo_integration = circularo_integration or get_settings()
 	get_document_url = create_circularo_url(circularo_integration.circularo_url, "documents/" + document_id, {"token": circularo_integration.circularo_api_token})
 
-	r = call_rest_api("get", get_document_url)
+	r = call_rest_api("get", get_document_url, **_request_options(circularo_integration))
 	return r.get("results")[0]
 
 
-def _sign_document(document_id, document_version, sign_page):
+def _sign_document(document_id, document_version, sign_page, circularo_integration=None):
 	"""
 	Sign document in Circularo
 
@@ -545,9 +1151,11 @@ def _sign_document(document_id, document_version, sign_page):
 	:type document_version: str
 	:param sign_page: Page to be signed
 	:type sign_page: int
+	:param circularo_integration: Optional Circularo Integration settings (for threads without Frappe context)
+	:type circularo_integration: CircularoIntegration | None
 	:return:
 	"""
-	circularo_integration = frappe.get_doc("Circularo Integration")
+	circularo_integration = circularo_integration or get_settings()
 	sign_document_url = create_circularo_url(circularo_integration.circularo_url, "documents/sign/" + document_version, {"token": circularo_integration.circularo_api_token})
 	json = {
 		"id": document_id,
@@ -581,7 +1189,93 @@ def _sign_document(document_id, document_version, sign_page):
 			"text": "{{{documentId}}}"
 		}]
 	}
-	call_rest_api("put", sign_document_url, json)
+	call_rest_api("put", sign_document_url, json, **_request_options(circularo_integration))
+
+
+@contextmanager
+def _measure(timings, stage):
+	"""
+	Measure duration of a stage
+
+	:param timings: Dictionary to store duration (seconds) into, nothing is measured if None
+	:type timings: dict | None
+	:param stage: Stage name
+	:type stage: str
+	:return:
+	"""
+	start = time.time()
+	try:
+		yield
+	finally:
+		if timings is not None:
+			timings[stage] = round(time.time() - start, 3)
+
+
+@contextmanager
+def _operation_deadline(count=1):
+	"""
+	Bound total duration of all Circularo requests inside the block by operation timeout
+	Nested blocks keep the outer deadline
+
+	:param count: Count of documents sent by the operation (combined document gets budget of all its parts)
+	:type count: int
+	:return:
+	"""
+	if _get_deadline() is not None:
+		yield
+		return
+
+	frappe.local.circularo_deadline = time.time() + (get_settings().operation_timeout or DEFAULT_OPERATION_TIMEOUT) * max(count, 1)
+	try:
+		yield
+	finally:
+		frappe.local.circularo_deadline = None
+
+
+def _get_deadline():
+	"""
+	Get deadline of current Circularo operation
+
+	:return: Deadline (as time.time()) or None if there is no running operation
+	"""
+	return getattr(frappe.local, "circularo_deadline", None)
+
+
+def _request_options(circularo_integration):
+	"""
+	Get options of REST calls for given settings (and deadline of current operation)
+	Options overridden by _override_request_options take precedence
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:return: Keyword arguments of call_rest_api
+	"""
+	options = {
+		"pool_size": circularo_integration.http_pool_size or DEFAULT_POOL_SIZE,
+		"timeout": (circularo_integration.connect_timeout or DEFAULT_CONNECT_TIMEOUT, circularo_integration.read_timeout or DEFAULT_READ_TIMEOUT),
+		"deadline": _get_deadline()
+	}
+	options.update(getattr(frappe.local, "circularo_request_options", None) or {})
+
+	if "breaker" not in options:
+		options["breaker"] = get_circuit_breaker(circularo_integration)
+
+	return options
+
+
+@contextmanager
+def _override_request_options(**options):
+	"""
+	Override options of REST calls made in this thread (e.g. breaker=None, notify_listeners=False for calls of local stand-in)
+
+	:return:
+	"""
+	previous = getattr(frappe.local, "circularo_request_options", None)
+	frappe.local.circularo_request_options = dict(previous or {}, **options)
+	try:
+		yield
+	finally:
+		frappe.local.circularo_request_options = previous
 
 
 def _print_to_pdf(doctype, docname):
@@ -592,14 +1286,157 @@ def _print_to_pdf(doctype, docname):
 	:type doctype: str
 	:param docname: Frappe DocName
 	:type docname: str
-	:return: PDF file bytes and number of pages
+	:return: PDF file (spooled to disk if big) and number of pages
 	"""
+	cache_key = _get_print_cache_key(doctype, docname)
+	cached = _get_cached_print(doctype, docname, cache_key)
+	if cached is not None:
+		return cached
+
 	html = frappe.get_print(doctype, docname)
 
-	pdf_bytes = get_pdf(html)
-	reader = PdfFileReader(io.BytesIO(pdf_bytes))
+	pdf_bytes, num_pages = _finish_print(get_pdf(html), cache_key)
+	return spool_pdf(pdf_bytes), num_pages
+
+
+def _print_batch_to_pdf(doctype, docnames):
+	"""
+	Print many Frappe documents of one DocType to PDF in one run of the PDF engine
+	Documents found in rendered PDF cache are not rendered again; if the batch cannot be split back, documents are printed one by one
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docnames: Frappe DocNames
+	:type docnames: list
+	:return: List of (docname, PDF file, number of pages, error message) tuples
+	"""
+	results = {}
+	pending = []
+	for docname in docnames:
+		try:
+			cache_key = _get_print_cache_key(doctype, docname)
+			cached = _get_cached_print(doctype, docname, cache_key)
+			if cached is not None:
+				results[docname] = (docname, cached[0], cached[1], None)
+			else:
+				pending.append((docname, cache_key, frappe.get_print(doctype, docname)))
+		except Exception as e:
+			results[docname] = (docname, None, None, str(e))
+
+	rendered = None
+	if len(pending) > 1:
+		try:
+			rendered = render_batch_pdf([html for docname, cache_key, html in pending], get_pdf)
+		except Exception:
+			rendered = None
+
+	for index, (docname, cache_key, html) in enumerate(pending):
+		try:
+			# Rendered HTML is reused when the batch cannot be split
+			pdf_bytes, num_pages = _finish_print(rendered[index] if rendered else get_pdf(html), cache_key)
+			results[docname] = (docname, spool_pdf(pdf_bytes), num_pages, None)
+		except Exception as e:
+			results[docname] = (docname, None, None, str(e))
+
+	return [results.get(docname) for docname in docnames]
+
+
+def _get_print_cache_key(doctype, docname):
+	"""
+	Get rendered PDF cache key of Frappe document
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:return: Cache key or None if cache is disabled
+	"""
+	circularo_integration = get_settings()
+	if not circularo_integration.pdf_cache_size:
+		return None
+
+	# Optimized files are cached separately
+	variant = ("optimized-" + str(_get_image_resolution(circularo_integration))) if circularo_integration.optimize_pdf else None
+	return get_cache_key(doctype, docname, variant)
+
+
+def _get_cached_print(doctype, docname, cache_key):
+	"""
+	Get Frappe document print from rendered PDF cache
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param cache_key: Cache key (None if cache is disabled)
+	:type cache_key: str | None
+	:return: PDF file and number of pages or None if not cached
+	"""
+	if not cache_key:
+		return None
+
+	cached = get_cached_pdf(cache_key)
+	if cached is not None:
+		# Rendering would check print permission
+		if not frappe.has_permission(doctype, "print", docname):
+			cached[0].close()
+			raise frappe.PermissionError
+
+	return cached
+
+
+def _finish_print(pdf_bytes, cache_key):
+	"""
+	Optimize rendered PDF file (if enabled) and store it into rendered PDF cache
+
+	:param pdf_bytes: Rendered PDF file bytes
+	:type pdf_bytes: bytes
+	:param cache_key: Cache key (None if cache is disabled)
+	:type cache_key: str | None
+	:return: PDF file bytes and number of pages
+	"""
+	circularo_integration = get_settings()
+	if circularo_integration.optimize_pdf:
+		pdf_bytes = _optimize_pdf(pdf_bytes, _get_image_resolution(circularo_integration))
+	num_pages = get_page_count(pdf_bytes)
+
+	if cache_key:
+		put_pdf(cache_key, pdf_bytes, num_pages, circularo_integration.pdf_cache_size * 1024 * 1024)
+
+	return pdf_bytes, num_pages
+
+
+def _get_image_resolution(circularo_integration):
+	"""
+	Get maximal resolution of images in optimized PDF files
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:return: Resolution (DPI)
+	"""
+	return circularo_integration.pdf_image_resolution or DEFAULT_IMAGE_RESOLUTION
+
+
+def _optimize_pdf(pdf_bytes, image_resolution):
+	"""
+	Optimize rendered PDF file and record its size before and after
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param image_resolution: Maximal resolution of images (DPI)
+	:type image_resolution: int
+	:return: PDF file bytes
+	"""
+	start = time.time()
+	optimized_bytes = optimize_pdf(pdf_bytes, image_resolution)
+
+	try:
+		record_pdf_optimization(len(pdf_bytes), len(optimized_bytes), time.time() - start)
+	except Exception:
+		# Metrics must not stop sending
+		pass
 
-	return pdf_bytes, reader.getNumPages()
+	return optimized_bytes
 
 
 def _check_ping(url):
@@ -612,7 +1449,7 @@ def _check_ping(url):
 	"""
 	ping_url = create_circularo_url(url, "ping")
 	try:
-		call_rest_api("get", ping_url)
+		call_rest_api("get", ping_url, timeout=SETUP_TIMEOUT)
 	except:
 		frappe.throw("No ping response from server '" + url + "'!")
 
@@ -629,7 +1466,7 @@ def _check_tenant(url, tenant):
 	"""
 	tenant_url = create_circularo_url(url, "settings", {"tenant": tenant})
 	try:
-		call_rest_api("get", tenant_url)
+		call_rest_api("get", tenant_url, timeout=SETUP_TIMEOUT)
 	except:
 		frappe.throw("Incorrect tenant '" + tenant + "'!")
 
@@ -656,7 +1493,7 @@ def _login_to_circularo(url, tenant, email, password):
 	}
 
 	try:
-		r = call_rest_api("post", login_url, json)
+		r = call_rest_api("post", login_url, json, timeout=SETUP_TIMEOUT)
 		return r
 	except:
 		frappe.throw("Incorrect e-mail or password!")
@@ -675,7 +1512,7 @@ def _create_api_token(url, token):
 	api_key_url = create_circularo_url(url, "api/key", {"token": token})
 
 	try:
-		r = call_rest_api("post", api_key_url)
+		r = call_rest_api("post", api_key_url, timeout=SETUP_TIMEOUT)
 		return r.get("id")
 	except:
 		frappe.throw("Unable to create API key!")
@@ -693,6 +1530,6 @@ def _logout_user(url, token):
 	"""
 	try:
 		logout_url = create_circularo_url(url, "logout", {"token": token})
-		call_rest_api("get", logout_url)
+		call_rest_api("get", logout_url, timeout=SETUP_TIMEOUT)
 	except:
 		pass
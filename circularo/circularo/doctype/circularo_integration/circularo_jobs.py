@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import frappe
+from frappe.utils import now_datetime
+from circularo.circularo.doctype.circularo_integration.circularo_progress import ProgressReporter, get_stages, report, STAGE_RENDERED
+from circularo.circularo.doctype.circularo_integration.circularo_render import render_documents
+
+# Default count of documents processed in parallel by one bulk job
+DEFAULT_BULK_CONCURRENCY = 4
+
+# Pending manual sign reconciliation
+RECONCILE_PAGE_SIZE = 100
+RECONCILE_MAX_ROWS = 2000
+RECONCILE_CURSOR_KEY = "circularo_reconcile_cursor"
+RECONCILE_STATS_KEY = "circularo_reconcile_stats"
+# Delay of next check of unsigned document, doubled with every attempt (seconds)
+RECONCILE_BASE_DELAY = 10 * 60
+RECONCILE_MAX_DELAY = 24 * 60 * 60
+
+# History retention (days, 0 to keep all history in Circularo Documents)
+DEFAULT_HISTORY_RETENTION_DAYS = 0
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVE_MAX_ROWS = 100000
+
+# Columns moved into Circularo Documents Archive (URLs are computed on read there)
+ARCHIVE_COLUMNS = ["name", "creation", "modified", "modified_by", "owner", "docstatus", "idx", "target_doctype", "target_docname",
+	"action", "author", "date", "is_sign", "is_autosign", "is_signed", "is_downloaded", "file_url", "target_document_id", "page_ranges"]
+
+
+def bulk_send_job(job_id, doctype, docnames, action, user, combined=0):
+	"""
+	Background job sending many Frappe documents to Circularo
+
+	:param job_id: Circularo job ID
+	:type job_id: str
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docnames: Frappe DocNames
+	:type docnames: list
+	:param action: Circularo action
+	:type action: int
+	:param user: User who started the job
+	:type user: str
+	:param combined: 1 to send all documents as one combined Circularo document
+	:type combined: int
+	:return: Summary of the job
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import _get_action_flags, get_settings
+
+	circularo_integration = get_settings()
+	concurrency = circularo_integration.bulk_send_concurrency or DEFAULT_BULK_CONCURRENCY
+	render_pool_size = circularo_integration.render_pool_size or 0
+	render_batch_size = circularo_integration.render_batch_size or 1
+
+	progress = ProgressReporter(job_id, user, len(docnames), get_stages(*_get_action_flags(action)))
+	progress.start()
+
+	def send(docname, rendered=None):
+		return run_in_site_context(site, sites_path, user, _send_and_report, progress, doctype, docname, action, rendered)
+
+	def send_rendered(docname, path, num_pages):
+		try:
+			return send(docname, (open(path, "rb"), num_pages))
+		finally:
+			os.remove(path)
+
+	site = frappe.local.site
+	sites_path = frappe.local.sites_path
+	results = {}
+	if combined:
+		results = _send_combined(doctype, docnames, action, render_pool_size, render_batch_size, progress)
+
+	else:
+		with ThreadPoolExecutor(max_workers=min(concurrency, len(docnames))) as executor:
+			if (render_pool_size >= 1) or (render_batch_size > 1):
+				# Render in process pool (or in this process), upload as soon as each document (batch) is rendered
+				futures = {}
+				for docname, path, num_pages, error in render_documents(doctype, docnames, render_pool_size, render_batch_size):
+					if error is None:
+						progress.advance(STAGE_RENDERED)
+						futures[docname] = executor.submit(send_rendered, docname, path, num_pages)
+					else:
+						results[docname] = (1, error)
+						progress.complete(False)
+
+				for docname, future in futures.items():
+					results[docname] = future.result()
+
+			else:
+				# Render in sending threads
+				results = dict(zip(docnames, executor.map(send, docnames)))
+
+	documents = []
+	for docname in docnames:
+		status, message = results.get(docname)
+		documents.append({
+			"docname": docname,
+			"status": status,
+			"message": message
+		})
+
+	summary = {
+		"job_id": job_id,
+		"doctype": doctype,
+		"action": action,
+		"combined": combined,
+		"total": len(documents),
+		"succeeded": len([document for document in documents if document.get("status") == 0]),
+		"failed": len([document for document in documents if document.get("status") != 0]),
+		"documents": documents
+	}
+
+	progress.finish()
+	frappe.publish_realtime("circularo_bulk_send", summary, user=user)
+	return summary
+
+
+def _send_and_report(progress, doctype, docname, action, rendered=None):
+	"""
+	Send Frappe document to Circularo and record the outcome in job progress (in worker thread)
+
+	:param progress: Job progress
+	:type progress: ProgressReporter
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param action: Circularo action
+	:type action: int
+	:param rendered: Optional already rendered PDF file and number of pages
+	:type rendered: tuple | None
+	:return: Circularo document info
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import _send_document
+
+	try:
+		message = _send_document(doctype, docname, action, rendered, progress)
+	except Exception:
+		progress.complete(False)
+		raise
+
+	progress.complete(True)
+	return message
+
+
+def _send_combined(doctype, docnames, action, render_pool_size, render_batch_size=1, progress=None):
+	"""
+	Render documents and send them to Circularo as one combined document
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docnames: Frappe DocNames
+	:type docnames: list
+	:param action: Circularo action
+	:type action: int
+	:param render_pool_size: Count of rendering processes, 0 to render in this process
+	:type render_pool_size: int
+	:param render_batch_size: Count of documents rendered in one run of the PDF engine
+	:type render_batch_size: int
+	:param progress: Optional job progress
+	:type progress: ProgressReporter | None
+	:return: Status and message per DocName
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import _send_combined_document
+
+	results = {}
+	rendered = {}
+	try:
+		for docname, path, num_pages, error in render_documents(doctype, docnames, render_pool_size, render_batch_size):
+			if error is None:
+				rendered[docname] = (path, num_pages)
+				report(progress, STAGE_RENDERED)
+			else:
+				results[docname] = (1, error)
+				if progress is not None:
+					progress.complete(False)
+
+		# Keep order of selected documents
+		parts = [(docname,) + rendered.get(docname) for docname in docnames if docname in rendered]
+		if parts:
+			try:
+				message = _send_combined_document(doctype, parts, action, progress)
+				frappe.db.commit()
+				if progress is not None:
+					progress.complete(True, len(parts))
+
+				document_message = dict((key, value) for key, value in message.items() if key != "page_ranges")
+				for page_range in message.get("page_ranges"):
+					results[page_range.get("name")] = (0, dict(document_message, pages=[page_range.get("from"), page_range.get("to")]))
+			except Exception as e:
+				frappe.db.rollback()
+				for docname, path, num_pages in parts:
+					results[docname] = (1, str(e))
+				if progress is not None:
+					progress.complete(False, len(parts))
+
+	finally:
+		for path, num_pages in rendered.values():
+			os.remove(path)
+
+	return results
+
+
+def download_signed_document(history_name):
+	"""
+	Background job downloading signed file of given history record (queued by signature webhook)
+
+	:param history_name: Circularo documents (history) record DocName
+	:type history_name: str
+	:return:
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import _download_history_file
+
+	history_record = frappe.get_doc("Circularo Documents", history_name)
+	if history_record.is_downloaded:
+		return
+
+	frappe.set_user(history_record.author)
+	_download_history_file(history_record, 1)
+
+
+def reconcile_pending_documents():
+	"""
+	Scheduled job downloading manually signed documents
+	Pending rows are checked in pages with bounded concurrency, unsigned rows are checked again after growing delay
+	Cursor is kept between runs, so every run continues where the previous one stopped
+
+	:return: Statistics of the run
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import _get_document_details, get_settings
+
+	circularo_integration = get_settings()
+	if (circularo_integration.enabled != 1) or (not circularo_integration.circularo_api_token):
+		return
+
+	concurrency = circularo_integration.bulk_send_concurrency or DEFAULT_BULK_CONCURRENCY
+	start = time.time()
+	now = now_datetime()
+	cursor = frappe.cache().get_value(RECONCILE_CURSOR_KEY) or ""
+	checked = signed = failed = 0
+
+	def get_details(row):
+		try:
+			return 0, _get_document_details(row.target_document_id, circularo_integration)
+		except Exception as e:
+			return 1, str(e)
+
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		while checked < RECONCILE_MAX_ROWS:
+			rows = frappe.db.sql("""
+				select name, target_document_id, check_attempts
+				from `tabCircularo Documents`
+				where is_sign = 1 and is_autosign = 0 and is_downloaded = 0
+					and (next_check is null or next_check <= %(now)s)
+					and name > %(cursor)s
+				order by name
+				limit %(limit)s""", {"now": now, "cursor": cursor, "limit": RECONCILE_PAGE_SIZE}, as_dict=True)
+
+			if not rows:
+				# Whole table checked, start from the beginning next time
+				cursor = ""
+				break
+			cursor = rows[-1].name
+
+			for row, (status, details) in zip(rows, executor.map(get_details, rows)):
+				checked += 1
+
+				if (status == 0) and details.get("isSigned"):
+					signed += 1
+					frappe.db.set_value("Circularo Documents", row.name, {
+						"is_signed": 1,
+						"next_check": None
+					}, update_modified=False)
+					frappe.enqueue(
+						"circularo.circularo.doctype.circularo_integration.circularo_jobs.download_signed_document",
+						queue="short",
+						enqueue_after_commit=True,
+						history_name=row.name)
+
+				else:
+					if status != 0:
+						failed += 1
+
+					# Not signed yet -> check again later
+					attempts = (row.check_attempts or 0) + 1
+					delay = min(RECONCILE_MAX_DELAY, RECONCILE_BASE_DELAY * (2 ** (attempts - 1))) * random.uniform(0.8, 1.2)
+					frappe.db.set_value("Circularo Documents", row.name, {
+						"check_attempts": attempts,
+						"next_check": now + timedelta(seconds=delay)
+					}, update_modified=False)
+
+			frappe.db.commit()
+
+	frappe.cache().set_value(RECONCILE_CURSOR_KEY, cursor)
+
+	duration = time.time() - start
+	stats = {
+		"checked": checked,
+		"signed": signed,
+		"failed": failed,
+		"duration": round(duration, 3),
+		"rows_per_second": round(checked / duration, 1) if duration > 0 else None
+	}
+	frappe.cache().set_value(RECONCILE_STATS_KEY, stats)
+	frappe.logger("circularo").info("Pending documents reconciled: {0}".format(stats))
+
+	return stats
+
+
+def send_email_digests():
+	"""
+	Scheduled job sending e-mail digests of automatically signed documents
+	Documents of one user are sent together once the oldest of them waited for the digest window
+
+	:return: Count of sent digests
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import get_settings
+	from circularo.circularo.doctype.circularo_integration.circularo_email import send_digest, discard_pending_emails, \
+		DEFAULT_EMAIL_DIGEST_WINDOW, EMAIL_PENDING
+
+	circularo_integration = get_settings()
+	if circularo_integration.send_to_email != 1:
+		# E-mails were turned off, documents waiting for a digest are not e-mailed anymore
+		discard_pending_emails()
+		frappe.db.commit()
+		return 0
+
+	if circularo_integration.enabled != 1:
+		return 0
+
+	# Pending documents are sent at once when digest was turned off
+	window = (circularo_integration.email_digest_window or DEFAULT_EMAIL_DIGEST_WINDOW) if circularo_integration.email_digest else 0
+	authors = frappe.db.sql_list("""
+		select author
+		from `tabCircularo Documents`
+		where email_status = %(pending)s
+		group by author
+		having min(email_pending_since) <= %(since)s""", {"pending": EMAIL_PENDING, "since": now_datetime() - timedelta(minutes=window)})
+
+	sent = 0
+	for author in authors:
+		try:
+			send_digest(author)
+			frappe.db.commit()
+			sent += 1
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(frappe.get_traceback(), "Circularo e-mail digest failed")
+
+	return sent
+
+
+def archive_old_documents():
+	"""
+	Scheduled job moving history older than retention period into Circularo Documents Archive
+	Rows still waiting for signature, download or e-mail are kept
+	Version and Comment rows (timeline) of moved rows are deleted, archive keeps no change history
+	Files stay attached to the moved rows, so stored files are kept as long as the history is
+
+	:return: Count of archived rows
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import get_settings
+	from circularo.circularo.doctype.circularo_integration.circularo_email import EMAIL_PENDING
+
+	retention_days = get_settings().history_retention_days or DEFAULT_HISTORY_RETENTION_DAYS
+	if retention_days <= 0:
+		return 0
+
+	cutoff = now_datetime() - timedelta(days=retention_days)
+	archived = 0
+
+	while archived < ARCHIVE_MAX_ROWS:
+		names = frappe.db.sql_list("""
+			select name
+			from `tabCircularo Documents`
+			where date < %(cutoff)s
+				and (is_sign = 0 or is_autosign = 1 or is_downloaded = 1)
+				and ifnull(email_status, '') != %(pending)s
+			order by date
+			limit %(limit)s""", {"cutoff": cutoff, "pending": EMAIL_PENDING, "limit": ARCHIVE_BATCH_SIZE})
+		if not names:
+			break
+
+		# Move whole batch by a few statements, rows are never loaded into Python
+		columns = ", ".join("`" + column + "`" for column in ARCHIVE_COLUMNS)
+		frappe.db.sql("""
+			insert into `tabCircularo Documents Archive` ({columns}, `archived_on`)
+			select {columns}, %(now)s
+			from `tabCircularo Documents`
+			where name in %(names)s""".format(columns=columns), {"now": now_datetime(), "names": names})
+		frappe.db.sql("""
+			delete from `tabCircularo Documents`
+			where name in %(names)s""", {"names": names})
+		frappe.db.sql("""
+			update `tabFile`
+			set attached_to_doctype = 'Circularo Documents Archive'
+			where attached_to_doctype = 'Circularo Documents' and attached_to_name in %(names)s""", {"names": names})
+		frappe.db.sql("""
+			delete from `tabVersion`
+			where ref_doctype = 'Circularo Documents' and docname in %(names)s""", {"names": names})
+		frappe.db.sql("""
+			delete from `tabComment`
+			where reference_doctype = 'Circularo Documents' and reference_name in %(names)s""", {"names": names})
+		frappe.db.commit()
+
+		archived += len(names)
+
+	frappe.logger("circularo").info("Circularo history archived: {0} rows".format(archived))
+
+	return archived
+
+
+def run_in_site_context(site, sites_path, user, function, *args, **kwargs):
+	"""
+	Run function in its own Frappe context (for worker threads)
+	Changes are committed on success and rolled back on failure
+
+	:param site: Frappe site
+	:type site: str
+	:param sites_path: Frappe sites path
+	:type sites_path: str
+	:param user: User to run the function as
+	:type user: str
+	:param function: Function to be run
+	:type function: callable
+	:return: Status (0 on success, 1 on failure) and function result or error message
+	"""
+	frappe.init(site=site, sites_path=sites_path)
+	try:
+		frappe.connect()
+		frappe.set_user(user)
+
+		result = function(*args, **kwargs)
+		frappe.db.commit()
+		return 0, result
+
+	except Exception as e:
+		if frappe.db:
+			frappe.db.rollback()
+		return 1, str(e)
+
+	finally:
+		frappe.destroy()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+Latency and error metrics of Circularo REST calls
+Metrics are kept in Redis, so they are shared by all workers
+"""
+
+from __future__ import unicode_literals
+import frappe
+from werkzeug.wrappers import Response
+
+# Redis keys, prefixed with site by _make_key
+METRICS_KEY_PREFIX = "circularo_metrics|"
+ENDPOINTS_KEY = "circularo_metrics_endpoints"
+PDF_OPTIMIZATION_KEY = "circularo_metrics_pdf_optimization"
+
+# Upper bounds of latency histogram buckets (seconds)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def record_request(method, endpoint, duration, status_code, bytes_sent, bytes_received):
+	"""
+	Record performed request (request listener of call_rest_api)
+
+	:param method: Request method
+	:type method: str
+	:param endpoint: Endpoint template
+	:type endpoint: str
+	:param duration: Request duration (seconds)
+	:type duration: float
+	:param status_code: Response status code, None on connection error
+	:type status_code: int | None
+	:param bytes_sent: Count of sent bytes
+	:type bytes_sent: int
+	:param bytes_received: Count of received bytes
+	:type bytes_received: int
+	:return:
+	"""
+	label = method + "|" + endpoint
+	key = _make_key(METRICS_KEY_PREFIX + label)
+
+	pipeline = frappe.cache().pipeline()
+	pipeline.sadd(_make_key(ENDPOINTS_KEY), label)
+	pipeline.hincrby(key, "count", 1)
+	pipeline.hincrbyfloat(key, "duration_sum", duration)
+	pipeline.hincrby(key, "bytes_sent", bytes_sent)
+	pipeline.hincrby(key, "bytes_received", bytes_received)
+	pipeline.hincrby(key, "status_" + (str(status_code) if status_code else "none"), 1)
+	if (status_code is None) or (status_code >= 400):
+		pipeline.hincrby(key, "errors", 1)
+	for bucket in LATENCY_BUCKETS:
+		if duration <= bucket:
+			pipeline.hincrby(key, "le_" + str(bucket), 1)
+	pipeline.execute()
+
+
+def record_pdf_optimization(bytes_before, bytes_after, duration):
+	"""
+	Record optimized PDF file
+
+	:param bytes_before: Size of rendered PDF file
+	:type bytes_before: int
+	:param bytes_after: Size of optimized PDF file
+	:type bytes_after: int
+	:param duration: Optimization duration (seconds)
+	:type duration: float
+	:return:
+	"""
+	key = _make_key(PDF_OPTIMIZATION_KEY)
+
+	pipeline = frappe.cache().pipeline()
+	pipeline.hincrby(key, "count", 1)
+	pipeline.hincrby(key, "bytes_before", bytes_before)
+	pipeline.hincrby(key, "bytes_after", bytes_after)
+	pipeline.hincrbyfloat(key, "duration_sum", duration)
+	pipeline.execute()
+
+
+def get_pdf_optimization_metrics():
+	"""
+	Get recorded metrics of PDF optimization
+
+	:return: Count of optimized files, their total size before and after optimization and total duration
+	"""
+	pipeline = frappe.cache().pipeline()
+	pipeline.hgetall(_make_key(PDF_OPTIMIZATION_KEY))
+	values = dict((frappe.safe_decode(field), frappe.safe_decode(value)) for field, value in pipeline.execute()[0].items())
+
+	return {
+		"count": int(values.get("count", 0)),
+		"bytes_before": int(values.get("bytes_before", 0)),
+		"bytes_after": int(values.get("bytes_after", 0)),
+		"duration_sum": float(values.get("duration_sum", 0))
+	}
+
+
+def get_metrics():
+	"""
+	Get recorded metrics
+
+	:return: Metrics per endpoint
+	"""
+	# Pipelines work with raw keys and values, same as record_request
+	pipeline = frappe.cache().pipeline()
+	pipeline.smembers(_make_key(ENDPOINTS_KEY))
+	labels = sorted(frappe.safe_decode(label) for label in pipeline.execute()[0])
+
+	for label in labels:
+		pipeline.hgetall(_make_key(METRICS_KEY_PREFIX + label))
+	all_values = pipeline.execute() if labels else []
+
+	metrics = []
+	for label, raw_values in zip(labels, all_values):
+		values = dict((frappe.safe_decode(field), frappe.safe_decode(value)) for field, value in raw_values.items())
+		method, endpoint = label.split("|", 1)
+
+		metrics.append({
+			"method": method,
+			"endpoint": endpoint,
+			"count": int(values.get("count", 0)),
+			"errors": int(values.get("errors", 0)),
+			"duration_sum": float(values.get("duration_sum", 0)),
+			"bytes_sent": int(values.get("bytes_sent", 0)),
+			"bytes_received": int(values.get("bytes_received", 0)),
+			"status": dict((field[len("status_"):], int(value)) for field, value in values.items() if field.startswith("status_")),
+			"buckets": [(bucket, int(values.get("le_" + str(bucket), 0))) for bucket in LATENCY_BUCKETS]
+		})
+
+	return metrics
+
+
+def reset_metrics():
+	"""
+	Delete all recorded metrics
+
+	:return:
+	"""
+	pipeline = frappe.cache().pipeline()
+	pipeline.smembers(_make_key(ENDPOINTS_KEY))
+	labels = pipeline.execute()[0]
+
+	for label in labels:
+		pipeline.delete(_make_key(METRICS_KEY_PREFIX + frappe.safe_decode(label)))
+	pipeline.delete(_make_key(ENDPOINTS_KEY), _make_key(PDF_OPTIMIZATION_KEY))
+	pipeline.execute()
+
+
+def _make_key(key):
+	"""
+	Prefix Redis key with site, pipelines work with raw keys
+
+	:param key: Key
+	:type key: str
+	:return: Site specific key
+	"""
+	return frappe.cache().make_key(key)
+
+
+@frappe.whitelist()
+def get_request_metrics():
+	"""
+	Get metrics of Circularo REST calls
+
+	:return:
+	"""
+	frappe.only_for("System Manager")
+
+	return {
+		"status": 0,
+		"message": get_metrics(),
+		"pdf_optimization": get_pdf_optimization_metrics()
+	}
+
+
+@frappe.whitelist()
+def prometheus_metrics():
+	"""
+	Get metrics of Circularo REST calls in Prometheus text format
+
+	:return: Plain text response
+	"""
+	frappe.only_for("System Manager")
+
+	lines = [
+		"# HELP circularo_request_duration_seconds Latency of Circularo REST calls.",
+		"# TYPE circularo_request_duration_seconds histogram"
+	]
+	metrics = get_metrics()
+	for metric in metrics:
+		labels = _format_labels(metric)
+		for bucket, count in metric.get("buckets"):
+			lines.append("circularo_request_duration_seconds_bucket{" + labels + ",le=\"" + str(bucket) + "\"} " + str(count))
+		lines.append("circularo_request_duration_seconds_bucket{" + labels + ",le=\"+Inf\"} " + str(metric.get("count")))
+		lines.append("circularo_request_duration_seconds_sum{" + labels + "} " + repr(metric.get("duration_sum")))
+		lines.append("circularo_request_duration_seconds_count{" + labels + "} " + str(metric.get("count")))
+
+	counters = [
+		("circularo_request_errors_total", "Failed Circularo REST calls (connection errors and 4xx/5xx responses).", "errors"),
+		("circularo_request_sent_bytes_total", "Bytes sent to Circularo.", "bytes_sent"),
+		("circularo_request_received_bytes_total", "Bytes received from Circularo.", "bytes_received")
+	]
+	for name, description, field in counters:
+		lines.append("# HELP " + name + " " + description)
+		lines.append("# TYPE " + name + " counter")
+		for metric in metrics:
+			lines.append(name + "{" + _format_labels(metric) + "} " + str(metric.get(field)))
+
+	lines.append("# HELP circularo_responses_total Circularo responses by status code.")
+	lines.append("# TYPE circularo_responses_total counter")
+	for metric in metrics:
+		for status, count in sorted(metric.get("status").items()):
+			lines.append("circularo_responses_total{" + _format_labels(metric) + ",status=\"" + status + "\"} " + str(count))
+
+	pdf_optimization = get_pdf_optimization_metrics()
+	lines.extend([
+		"# HELP circularo_pdf_optimized_total Rendered PDF files passed through the optimization stage.",
+		"# TYPE circularo_pdf_optimized_total counter",
+		"circularo_pdf_optimized_total " + str(pdf_optimization.get("count")),
+		"# HELP circularo_pdf_optimized_bytes_total Size of optimized PDF files before and after optimization.",
+		"# TYPE circularo_pdf_optimized_bytes_total counter",
+		"circularo_pdf_optimized_bytes_total{stage=\"before\"} " + str(pdf_optimization.get("bytes_before")),
+		"circularo_pdf_optimized_bytes_total{stage=\"after\"} " + str(pdf_optimization.get("bytes_after")),
+		"# HELP circularo_pdf_optimization_seconds_total Time spent optimizing PDF files.",
+		"# TYPE circularo_pdf_optimization_seconds_total counter",
+		"circularo_pdf_optimization_seconds_total " + repr(pdf_optimization.get("duration_sum"))
+	])
+
+	return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+def _format_labels(metric):
+	"""
+	Format Prometheus labels of metric
+
+	:param metric: Endpoint metric
+	:type metric: dict
+	:return: Labels
+	"""
+	return "method=\"" + metric.get("method") + "\",endpoint=\"" + metric.get("endpoint") + "\""
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import io
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import uuid
+from PyPDF2 import PdfFileMerger, PdfFileReader, PdfFileWriter
+from PyPDF2.generic import Destination
+
+try:
+	from shutil import which
+except ImportError:
+	from distutils.spawn import find_executable as which
+
+# Rendered PDF files bigger than this are kept on disk (bytes)
+PDF_SPOOL_THRESHOLD = 1024 * 1024
+
+# Default resolution of images in optimized PDF files (DPI)
+DEFAULT_IMAGE_RESOLUTION = 150
+
+# Ghostscript executable used by optimize_pdf (optional)
+GHOSTSCRIPT_EXECUTABLE = "gs"
+
+# Maximal duration of Ghostscript run (seconds)
+GHOSTSCRIPT_TIMEOUT = 120
+
+# Prefix of outline headings marking start of every document in batched rendering
+BATCH_MARKER_PREFIX = "circularo-batch-"
+
+# wkhtmltopdf options of batched rendering, only top level headings get into the outline
+BATCH_RENDER_OPTIONS = {
+	"outline": None,
+	"outline-depth": 1
+}
+
+# Marker heading must get into the outline but must not be visible nor take any space
+_BATCH_MARKER_HTML = "<h1 style=\"height: 0; margin: 0; padding: 0; border: 0; overflow: hidden; font-size: 1px; line-height: 0;\">{0}</h1>"
+
+_BODY_RE = re.compile(r"<body[^>]*>(.*)</body>", re.DOTALL | re.IGNORECASE)
+_HEADER_FOOTER_RE = re.compile(r"id=[\"']?(header|footer)-html", re.IGNORECASE)
+_ROOT_RE = re.compile(br"/Root\s+(\d+)\s+(\d+)\s+R")
+_PAGES_RE = re.compile(br"/Pages\s+(\d+)\s+(\d+)\s+R")
+_COUNT_RE = re.compile(br"/Count\s+(\d+)(\s+\d+\s+R)?")
+
+
+def spool_pdf(pdf_bytes, max_size=PDF_SPOOL_THRESHOLD):
+	"""
+	Move PDF bytes into temporary file, which is kept in memory only up to given size
+	Bigger files are written straight to disk, so they are not copied in memory once more
+	Rendering, optimization and page count work with bytes, so this bounds memory of the upload only, not of rendering
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param max_size: Maximal size kept in memory
+	:type max_size: int
+	:return: Temporary file positioned at its beginning
+	"""
+	if len(pdf_bytes) > max_size:
+		pdf_file = tempfile.TemporaryFile()
+	else:
+		pdf_file = tempfile.SpooledTemporaryFile(max_size=max_size)
+	pdf_file.write(pdf_bytes)
+	pdf_file.seek(0)
+
+	return pdf_file
+
+
+def merge_pdfs(parts, max_size=PDF_SPOOL_THRESHOLD):
+	"""
+	Concatenate PDF files into one, every part starts with a bookmark of its name
+	Parts are read one by one, but the merged document is built in memory before it is written
+
+	:param parts: List of (name, PDF file path, number of pages) tuples
+	:type parts: list
+	:param max_size: Maximal size of merged file kept in memory
+	:type max_size: int
+	:return: Merged file (spooled temporary file positioned at its beginning) and page ranges of the parts
+	"""
+	merger = PdfFileMerger(strict=False)
+	page_ranges = []
+	first_page = 1
+
+	for name, path, num_pages in parts:
+		with open(path, "rb") as pdf_file:
+			# Content is copied, so the file can be closed right away
+			merger.append(pdf_file, bookmark=name, import_bookmarks=False)
+
+		page_ranges.append({
+			"name": name,
+			"from": first_page,
+			"to": first_page + num_pages - 1
+		})
+		first_page += num_pages
+
+	merged_file = tempfile.SpooledTemporaryFile(max_size=max_size)
+	merger.write(merged_file)
+	merger.close()
+	merged_file.seek(0)
+
+	return merged_file, page_ranges
+
+
+def optimize_pdf(pdf_bytes, image_resolution=DEFAULT_IMAGE_RESOLUTION):
+	"""
+	Make PDF file smaller
+	With Ghostscript installed images are downsampled, fonts are subset and compressed, duplicate images are merged
+	and all streams are recompressed; otherwise only page content streams are compressed by PyPDF2
+	Original bytes are returned if the optimized file is not smaller or optimization fails
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param image_resolution: Maximal resolution of images (DPI)
+	:type image_resolution: int
+	:return: PDF file bytes
+	"""
+	executable = which(GHOSTSCRIPT_EXECUTABLE)
+
+	try:
+		if executable:
+			optimized_bytes = _optimize_with_ghostscript(executable, pdf_bytes, image_resolution or DEFAULT_IMAGE_RESOLUTION)
+		else:
+			optimized_bytes = _compress_content_streams(pdf_bytes)
+	except Exception:
+		# Optimization is optional, never fail the upload because of it
+		return pdf_bytes
+
+	if (not optimized_bytes) or (len(optimized_bytes) >= len(pdf_bytes)):
+		return pdf_bytes
+
+	return optimized_bytes
+
+
+def _optimize_with_ghostscript(executable, pdf_bytes, image_resolution):
+	"""
+	Rewrite PDF file by Ghostscript pdfwrite device
+
+	:param executable: Ghostscript executable path
+	:type executable: str
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param image_resolution: Maximal resolution of images (DPI)
+	:type image_resolution: int
+	:return: PDF file bytes
+	"""
+	directory = tempfile.mkdtemp(prefix="circularo_pdf_")
+	try:
+		input_path = os.path.join(directory, "input.pdf")
+		output_path = os.path.join(directory, "output.pdf")
+		with open(input_path, "wb") as input_file:
+			input_file.write(pdf_bytes)
+
+		resolution = str(int(image_resolution))
+		subprocess.check_call([
+			executable, "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE",
+			"-sDEVICE=pdfwrite",
+			"-dCompatibilityLevel=1.5",
+			"-dDetectDuplicateImages=true",
+			"-dCompressFonts=true",
+			"-dSubsetFonts=true",
+			"-dDownsampleColorImages=true",
+			"-dDownsampleGrayImages=true",
+			"-dDownsampleMonoImages=true",
+			"-dColorImageResolution=" + resolution,
+			"-dGrayImageResolution=" + resolution,
+			"-dMonoImageResolution=" + str(int(image_resolution) * 2),
+			"-sOutputFile=" + output_path,
+			input_path
+		], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=GHOSTSCRIPT_TIMEOUT)
+
+		with open(output_path, "rb") as output_file:
+			return output_file.read()
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+
+def _compress_content_streams(pdf_bytes):
+	"""
+	Rewrite PDF file with compressed page content streams
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:return: PDF file bytes
+	"""
+	reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+	writer = PdfFileWriter()
+	for page in reader.pages:
+		if "/Contents" in page:
+			page.compressContentStreams()
+		writer.addPage(page)
+
+	output = io.BytesIO()
+	writer.write(output)
+	return output.getvalue()
+
+
+def render_batch_pdf(html_documents, render):
+	"""
+	Render many HTML documents in one run of the PDF engine and split the result back into one PDF file per document
+	Every document starts on a new page behind an invisible outline heading, the outline tells where documents start
+
+	:param html_documents: Complete HTML documents sharing the same styles (e.g. prints of one DocType)
+	:type html_documents: list
+	:param render: Function rendering HTML with given options to PDF bytes (e.g. frappe.utils.pdf.get_pdf)
+	:type render: function
+	:return: PDF file bytes per document or None if documents cannot be rendered together
+	"""
+	# Header and footer of the first document would be used for all pages and the others would be printed inline
+	if any(_HEADER_FOOTER_RE.search(html) for html in html_documents):
+		return None
+
+	marker = BATCH_MARKER_PREFIX + uuid.uuid4().hex + "-"
+	pdf_bytes = render(join_html_documents(html_documents, marker), dict(BATCH_RENDER_OPTIONS))
+
+	page_ranges = get_marker_page_ranges(pdf_bytes, marker, len(html_documents))
+	if page_ranges is None:
+		return None
+
+	return split_pdf(pdf_bytes, page_ranges)
+
+
+def join_html_documents(html_documents, marker):
+	"""
+	Join bodies of HTML documents into the first one, every document starts on a new page with a marker heading
+
+	:param html_documents: Complete HTML documents
+	:type html_documents: list
+	:param marker: Prefix of marker headings, document index is appended
+	:type marker: str
+	:return: HTML document
+	"""
+	bodies = []
+	for index, html in enumerate(html_documents):
+		body = _BODY_RE.search(html)
+		bodies.append("<div{0}>{1}{2}</div>".format(
+			" style=\"page-break-before: always;\"" if index else "",
+			_BATCH_MARKER_HTML.format(marker + str(index)),
+			body.group(1) if body else html))
+
+	first = _BODY_RE.search(html_documents[0])
+	if first is None:
+		return "".join(bodies)
+
+	return html_documents[0][:first.start(1)] + "".join(bodies) + html_documents[0][first.end(1):]
+
+
+def get_marker_page_ranges(pdf_bytes, marker, count):
+	"""
+	Get pages of documents from marker headings in PDF outline
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param marker: Prefix of marker headings
+	:type marker: str
+	:param count: Count of documents
+	:type count: int
+	:return: List of (first page, last page) tuples (zero based) or None if markers are missing or out of order
+	"""
+	reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+
+	first_pages = {}
+	outlines = list(reader.getOutlines())
+	while outlines:
+		outline = outlines.pop()
+		if isinstance(outline, list):
+			outlines.extend(outline)
+		elif isinstance(outline, Destination) and outline.title.strip().startswith(marker):
+			index = outline.title.strip()[len(marker):]
+			if (not index.isdigit()) or (int(index) in first_pages):
+				return None
+			first_pages[int(index)] = reader.getDestinationPageNumber(outline)
+
+	if sorted(first_pages) != list(range(count)):
+		return None
+
+	first_pages = [first_pages[index] for index in range(count)]
+	if (first_pages[0] != 0) or any(first_pages[index] >= first_pages[index + 1] for index in range(count - 1)):
+		return None
+
+	last_pages = [first_page - 1 for first_page in first_pages[1:]] + [reader.getNumPages() - 1]
+	return list(zip(first_pages, last_pages))
+
+
+def split_pdf(pdf_bytes, page_ranges):
+	"""
+	Split PDF file by page ranges
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param page_ranges: List of (first page, last page) tuples (zero based)
+	:type page_ranges: list
+	:return: PDF file bytes per page range
+	"""
+	reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+
+	parts = []
+	for first_page, last_page in page_ranges:
+		writer = PdfFileWriter()
+		for page_number in range(first_page, last_page + 1):
+			writer.addPage(reader.getPage(page_number))
+
+		output = io.BytesIO()
+		writer.write(output)
+		parts.append(output.getvalue())
+
+	return parts
+
+
+def get_page_count(pdf_bytes):
+	"""
+	Get number of PDF pages
+	Reads only page tree root, full PyPDF2 parse is used only if that is not possible
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:return: Number of pages
+	"""
+	num_pages = get_page_count_fast(pdf_bytes)
+	if num_pages is None:
+		num_pages = get_page_count_full(pdf_bytes)
+
+	return num_pages
+
+
+def get_page_count_fast(pdf_bytes):
+	"""
+	Get number of PDF pages from /Count of page tree root
+	Follows trailer /Root -> catalog /Pages -> /Count, works only for objects not stored in object streams
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:return: Number of pages or None if not found
+	"""
+	# Last trailer (or cross-reference stream) wins
+	root_position = pdf_bytes.rfind(b"/Root")
+	if root_position < 0:
+		return None
+	root = _ROOT_RE.match(pdf_bytes, root_position)
+	if root is None:
+		return None
+
+	catalog = _get_object(pdf_bytes, int(root.group(1)), int(root.group(2)))
+	if catalog is None:
+		return None
+	pages = _PAGES_RE.search(catalog)
+	if pages is None:
+		return None
+
+	page_tree = _get_object(pdf_bytes, int(pages.group(1)), int(pages.group(2)))
+	if page_tree is None:
+		return None
+	count = _COUNT_RE.search(page_tree)
+	if (count is None) or (count.group(2) is not None):
+		# Missing or indirect count
+		return None
+
+	return int(count.group(1))
+
+
+def get_page_count_full(pdf_bytes):
+	"""
+	Get number of PDF pages using full PyPDF2 parse
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:return: Number of pages
+	"""
+	reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+	return reader.getNumPages()
+
+
+def _get_object(pdf_bytes, number, generation):
+	"""
+	Get body of the last definition of indirect PDF object
+
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param number: Object number
+	:type number: int
+	:param generation: Object generation
+	:type generation: int
+	:return: Object body or None if not found
+	"""
+	header = ("%d %d obj" % (number, generation)).encode("ascii")
+
+	end = len(pdf_bytes)
+	while True:
+		start = pdf_bytes.rfind(header, 0, end)
+		if start < 0:
+			return None
+
+		# Object number must not be suffix of another number
+		if (start == 0) or (not pdf_bytes[start - 1:start].isdigit()):
+			body_start = start + len(header)
+			body_end = pdf_bytes.find(b"endobj", body_start)
+			if body_end < 0:
+				return None
+			return pdf_bytes[body_start:body_end]
+
+		end = start
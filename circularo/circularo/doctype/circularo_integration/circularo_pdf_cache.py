@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import glob
+import hashlib
+import os
+import tempfile
+import frappe
+
+# Default cache size (MB)
+DEFAULT_PDF_CACHE_SIZE = 100
+
+# Cache directory (in site private directory)
+CACHE_DIRECTORY = "circularo_pdf_cache"
+
+# Redis keys of cache counters
+HITS_KEY = "circularo_pdf_cache_hits"
+MISSES_KEY = "circularo_pdf_cache_misses"
+
+
+def get_cache_key(doctype, docname, variant=None):
+	"""
+	Get cache key of rendered document
+	Key changes whenever the document, its print format, default letter head or print settings change
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docname: Frappe DocName
+	:type docname: str
+	:param variant: Optional rendering variant (e.g. PDF optimization settings)
+	:type variant: str | None
+	:return: Cache key
+	"""
+	meta = frappe.get_meta(doctype)
+	if meta.issingle:
+		modified = frappe.db.get_value(doctype, None, "modified")
+	else:
+		modified = frappe.db.get_value(doctype, docname, "modified")
+
+	print_format = meta.default_print_format or "Standard"
+	print_format_modified = frappe.db.get_value("Print Format", print_format, "modified")
+	letter_head = frappe.db.get_value("Letter Head", {"is_default": 1}, ["name", "modified"])
+	print_settings_modified = frappe.db.get_value("Print Settings", None, "modified")
+
+	fingerprint = [doctype, docname, modified, print_format, print_format_modified, letter_head, print_settings_modified, frappe.local.lang]
+	if variant:
+		fingerprint.append(variant)
+	return hashlib.sha1("|".join(frappe.as_unicode(part) for part in fingerprint).encode("utf-8")).hexdigest()
+
+
+def get_cached_pdf(key):
+	"""
+	Get rendered PDF file from cache
+
+	:param key: Cache key
+	:type key: str
+	:return: Opened PDF file and number of pages or None if not cached
+	"""
+	for path in glob.glob(os.path.join(_get_cache_path(), key + "-*.pdf")):
+		try:
+			pdf_file = open(path, "rb")
+		except (IOError, OSError):
+			# Evicted meanwhile
+			continue
+
+		# Mark as recently used
+		os.utime(path, None)
+		_increment(HITS_KEY)
+
+		num_pages = int(os.path.basename(path)[len(key) + 1:-len(".pdf")])
+		return pdf_file, num_pages
+
+	_increment(MISSES_KEY)
+	return None
+
+
+def put_pdf(key, pdf_bytes, num_pages, max_size):
+	"""
+	Store rendered PDF file into cache and evict least recently used files over the size limit
+
+	:param key: Cache key
+	:type key: str
+	:param pdf_bytes: PDF file bytes
+	:type pdf_bytes: bytes
+	:param num_pages: Number of pages
+	:type num_pages: int
+	:param max_size: Maximal cache size (bytes)
+	:type max_size: int
+	:return:
+	"""
+	cache_path = _get_cache_path()
+	if not os.path.exists(cache_path):
+		frappe.create_folder(cache_path)
+
+	# Write atomically, concurrent readers never see partial file
+	temp_fd, temp_path = tempfile.mkstemp(suffix=".part", dir=cache_path)
+	with os.fdopen(temp_fd, "wb") as temp_file:
+		temp_file.write(pdf_bytes)
+	os.rename(temp_path, os.path.join(cache_path, key + "-" + str(num_pages) + ".pdf"))
+
+	evict(max_size)
+
+
+def evict(max_size):
+	"""
+	Delete least recently used cached files until cache fits into given size
+
+	:param max_size: Maximal cache size (bytes)
+	:type max_size: int
+	:return: Count of deleted files
+	"""
+	entries = []
+	total_size = 0
+	for path in glob.glob(os.path.join(_get_cache_path(), "*.pdf")):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			continue
+		entries.append((stat.st_mtime, stat.st_size, path))
+		total_size += stat.st_size
+
+	deleted = 0
+	for mtime, size, path in sorted(entries):
+		if total_size <= max_size:
+			break
+		try:
+			os.remove(path)
+			deleted += 1
+		except OSError:
+			pass
+		total_size -= size
+
+	return deleted
+
+
+def clear_cache():
+	"""
+	Delete all cached files
+
+	:return:
+	"""
+	evict(0)
+
+
+@frappe.whitelist()
+def get_cache_stats():
+	"""
+	Get statistics of rendered PDF cache
+
+	:return:
+	"""
+	frappe.only_for("System Manager")
+
+	paths = glob.glob(os.path.join(_get_cache_path(), "*.pdf"))
+	size = 0
+	for path in paths:
+		try:
+			size += os.path.getsize(path)
+		except OSError:
+			pass
+
+	return {
+		"status": 0,
+		"message": {
+			"hits": _get_counter(HITS_KEY),
+			"misses": _get_counter(MISSES_KEY),
+			"entries": len(paths),
+			"size": size
+		}
+	}
+
+
+def _get_cache_path():
+	"""
+	Get cache directory of current site
+
+	:return: Cache directory path
+	"""
+	return frappe.get_site_path("private", CACHE_DIRECTORY)
+
+
+def _increment(counter):
+	"""
+	Increment counter shared by all workers
+
+	:param counter: Counter key
+	:type counter: str
+	:return:
+	"""
+	cache = frappe.cache()
+	pipeline = cache.pipeline()
+	pipeline.incr(cache.make_key(counter))
+	pipeline.execute()
+
+
+def _get_counter(counter):
+	"""
+	Get value of counter shared by all workers
+
+	:param counter: Counter key
+	:type counter: str
+	:return: Counter value
+	"""
+	cache = frappe.cache()
+	pipeline = cache.pipeline()
+	pipeline.get(cache.make_key(counter))
+	return int(pipeline.execute()[0] or 0)
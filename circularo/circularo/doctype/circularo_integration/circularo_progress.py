@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+Progress of Circularo jobs, published to the user who started the job as realtime events
+Stage events are coalesced into one snapshot, which is published at most once per interval
+The last snapshot is kept in cache, so a client can attach to a running job at any time
+"""
+
+from __future__ import unicode_literals
+import threading
+import time
+import frappe
+
+# Minimal delay between two published snapshots of one job (seconds)
+DEFAULT_PROGRESS_INTERVAL = 1
+
+# Snapshots of finished jobs are kept for (seconds)
+PROGRESS_TTL = 24 * 60 * 60
+
+PROGRESS_KEY_PREFIX = "circularo_progress|"
+PROGRESS_EVENT = "circularo_progress"
+
+STAGE_RENDERED = "rendered"
+STAGE_UPLOADED = "uploaded"
+STAGE_CREATED = "created"
+STAGE_SIGNED = "signed"
+STAGE_DOWNLOADED = "downloaded"
+
+
+class ProgressReporter(object):
+	"""
+	Progress of one job, safe to use from many threads
+	Every thread must have its own Frappe site context
+	"""
+	def __init__(self, job_id, user, total, stages, interval=DEFAULT_PROGRESS_INTERVAL):
+		"""
+		:param job_id: Job ID
+		:type job_id: str
+		:param user: User who started the job
+		:type user: str
+		:param total: Count of documents
+		:type total: int
+		:param stages: Stages every document goes through
+		:type stages: list
+		:param interval: Minimal delay between two published snapshots (seconds)
+		:type interval: float
+		"""
+		self.job_id = job_id
+		self.user = user
+		self.interval = interval
+
+		self._snapshot = {
+			"job_id": job_id,
+			"user": user,
+			"total": total,
+			"stages": stages,
+			"counts": dict((stage, 0) for stage in stages),
+			"succeeded": 0,
+			"failed": 0,
+			"finished": False
+		}
+		self._lock = threading.Lock()
+		self._published = 0
+
+	def start(self):
+		"""
+		Publish the initial snapshot right away
+
+		:return:
+		"""
+		with self._lock:
+			self._publish(force=True)
+
+	def advance(self, stage, count=1):
+		"""
+		Record documents which passed given stage
+
+		:param stage: Stage name
+		:type stage: str
+		:param count: Count of documents
+		:type count: int
+		:return:
+		"""
+		with self._lock:
+			if stage in self._snapshot["counts"]:
+				self._snapshot["counts"][stage] += count
+				self._publish()
+
+	def complete(self, succeeded, count=1):
+		"""
+		Record processed documents
+
+		:param succeeded: True if documents were sent successfully
+		:type succeeded: bool
+		:param count: Count of documents
+		:type count: int
+		:return:
+		"""
+		with self._lock:
+			self._snapshot["succeeded" if succeeded else "failed"] += count
+			self._publish()
+
+	def finish(self):
+		"""
+		Mark the job finished and publish the final snapshot right away
+
+		:return:
+		"""
+		with self._lock:
+			self._snapshot["finished"] = True
+			self._publish(force=True)
+
+	def _publish(self, force=False):
+		"""
+		Store and publish snapshot unless the last one was published recently
+		Called with the lock held, so snapshots are never published out of order
+
+		:param force: Publish regardless of interval
+		:type force: bool
+		:return:
+		"""
+		now = time.time()
+		if (not force) and (now - self._published < self.interval):
+			return
+		self._published = now
+
+		snapshot = dict(self._snapshot, counts=dict(self._snapshot["counts"]))
+		try:
+			frappe.cache().set_value(PROGRESS_KEY_PREFIX + self.job_id, snapshot, expires_in_sec=PROGRESS_TTL)
+			frappe.publish_realtime(PROGRESS_EVENT, snapshot, user=self.user)
+		except Exception:
+			# Progress must not stop the job
+			pass
+
+
+def get_stages(is_sign, is_autosign):
+	"""
+	Get stages every document of Circularo action goes through
+
+	:param is_sign: 1 if is sign action, 0 otherwise
+	:type is_sign: int
+	:param is_autosign: 1 if is autosign action, 0 otherwise
+	:type is_autosign: int
+	:return: Stage names
+	"""
+	stages = [STAGE_RENDERED, STAGE_UPLOADED, STAGE_CREATED]
+	if is_autosign == 1:
+		stages.append(STAGE_SIGNED)
+	if (is_sign == 0) or (is_autosign == 1):
+		stages.append(STAGE_DOWNLOADED)
+
+	return stages
+
+
+def report(progress, stage, count=1):
+	"""
+	Record stage of documents if progress is reported
+
+	:param progress: Progress reporter or None
+	:type progress: ProgressReporter | None
+	:param stage: Stage name
+	:type stage: str
+	:param count: Count of documents
+	:type count: int
+	:return:
+	"""
+	if progress is not None:
+		progress.advance(stage, count)
+
+
+@frappe.whitelist()
+def get_job_progress(job_id):
+	"""
+	Get the last progress snapshot of a job, further snapshots are published as "circularo_progress" realtime events
+
+	:param job_id: Job ID
+	:type job_id: str
+	:return: Progress snapshot or None if the job has not reported any progress yet
+	"""
+	snapshot = frappe.cache().get_value(PROGRESS_KEY_PREFIX + job_id)
+	if snapshot and (snapshot.get("user") != frappe.session.user) and ("System Manager" not in frappe.get_roles()):
+		return {
+			"status": 1,
+			"message": "Not permitted"
+		}
+
+	return {
+		"status": 0,
+		"message": snapshot
+	}
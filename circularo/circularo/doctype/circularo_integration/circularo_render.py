@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+Parallel PDF rendering in a pool of worker processes (or in the calling process)
+Every worker process has its own Frappe site context, documents can be rendered in batches to save PDF engine startups
+"""
+
+from __future__ import unicode_literals
+import multiprocessing
+import shutil
+import tempfile
+import frappe
+
+# Default count of rendering processes of one bulk job
+DEFAULT_RENDER_POOL_SIZE = 2
+
+# Default count of documents rendered in one run of the PDF engine (1 renders documents one by one)
+DEFAULT_RENDER_BATCH_SIZE = 1
+
+
+def render_documents(doctype, docnames, pool_size, batch_size=1):
+	"""
+	Render Frappe documents to PDF files in a process pool, or in this process if pool size is 0
+	Results are yielded in order of completion, so they can be processed while other documents are still rendered
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docnames: Frappe DocNames
+	:type docnames: list
+	:param pool_size: Count of rendering processes, 0 to render in this process
+	:type pool_size: int
+	:param batch_size: Count of documents rendered in one run of the PDF engine
+	:type batch_size: int
+	:return: Generator of (docname, temporary PDF file path, number of pages, error message) tuples
+	"""
+	batch_size = max(1, batch_size or 1)
+	batches = [docnames[start:start + batch_size] for start in range(0, len(docnames), batch_size)]
+
+	if pool_size < 1:
+		for batch in batches:
+			for result in _render_batch(doctype, batch):
+				yield result
+		return
+
+	# Spawned processes do not share database connection or sockets with this one
+	context = multiprocessing.get_context("spawn")
+	pool = context.Pool(
+		processes=max(1, min(pool_size, len(batches))),
+		initializer=_init_worker,
+		initargs=(frappe.local.site, frappe.local.sites_path, frappe.session.user))
+
+	try:
+		for results in pool.imap_unordered(_render_to_files, [(doctype, batch) for batch in batches]):
+			for result in results:
+				yield result
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def _init_worker(site, sites_path, user):
+	"""
+	Initialize Frappe site context of rendering process
+
+	:param site: Frappe site
+	:type site: str
+	:param sites_path: Frappe sites path
+	:type sites_path: str
+	:param user: User to render documents as
+	:type user: str
+	:return:
+	"""
+	frappe.init(site=site, sites_path=sites_path)
+	frappe.connect()
+	frappe.set_user(user)
+
+
+def _render_to_files(args):
+	"""
+	Render Frappe documents into temporary PDF files (in rendering process)
+
+	:param args: Frappe DocType and DocNames
+	:type args: tuple
+	:return: List of (docname, temporary PDF file path, number of pages, error message) tuples
+	"""
+	doctype, docnames = args
+	try:
+		return _render_batch(doctype, docnames)
+
+	finally:
+		# Do not keep transaction open between batches
+		frappe.db.rollback()
+
+
+def _render_batch(doctype, docnames):
+	"""
+	Render Frappe documents into temporary PDF files, errors are returned
+
+	:param doctype: Frappe DocType
+	:type doctype: str
+	:param docnames: Frappe DocNames
+	:type docnames: list
+	:return: List of (docname, temporary PDF file path, number of pages, error message) tuples
+	"""
+	from circularo.circularo.doctype.circularo_integration.circularo_integration import _print_to_pdf, _print_batch_to_pdf
+
+	try:
+		if len(docnames) > 1:
+			rendered = _print_batch_to_pdf(doctype, docnames)
+		else:
+			rendered = [_print_one(_print_to_pdf, doctype, docname) for docname in docnames]
+
+		return [_save_to_file(*result) for result in rendered]
+
+	except Exception as e:
+		return [(docname, None, None, str(e)) for docname in docnames]
+
+
+def _print_one(print_to_pdf, doctype, docname):
+	"""
+	Render Frappe document to PDF, errors are returned
+
+	:return: DocName, PDF file, number of pages and error message
+	"""
+	try:
+		pdf_file, num_pages = print_to_pdf(doctype, docname)
+		return docname, pdf_file, num_pages, None
+
+	except Exception as e:
+		return docname, None, None, str(e)
+
+
+def _save_to_file(docname, pdf_file, num_pages, error):
+	"""
+	Copy rendered PDF file into temporary file, which outlives rendering process
+
+	:return: DocName, temporary PDF file path, number of pages and error message
+	"""
+	if error is not None:
+		return docname, None, None, error
+
+	try:
+		with pdf_file, tempfile.NamedTemporaryFile(prefix="circularo-", suffix=".pdf", delete=False) as temp_file:
+			shutil.copyfileobj(pdf_file, temp_file)
+
+		return docname, temp_file.name, num_pages, None
+
+	except Exception as e:
+		return docname, None, None, str(e)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+Local stand-in of Circularo REST API for tests and benchmarks
+Implements only endpoints used by this integration, with configurable latency and failure injection
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlsplit
+from circularo.circularo.doctype.circularo_integration.circularo_utils import get_endpoint_template
+
+
+class StandInServer(object):
+	"""
+	Circularo stand-in server running in background thread
+	"""
+	def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, failure_status=503, seed=None):
+		"""
+		:param latency: Delay of every response (seconds)
+		:type latency: float
+		:param jitter: Maximal random delay added to latency (seconds)
+		:type jitter: float
+		:param failure_rate: Probability of failed response
+		:type failure_rate: float
+		:param failure_status: Status code of failed responses
+		:type failure_status: int
+		:param seed: Optional seed of randomness
+		:type seed: int | None
+		"""
+		self.latency = latency
+		self.jitter = jitter
+		self.failure_rate = failure_rate
+		self.failure_status = failure_status
+
+		self.files = {}
+		self.documents = {}
+		self.requests = Counter()
+
+		self._random = random.Random(seed)
+		self._forced_failures = []
+		self._lock = threading.Lock()
+		self._server = None
+		self._thread = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	@property
+	def url(self):
+		"""
+		Base URL of the server (same format as Circularo server URL in settings)
+
+		:return: Server URL
+		"""
+		return "http://127.0.0.1:" + str(self._server.server_address[1]) + "/"
+
+	def start(self):
+		"""
+		Start server on random free port
+
+		:return: Started server
+		"""
+		self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+		self._server.stand_in = self
+		self._thread = threading.Thread(target=self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+
+		return self
+
+	def stop(self):
+		"""
+		Stop server
+
+		:return:
+		"""
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._thread.join()
+			self._server = None
+
+	def fail_next(self, count=1, status=None):
+		"""
+		Make next requests fail
+
+		:param count: Count of failed requests
+		:type count: int
+		:param status: Status code of failed responses (None to close connection without response)
+		:type status: int | None
+		:return:
+		"""
+		with self._lock:
+			self._forced_failures.extend([status] * count)
+
+	def sign(self, document_id):
+		"""
+		Sign document (as a user would do in Circularo)
+
+		:param document_id: Circularo document ID
+		:type document_id: str
+		:return:
+		"""
+		with self._lock:
+			self.documents[document_id]["isSigned"] = True
+
+	def handle(self, method, path, query, body):
+		"""
+		Handle request
+
+		:return: Status code, content type and response body (None to close connection)
+		"""
+		with self._lock:
+			self.requests[method + " " + get_endpoint_template(path)] += 1
+			failure = self._forced_failures.pop(0) if self._forced_failures else False
+			if (failure is False) and (self.failure_rate > 0) and (self._random.random() < self.failure_rate):
+				failure = self.failure_status
+			delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+
+		if delay:
+			time.sleep(delay)
+		if failure is None:
+			return None, None, None
+		if failure is not False:
+			return failure, "application/json", {"error": "Injected failure"}
+
+		if (method == "GET") and (path in ("ping", "settings", "logout")):
+			return 200, "application/json", {}
+
+		if (method == "POST") and (path == "login"):
+			return 200, "application/json", {
+				"token": uuid.uuid4().hex,
+				"rights": ["use_file_management", "use_document_management"],
+				"user": {"config": {"signature": [{"imageId": "stand-in-signature"}]}}
+			}
+
+		if (method == "POST") and (path == "api/key"):
+			return 200, "application/json", {"id": uuid.uuid4().hex}
+
+		if (method == "DELETE") and path.startswith("api/key/"):
+			return 200, "application/json", {}
+
+		if (method == "POST") and (path == "files/saveFile"):
+			content = _get_multipart_content(body)
+			file_id = hashlib.sha1(content).hexdigest()
+			with self._lock:
+				self.files[file_id] = content
+			return 200, "application/json", {"file": {"hash": file_id}}
+
+		if (method == "POST") and (path == "documents"):
+			request = json.loads(body.decode("utf-8"))
+			document_id = uuid.uuid4().hex
+			with self._lock:
+				self.documents[document_id] = {
+					"_version": 1,
+					"pdfFile": {"content": request.get("body").get("pdfFile").get("content")},
+					"isSigned": bool(request.get("optionalData", {}).get("signatures"))
+				}
+			return 200, "application/json", {"results": [{"documentId": document_id}]}
+
+		match = re.match(r"^documents/sign/(\d+)$", path)
+		if (method == "PUT") and match:
+			request = json.loads(body.decode("utf-8"))
+			with self._lock:
+				document = self.documents.get(request.get("id"))
+				if document is None:
+					return 404, "application/json", {"error": "Unknown document"}
+				document["isSigned"] = True
+				document["_version"] += 1
+			return 200, "application/json", {}
+
+		match = re.match(r"^documents/([^/]+)$", path)
+		if (method == "GET") and match:
+			with self._lock:
+				document = self.documents.get(match.group(1))
+				if document is None:
+					return 404, "application/json", {"error": "Unknown document"}
+				return 200, "application/json", {"results": [dict(document)]}
+
+		match = re.match(r"^files/loadFile/hash/([^/]+)$", path)
+		if (method in ("GET", "HEAD")) and match:
+			with self._lock:
+				content = self.files.get(match.group(1))
+			if content is None:
+				return 404, "application/json", {"error": "Unknown file"}
+			return 200, "application/pdf", content
+
+		return 404, "application/json", {"error": "Unknown endpoint"}
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Request handler of stand-in server
+	"""
+	# Keep-alive, so pooled sessions are reused
+	protocol_version = "HTTP/1.1"
+	# Headers and body are written separately, avoid delayed ACK stalls
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		self._handle("GET")
+
+	def do_HEAD(self):
+		self._handle("HEAD")
+
+	def do_POST(self):
+		self._handle("POST")
+
+	def do_PUT(self):
+		self._handle("PUT")
+
+	def do_DELETE(self):
+		self._handle("DELETE")
+
+	def log_message(self, format, *args):
+		pass
+
+	def _handle(self, method):
+		url = urlsplit(self.path)
+		path = url.path
+		if path.startswith("/api/v1/"):
+			path = path[len("/api/v1/"):]
+
+		length = int(self.headers.get("Content-Length") or 0)
+		body = self.rfile.read(length) if length else b""
+
+		status, content_type, content = self.server.stand_in.handle(method, path, url.query, body)
+		if status is None:
+			# Simulate connection reset
+			self.close_connection = True
+			return
+
+		if not isinstance(content, bytes):
+			content = json.dumps(content).encode("utf-8")
+
+		self.send_response(status)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+		if method != "HEAD":
+			self.wfile.write(content)
+
+
+def _get_multipart_content(body):
+	"""
+	Get content of the first file of multipart/form-data body
+
+	:param body: Request body
+	:type body: bytes
+	:return: File content
+	"""
+	boundary = body[:body.find(b"\r\n")]
+	start = body.find(b"\r\n\r\n") + 4
+	end = body.find(b"\r\n" + boundary, start)
+
+	return body[start:end]
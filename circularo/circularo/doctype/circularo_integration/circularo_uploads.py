@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Circularo and contributors
+# For license information, please see license.txt
+
+"""
+Index of files uploaded into Circularo, addressed by their content
+Identical PDF files are then uploaded only once
+"""
+
+from __future__ import unicode_literals
+import frappe
+
+# Default validity of index entries (hours)
+DEFAULT_UPLOAD_INDEX_TTL = 24
+
+
+def get_uploaded_file_id(circularo_integration, content_hash, file_size):
+	"""
+	Get Circularo file ID of already uploaded content
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:param content_hash: SHA-256 of the content
+	:type content_hash: str
+	:param file_size: Size of the content
+	:type file_size: int
+	:return: Circularo file ID or None if not uploaded yet
+	"""
+	if not circularo_integration.upload_index_ttl:
+		return None
+
+	entry = frappe.cache().get_value(_get_content_key(circularo_integration, content_hash))
+	if (not entry) or (entry.get("file_size") != file_size):
+		return None
+
+	return entry.get("file_id")
+
+
+def remember_uploaded_file(circularo_integration, content_hash, file_size, file_id):
+	"""
+	Remember Circularo file ID of uploaded content
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:param content_hash: SHA-256 of the content
+	:type content_hash: str
+	:param file_size: Size of the content
+	:type file_size: int
+	:param file_id: Circularo file ID
+	:type file_id: str
+	:return:
+	"""
+	if not circularo_integration.upload_index_ttl:
+		return
+
+	expires_in_sec = circularo_integration.upload_index_ttl * 60 * 60
+	content_key = _get_content_key(circularo_integration, content_hash)
+
+	frappe.cache().set_value(content_key, {"file_id": file_id, "file_size": file_size}, expires_in_sec=expires_in_sec)
+	frappe.cache().set_value(_get_file_key(circularo_integration, file_id), content_key, expires_in_sec=expires_in_sec)
+
+
+def forget_uploaded_file(circularo_integration, file_id):
+	"""
+	Forget Circularo file ID which turned out to be invalid
+
+	:param circularo_integration: Circularo Integration settings
+	:type circularo_integration: CircularoIntegration
+	:param file_id: Circularo file ID
+	:type file_id: str
+	:return:
+	"""
+	file_key = _get_file_key(circularo_integration, file_id)
+	content_key = frappe.cache().get_value(file_key)
+
+	if content_key:
+		frappe.cache().delete_value(content_key)
+	frappe.cache().delete_value(file_key)
+
+
+def _get_content_key(circularo_integration, content_hash):
+	"""
+	Get cache key of content, file IDs are valid only within one Circularo server and tenant
+
+	:return: Cache key
+	"""
+	return "|".join(["circularo_upload", circularo_integration.circularo_url, circularo_integration.circularo_tenant, content_hash])
+
+
+def _get_file_key(circularo_integration, file_id):
+	"""
+	Get cache key of Circularo file ID
+
+	:return: Cache key
+	"""
+	return "|".join(["circularo_upload_file", circularo_integration.circularo_url, circularo_integration.circularo_tenant, file_id])
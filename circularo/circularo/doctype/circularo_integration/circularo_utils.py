@@ -3,7 +3,160 @@
 # For license information, please see license.txt
 
 from __future__ import unicode_literals
+import hashlib
+import io
+import os
+import random
+import re
+import threading
+import time
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from six.moves.http_cookiejar import DefaultCookiePolicy
+from six.moves.urllib.parse import urlsplit
+
+# Default count of kept-alive connections per Circularo server
+DEFAULT_POOL_SIZE = 10
+
+# Size of streamed chunks (bytes)
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Default timeouts of connecting and of waiting for response data (seconds)
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+
+# Endpoint paths with variable parts (IDs and tokens must never appear in metrics)
+ENDPOINT_TEMPLATES = [
+    (re.compile(r"^documents/sign/[^/]+$"), "documents/sign/{version}"),
+    (re.compile(r"^files/loadFile/hash/[^/]+$"), "files/loadFile/hash/{file_id}"),
+    (re.compile(r"^documents/[^/]+$"), "documents/{document_id}"),
+    (re.compile(r"^api/key/[^/]+$"), "api/key/{token}")
+]
+STATIC_ENDPOINTS = ["ping", "settings", "login", "logout", "api/key", "files/saveFile", "documents"]
+
+# Retry policies of idempotent endpoints: count of attempts, base and maximal backoff delay (seconds)
+# Other requests (uploads, document creation, signing) are never retried
+RETRY_POLICIES = {
+    "GET ping": (2, 0.2, 1.0),
+    "GET settings": (2, 0.2, 1.0),
+    "GET logout": (2, 0.2, 1.0),
+    "DELETE api/key/{token}": (2, 0.2, 1.0),
+    "GET documents/{document_id}": (3, 0.5, 4.0),
+    "GET files/loadFile/hash/{file_id}": (3, 0.5, 4.0),
+    "HEAD files/loadFile/hash/{file_id}": (2, 0.2, 1.0)
+}
+NO_RETRY_POLICY = (1, 0, 0)
+
+# Responses worth another attempt
+RETRY_STATUS_CODES = (502, 503, 504)
+
+# Escaping of multipart header parameters (HTML5 style, same as urllib3 used by requests)
+MULTIPART_PARAMETER_REPLACEMENTS = dict((code, "%{0:02X}".format(code)) for code in range(0x20) if code != 0x1B)
+MULTIPART_PARAMETER_REPLACEMENTS.update({0x22: "%22", 0x5C: "\\\\"})
+
+# Functions notified about every performed request
+_request_listeners = []
+
+# Pooled sessions, one per Circularo server
+_sessions = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = os.getpid()
+
+
+class _NoCookiesPolicy(DefaultCookiePolicy):
+    """
+    Cookie policy refusing all cookies
+    Pooled sessions are shared by all users, so they must stay stateless
+    """
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Request was not sent, because circuit breaker of the server is open
+    """
+    pass
+
+
+class DeadlineExceededError(requests.exceptions.Timeout):
+    """
+    Time budget of Circularo operation is exhausted
+    """
+    pass
+
+
+class MultipartFileStream(object):
+    """
+    Streamed multipart/form-data body with one file
+    File is read chunk by chunk while the request is being sent, so the body is never built in memory
+    """
+    def __init__(self, field_name, file_name, file_object, content_type="application/pdf", chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param field_name: Form field name
+        :type field_name: str
+        :param file_name: File name
+        :type file_name: str
+        :param file_object: Binary file opened for reading
+        :type file_object: file
+        :param content_type: File content type
+        :type content_type: str
+        :param chunk_size: Size of read chunks
+        :type chunk_size: int
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        self.chunk_size = chunk_size
+
+        self._head = ("--" + boundary + "\r\n" +
+                      "Content-Disposition: form-data; " + _format_multipart_parameter("name", field_name) + "; " +
+                      _format_multipart_parameter("filename", file_name) + "\r\n" +
+                      "Content-Type: " + content_type + "\r\n\r\n").encode("utf-8")
+        self._tail = ("\r\n--" + boundary + "--\r\n").encode("utf-8")
+
+        file_object.seek(0, os.SEEK_END)
+        self._length = len(self._head) + file_object.tell() + len(self._tail)
+        file_object.seek(0)
+
+        self._parts = [io.BytesIO(self._head), file_object, io.BytesIO(self._tail)]
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        """
+        Reads next part of the body
+
+        :param size: Maximal count of bytes, -1 to read everything
+        :type size: int
+        :return: Body bytes
+        """
+        if (size is None) or (size < 0):
+            data = b"".join(part.read() for part in self._parts)
+            self._parts = []
+            return data
+
+        chunks = []
+        while (size > 0) and self._parts:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        return b"".join(chunks)
 
 
 def create_circularo_url(base_url, url, query_parameters=None):
@@ -33,9 +186,103 @@ def create_circularo_url(base_url, url, query_parameters=None):
     return my_url
 
 
-def call_rest_api(method, url, post_parameters=None, file_parameters=None, json_decode=True):
+def get_session(url, pool_size=None):
     """
-    Performs request
+    Returns pooled keep-alive session for Circularo server of given URL
+
+    :param url: Any URL of the Circularo server
+    :type url: str
+    :param pool_size: Optional count of kept-alive connections
+    :type pool_size: int | None
+    :return: Pooled session
+    """
+    global _sessions_pid
+
+    base_url = _get_base_url(url)
+    pool_size = int(pool_size or DEFAULT_POOL_SIZE)
+
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            # Forked process must not share sockets with its parent
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+
+        pooled = _sessions.get(base_url)
+        if (pooled is None) or (pooled.get("pool_size") != pool_size):
+            if pooled is not None:
+                pooled.get("session").close()
+
+            session = requests.Session()
+            session.cookies.set_policy(_NoCookiesPolicy())
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+            pooled = {
+                "session": session,
+                "adapter": adapter,
+                "pool_size": pool_size,
+                "requests": 0
+            }
+            _sessions[base_url] = pooled
+
+        pooled["requests"] += 1
+        return pooled.get("session")
+
+
+def get_pool_stats():
+    """
+    Returns statistics of pooled sessions in current process
+
+    :return: Statistics per Circularo server
+    """
+    stats = {}
+
+    with _sessions_lock:
+        for base_url, pooled in _sessions.items():
+            pools = pooled.get("adapter").poolmanager.pools
+            connections = 0
+            pooled_requests = 0
+            idle_connections = 0
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+                if pool.pool is not None:
+                    # Queue is pre-filled with None placeholders
+                    idle_connections += len([connection for connection in list(pool.pool.queue) if connection is not None])
+
+            stats[base_url] = {
+                "pid": _sessions_pid,
+                "pool_size": pooled.get("pool_size"),
+                "requests": pooled.get("requests"),
+                "pooled_requests": pooled_requests,
+                "opened_connections": connections,
+                "idle_connections": idle_connections
+            }
+
+    return stats
+
+
+def close_sessions():
+    """
+    Closes all pooled sessions of current process
+
+    :return:
+    """
+    with _sessions_lock:
+        for pooled in _sessions.values():
+            pooled.get("session").close()
+        _sessions.clear()
+
+
+def call_rest_api(method, url, post_parameters=None, file_parameters=None, json_decode=True, pool_size=None, stream=False, breaker=None,
+                  timeout=None, deadline=None, notify_listeners=True):
+    """
+    Performs request using pooled keep-alive session
+    Idempotent endpoints are retried with jittered exponential backoff (see RETRY_POLICIES)
 
     :param method: Request method
     :type method: str
@@ -43,18 +290,328 @@ def call_rest_api(method, url, post_parameters=None, file_parameters=None, json_
     :type url: str
     :param post_parameters: Optional POST body parameters
     :type post_parameters: dict | None
-    :param file_parameters: Optional file parameters
+    :param file_parameters: Optional file parameters, single file-like object (optionally as (file name, file) tuple) is streamed
     :type file_parameters: dict
     :param json_decode: Automatically decode JSON?
     :type json_decode: bool
+    :param pool_size: Optional count of kept-alive connections
+    :type pool_size: int | None
+    :param stream: Do not download body immediately (read it with stream_to_file), only without json_decode
+    :type stream: bool
+    :param breaker: Optional circuit breaker with allow(), record_success() and record_failure(error) methods
+    :type breaker: object | None
+    :param timeout: Optional connect and read timeouts (seconds), DEFAULT_CONNECT_TIMEOUT and DEFAULT_READ_TIMEOUT otherwise
+    :type timeout: tuple | None
+    :param deadline: Optional time (as time.time()) by which the whole call incl. retries must finish
+    :type deadline: float | None
+    :param notify_listeners: Notify request listeners (e.g. metrics)? Disabled by benchmarks against local stand-in
+    :type notify_listeners: bool
     :return:
     """
-    my_function = getattr(requests, method)
-    r = my_function(url, json=post_parameters, files=file_parameters)
+    attempts, base_delay, max_delay = RETRY_POLICIES.get(method.upper() + " " + get_endpoint_template(url), NO_RETRY_POLICY)
+
+    attempt = 1
+    while True:
+        try:
+            r = _perform_request(method, url, post_parameters, file_parameters, pool_size, stream, breaker, timeout, deadline, notify_listeners)
+            break
+        except Exception as e:
+            if (attempt >= attempts) or (not _is_retryable(e)):
+                raise
+
+            delay = get_retry_delay(attempt, base_delay, max_delay)
+            if (deadline is not None) and (time.time() + delay >= deadline):
+                # No time left for another attempt
+                raise
 
-    r.raise_for_status()
+        time.sleep(delay)
+        attempt += 1
 
     if json_decode:
         return r.json()
     else:
         return r
+
+
+def get_retry_delay(attempt, base_delay, max_delay):
+    """
+    Returns jittered exponential backoff delay
+
+    :param attempt: Number of failed attempt (starting with 1)
+    :type attempt: int
+    :param base_delay: Delay after the first attempt (seconds)
+    :type base_delay: float
+    :param max_delay: Maximal delay (seconds)
+    :type max_delay: float
+    :return: Delay (seconds)
+    """
+    delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+
+    # Half of the delay is random, so retries of concurrent workers do not arrive at once
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def add_request_listener(listener):
+    """
+    Registers function notified about every performed request
+    Listener is called with method, endpoint template, duration (seconds), status code (None on connection error),
+    count of sent bytes and count of received bytes
+
+    :param listener: Listener function
+    :type listener: callable
+    :return:
+    """
+    if listener not in _request_listeners:
+        _request_listeners.append(listener)
+
+
+def get_endpoint_template(url):
+    """
+    Returns endpoint path of Circularo URL without query and variable parts
+
+    :param url: Circularo URL
+    :type url: str
+    :return: Endpoint template, e.g. "documents/{document_id}"
+    """
+    path = urlsplit(url).path
+    api_position = path.find("api/v1/")
+    path = path[api_position + len("api/v1/"):] if api_position >= 0 else path.lstrip("/")
+
+    if path in STATIC_ENDPOINTS:
+        return path
+
+    for pattern, template in ENDPOINT_TEMPLATES:
+        if pattern.match(path):
+            return template
+
+    # Unknown path may contain anything
+    return "other"
+
+
+def stream_to_file(response, file_object, chunk_size=DEFAULT_CHUNK_SIZE, deadline=None):
+    """
+    Writes streamed response body into file chunk by chunk, response is closed afterwards
+
+    :param response: Response of streamed request
+    :type response: requests.Response
+    :param file_object: Binary file opened for writing
+    :type file_object: file
+    :param chunk_size: Size of chunks
+    :type chunk_size: int
+    :param deadline: Optional time (as time.time()) by which the body must be downloaded
+    :type deadline: float | None
+    :return: Count of written bytes and MD5 hash of the content
+    """
+    file_size = 0
+    content_hash = hashlib.md5()
+
+    try:
+        for chunk in response.iter_content(chunk_size):
+            if (deadline is not None) and (time.time() > deadline):
+                # Read timeout bounds single reads only, not slowly trickling body
+                raise DeadlineExceededError("Circularo operation took too long")
+            if chunk:
+                file_object.write(chunk)
+                content_hash.update(chunk)
+                file_size += len(chunk)
+    finally:
+        response.close()
+
+    return file_size, content_hash.hexdigest()
+
+
+def hash_file(file_object, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Computes SHA-256 of file content chunk by chunk, file is rewound afterwards
+
+    :param file_object: Binary file opened for reading
+    :type file_object: file
+    :param chunk_size: Size of read chunks
+    :type chunk_size: int
+    :return: SHA-256 hash and size of the content
+    """
+    content_hash = hashlib.sha256()
+    file_size = 0
+
+    file_object.seek(0)
+    while True:
+        chunk = file_object.read(chunk_size)
+        if not chunk:
+            break
+        content_hash.update(chunk)
+        file_size += len(chunk)
+    file_object.seek(0)
+
+    return content_hash.hexdigest(), file_size
+
+
+def _perform_request(method, url, post_parameters, file_parameters, pool_size, stream, breaker, timeout, deadline, notify_listeners=True):
+    """
+    Performs single request attempt, see call_rest_api
+
+    :return: Response with successful status code
+    """
+    connect_timeout, read_timeout = timeout or (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceededError("Circularo operation took too long")
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+
+    if (breaker is not None) and (not breaker.allow()):
+        raise CircuitOpenError("Circularo server is unavailable, requests are suspended after repeated failures")
+
+    session = get_session(url, pool_size)
+
+    data = None
+    headers = None
+    if _is_streamed_upload(file_parameters):
+        # Single file-like object -> stream multipart body instead of building it in memory
+        field_name, file_value = list(file_parameters.items())[0]
+        file_name, file_object = file_value if isinstance(file_value, tuple) else (field_name, file_value)
+        data = MultipartFileStream(field_name, file_name, file_object)
+        headers = {"Content-Type": data.content_type}
+        file_parameters = None
+        post_parameters = None
+
+    start = time.time()
+    r = None
+    try:
+        r = session.request(method.upper(), url, json=post_parameters, data=data, files=file_parameters, headers=headers, stream=stream,
+                            timeout=(connect_timeout, read_timeout))
+        r.raise_for_status()
+    except Exception as e:
+        if r is not None:
+            r.close()
+        if breaker is not None:
+            if _is_server_failure(e):
+                breaker.record_failure(e)
+            else:
+                # Client errors (4xx) prove the server is alive
+                breaker.record_success()
+        raise
+    finally:
+        if notify_listeners:
+            _notify_request_listeners(method, url, time.time() - start, r, stream)
+
+    if breaker is not None:
+        breaker.record_success()
+
+    return r
+
+
+def _is_server_failure(error):
+    """
+    Checks if request failed because of the server (connection error, timeout or 5xx response)
+
+    :param error: Raised exception
+    :type error: Exception
+    :return: True if server failed
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        return (error.response is not None) and (error.response.status_code >= 500)
+
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _is_retryable(error):
+    """
+    Checks if failed request is worth another attempt
+
+    :param error: Raised exception
+    :type error: Exception
+    :return: True if request can be retried
+    """
+    if isinstance(error, (CircuitOpenError, DeadlineExceededError)):
+        return False
+
+    if isinstance(error, requests.exceptions.HTTPError):
+        return (error.response is not None) and (error.response.status_code in RETRY_STATUS_CODES)
+
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _notify_request_listeners(method, url, duration, response, stream):
+    """
+    Notifies request listeners about performed request
+
+    :param method: Request method
+    :type method: str
+    :param url: Request URL
+    :type url: str
+    :param duration: Request duration (seconds)
+    :type duration: float
+    :param response: Response or None on connection error
+    :type response: requests.Response | None
+    :param stream: Was the response streamed?
+    :type stream: bool
+    :return:
+    """
+    if not _request_listeners:
+        return
+
+    endpoint = get_endpoint_template(url)
+    status_code = None
+    bytes_sent = 0
+    bytes_received = 0
+
+    if response is not None:
+        status_code = response.status_code
+        body = response.request.body
+        if body is not None:
+            bytes_sent = len(body)
+        if stream:
+            bytes_received = int(response.headers.get("Content-Length") or 0)
+        else:
+            bytes_received = len(response.content)
+
+    for listener in _request_listeners:
+        try:
+            listener(method.upper(), endpoint, duration, status_code, bytes_sent, bytes_received)
+        except Exception:
+            # Listeners must never break the request
+            pass
+
+
+def _is_streamed_upload(file_parameters):
+    """
+    Checks if file parameters contain single file-like object
+
+    :param file_parameters: File parameters
+    :type file_parameters: dict | None
+    :return: True if upload can be streamed
+    """
+    if (not isinstance(file_parameters, dict)) or (len(file_parameters) != 1):
+        return False
+
+    file_value = list(file_parameters.values())[0]
+    if isinstance(file_value, tuple):
+        file_value = file_value[1] if len(file_value) == 2 else None
+
+    return hasattr(file_value, "read") and hasattr(file_value, "seek")
+
+
+def _format_multipart_parameter(name, value):
+    """
+    Formats parameter of multipart header, quotes, backslashes and control characters of the value are escaped
+
+    :param name: Parameter name
+    :type name: str
+    :param value: Parameter value
+    :type value: str
+    :return: Formatted parameter
+    """
+    return name + "=\"" + value.translate(MULTIPART_PARAMETER_REPLACEMENTS) + "\""
+
+
+def _get_base_url(url):
+    """
+    Returns scheme and host part of URL
+
+    :param url: URL
+    :type url: str
+    :return: Base URL
+    """
+    parts = urlsplit(url)
+    return parts.scheme + "://" + parts.netloc + "/"
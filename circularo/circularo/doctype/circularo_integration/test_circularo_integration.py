@@ -3,8 +3,852 @@
 # See license.txt
 from __future__ import unicode_literals
 
-# import frappe
+import frappe
+import datetime
+import hashlib
+import io
+import os
+import re
+import requests
+import shutil
+import tempfile
+import time
+import tracemalloc
 import unittest
+from unittest import mock
+from PyPDF2 import PdfFileWriter
+from circularo.circularo.doctype.circularo_integration import circularo_email, circularo_files, circularo_integration, circularo_jobs, \
+	circularo_pdf_cache, circularo_progress
+from circularo.circularo.doctype.circularo_integration.circularo_benchmark import make_pdf
+from circularo.circularo.doctype.circularo_integration.circularo_email import discard_pending_emails, queue_signed_document_email, \
+	send_digest, EMAIL_PENDING, EMAIL_QUEUED
+from circularo.circularo.doctype.circularo_integration.circularo_files import save_response_as_file
+from circularo.circularo.doctype.circularo_integration.circularo_integration import bulk_send, clear_settings_cache, create_api_token, get_settings, \
+	is_enabled_batch, signature_webhook, _get_deadline, _operation_deadline, _override_request_options, _upload_pdf, CircularoIntegration, \
+	ACTION_SEND
+from circularo.circularo.doctype.circularo_integration.circularo_jobs import archive_old_documents, bulk_send_job, reconcile_pending_documents, \
+	send_email_digests, RECONCILE_BASE_DELAY, RECONCILE_CURSOR_KEY, RECONCILE_MAX_DELAY
+from circularo.circularo.doctype.circularo_integration.circularo_pdf import get_page_count, get_page_count_fast, get_page_count_full, \
+	merge_pdfs, optimize_pdf, render_batch_pdf, spool_pdf
+from circularo.circularo.doctype.circularo_integration.circularo_pdf_cache import evict, get_cache_key, get_cached_pdf, put_pdf
+from circularo.circularo.doctype.circularo_integration.circularo_progress import get_job_progress, ProgressReporter, PROGRESS_EVENT, \
+	STAGE_CREATED, STAGE_UPLOADED
+from circularo.circularo.doctype.circularo_integration.circularo_stand_in import StandInServer
+from circularo.circularo.doctype.circularo_integration.circularo_utils import call_rest_api, create_circularo_url, get_endpoint_template, \
+	stream_to_file, MultipartFileStream, CircuitOpenError, DeadlineExceededError, ENDPOINT_TEMPLATES, STATIC_ENDPOINTS
+
+
+def make_text_pdf(num_pages):
+	"""
+	Create PDF file with uncompressed page contents
+	"""
+	objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+	content = b"BT /F1 10 Tf 50 800 Td " + b"(Circularo test line) Tj 0 -12 Td " * 60 + b"ET"
+	kids = []
+	for _ in range(num_pages):
+		objects.append(b"<< /Length " + str(len(content)).encode("ascii") + b" >>\nstream\n" + content + b"\nendstream")
+		objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+			"/Contents %d 0 R >>" % len(objects)).encode("ascii"))
+		kids.append(("%d 0 R" % len(objects)).encode("ascii"))
+	objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(kids) + b"] /Count " + str(num_pages).encode("ascii") + b" >>"
+
+	output = io.BytesIO()
+	output.write(b"%PDF-1.4\n")
+	offsets = []
+	for number, body in enumerate(objects, 1):
+		offsets.append(output.tell())
+		output.write(str(number).encode("ascii") + b" 0 obj\n" + body + b"\nendobj\n")
+	xref = output.tell()
+	output.write(("xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)).encode("ascii"))
+	for offset in offsets:
+		output.write(("%010d 00000 n \n" % offset).encode("ascii"))
+	output.write(("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)).encode("ascii"))
+	return output.getvalue()
+
+
+def fake_render(html, options, with_outline=True):
+	"""
+	Render every marker heading (and its document) as many blank pages as the document says
+	"""
+	writer = PdfFileWriter()
+	first_pages = []
+	for marker, num_pages in re.findall(r">(circularo-batch-[0-9a-f]+-\d+)</h1><p>(\d+) pages</p>", html):
+		first_pages.append((marker, writer.getNumPages()))
+		for _ in range(int(num_pages)):
+			writer.addBlankPage(595, 842)
+
+	if with_outline:
+		for marker, first_page in first_pages:
+			writer.addBookmark(marker, first_page)
+
+	output = io.BytesIO()
+	writer.write(output)
+	return output.getvalue()
+
+
+class ChunkedResponse(object):
+	"""
+	Streamed response generating its body lazily
+	"""
+	def __init__(self, num_chunks, chunk_size):
+		self.num_chunks = num_chunks
+		self.chunk_size = chunk_size
+		self.closed = False
+
+	def iter_content(self, chunk_size):
+		for i in range(self.num_chunks):
+			yield bytes([i % 256]) * self.chunk_size
+
+	def close(self):
+		self.closed = True
+
+
+class RecordingBreaker(object):
+	"""
+	In-memory circuit breaker recording request outcomes
+	"""
+	def __init__(self, allowed=True):
+		self.allowed = allowed
+		self.outcomes = []
+
+	def allow(self):
+		return self.allowed
+
+	def record_success(self):
+		self.outcomes.append("success")
+
+	def record_failure(self, error):
+		self.outcomes.append("failure")
+
+
+class FakeCache(object):
+	"""
+	In-memory replacement of frappe.cache() (values only)
+	"""
+	def __init__(self):
+		self.values = {}
+
+	def get_value(self, key):
+		return self.values.get(key)
+
+	def set_value(self, key, value, expires_in_sec=None):
+		self.values[key] = value
+
+	def delete_value(self, key):
+		self.values.pop(key, None)
+
+
+def make_settings(**values):
+	"""
+	Create enabled Circularo Integration settings (not saved)
+	"""
+	settings = {
+		"doctype": "Circularo Integration",
+		"enabled": 1,
+		"circularo_api_token": "test-token",
+		"show_in_form_view": 1,
+		"show_in_list_view": 1,
+		"show_in_all_doctypes": 0,
+		"show_in_doctypes": "Sales Invoice, Purchase Order",
+		"show_in_single": 0
+	}
+	settings.update(values)
+	return CircularoIntegration(settings)
+
+
+def run_in_test_context(site, sites_path, user, function, *args):
+	"""
+	Run function of worker thread in context of the test
+	"""
+	try:
+		return 0, function(*args)
+	except Exception as e:
+		return 1, str(e)
+
 
 class TestCircularoIntegration(unittest.TestCase):
-	pass
+	def test_page_count(self):
+		for num_pages in (1, 20, 500):
+			pdf_bytes = make_pdf(num_pages)
+			self.assertEqual(get_page_count_fast(pdf_bytes), num_pages)
+			self.assertEqual(get_page_count_full(pdf_bytes), num_pages)
+
+	def test_page_count_without_count(self):
+		pdf_bytes = make_pdf(3)
+		self.assertEqual(get_page_count(pdf_bytes), 3)
+
+		# Fast path gives up instead of guessing
+		self.assertIsNone(get_page_count_fast(pdf_bytes.replace(b"/Count", b"/Cxxnt")))
+
+	def test_merge_pdfs(self):
+		paths = []
+		try:
+			for num_pages in (2, 1, 3):
+				with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+					pdf_file.write(make_pdf(num_pages))
+				paths.append(pdf_file.name)
+
+			merged_file, page_ranges = merge_pdfs([("A", paths[0], 2), ("B", paths[1], 1), ("C", paths[2], 3)])
+			with merged_file:
+				self.assertEqual(get_page_count(merged_file.read()), 6)
+		finally:
+			for path in paths:
+				os.remove(path)
+
+		self.assertEqual([(page_range.get("name"), page_range.get("from"), page_range.get("to")) for page_range in page_ranges],
+			[("A", 1, 2), ("B", 3, 3), ("C", 4, 6)])
+
+	def test_optimize_pdf(self):
+		pdf_bytes = make_text_pdf(4)
+		optimized_bytes = optimize_pdf(pdf_bytes)
+		self.assertLess(len(optimized_bytes), len(pdf_bytes))
+		self.assertEqual(get_page_count(optimized_bytes), 4)
+
+		# Nothing to gain, original file is kept
+		pdf_bytes = make_pdf(2)
+		self.assertEqual(optimize_pdf(pdf_bytes), pdf_bytes)
+
+		# Broken file is passed through
+		self.assertEqual(optimize_pdf(b"not a PDF"), b"not a PDF")
+
+	def test_render_batch_pdf(self):
+		html_documents = ["<html><head><style></style></head><body><p>{0} pages</p></body></html>".format(num_pages) for num_pages in (2, 1, 3)]
+
+		parts = render_batch_pdf(html_documents, fake_render)
+		self.assertEqual([get_page_count(part) for part in parts], [2, 1, 3])
+
+		# Batch which cannot be split back is not used
+		self.assertIsNone(render_batch_pdf(html_documents, lambda html, options: fake_render(html, options, False)))
+		self.assertIsNone(render_batch_pdf([html.replace("<p>", "<div id=\"header-html\"></div><p>") for html in html_documents], fake_render))
+
+	def test_stream_to_file(self):
+		num_chunks, chunk_size = 64, 1024 * 1024
+		response = ChunkedResponse(num_chunks, chunk_size)
+
+		tracemalloc.start()
+		with tempfile.TemporaryFile() as temp_file:
+			file_size, content_hash = stream_to_file(response, temp_file)
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+		expected_hash = hashlib.md5()
+		for chunk in ChunkedResponse(num_chunks, chunk_size).iter_content(chunk_size):
+			expected_hash.update(chunk)
+
+		self.assertTrue(response.closed)
+		self.assertEqual(file_size, num_chunks * chunk_size)
+		self.assertEqual(content_hash, expected_hash.hexdigest())
+		# Only a few chunks may be held in memory at once, body never gets into memory as a whole
+		self.assertLess(peak, 4 * chunk_size)
+
+	def test_save_response_as_file(self):
+		num_chunks, chunk_size = 16, 1024 * 1024
+		expected_hash = hashlib.md5()
+		for chunk in ChunkedResponse(num_chunks, chunk_size).iter_content(chunk_size):
+			expected_hash.update(chunk)
+
+		files_path = tempfile.mkdtemp()
+		try:
+			with mock.patch.object(circularo_files, "get_files_path", side_effect=lambda *path: os.path.join(files_path, *path)), \
+					mock.patch.object(frappe, "db") as db, mock.patch.object(frappe, "get_doc") as get_doc:
+				db.get_value.return_value = None
+
+				tracemalloc.start()
+				saved_file = save_response_as_file(ChunkedResponse(num_chunks, chunk_size), "SINV-1.pdf", "Circularo Documents", "HIST-1")
+				peak = tracemalloc.get_traced_memory()[1]
+				tracemalloc.stop()
+
+				# Download past deadline leaves nothing behind
+				with self.assertRaises(DeadlineExceededError):
+					save_response_as_file(ChunkedResponse(num_chunks, chunk_size), "SINV-1.pdf", "Circularo Documents", "HIST-1",
+						time.time() - 1)
+
+			file_values = get_doc.call_args[0][0]
+			stored_path = os.path.join(files_path, os.path.basename(file_values.get("file_url")))
+			self.assertIs(saved_file, get_doc.return_value)
+			saved_file.insert.assert_called_once_with()
+			self.assertTrue(saved_file.flags.ignore_file_validate)
+			# Readable name, attached to the history record
+			self.assertEqual(file_values.get("file_name"), "SINV-1.pdf")
+			self.assertEqual(file_values.get("attached_to_doctype"), "Circularo Documents")
+			self.assertEqual(file_values.get("attached_to_name"), "HIST-1")
+			db.get_value.assert_any_call("Circularo Documents", "HIST-1", "name", for_update=True)
+			self.assertEqual(file_values.get("content_hash"), expected_hash.hexdigest())
+			self.assertEqual(file_values.get("file_size"), num_chunks * chunk_size)
+			self.assertEqual(os.path.getsize(stored_path), num_chunks * chunk_size)
+			self.assertEqual(os.listdir(files_path), [os.path.basename(stored_path)])
+			self.assertLess(peak, 4 * chunk_size)
+		finally:
+			shutil.rmtree(files_path)
+
+	def test_save_response_as_file_dedup(self):
+		files_path = tempfile.mkdtemp()
+		try:
+			with mock.patch.object(circularo_files, "get_files_path", side_effect=lambda *path: os.path.join(files_path, *path)), \
+					mock.patch.object(frappe, "db") as db, mock.patch.object(frappe, "get_doc") as get_doc:
+				# Same content of two documents, stored once, every document gets its own File
+				db.get_value.return_value = None
+				save_response_as_file(ChunkedResponse(4, 1024), "SINV-1.pdf", "Circularo Documents", "HIST-1")
+				save_response_as_file(ChunkedResponse(4, 1024), "SINV-2.pdf", "Circularo Documents", "HIST-2")
+				inserted = [call[0][0] for call in get_doc.call_args_list]
+				self.assertEqual(len(os.listdir(files_path)), 1)
+				self.assertEqual([values.get("file_name") for values in inserted], ["SINV-1.pdf", "SINV-2.pdf"])
+				self.assertEqual([values.get("attached_to_name") for values in inserted], ["HIST-1", "HIST-2"])
+				self.assertEqual(inserted[0].get("file_url"), inserted[1].get("file_url"))
+				self.assertEqual(get_doc.return_value.insert.call_count, 2)
+
+				# Document downloaded again reuses its File
+				get_doc.reset_mock()
+				db.get_value.return_value = "FILE-1"
+				save_response_as_file(ChunkedResponse(4, 1024), "SINV-1.pdf", "Circularo Documents", "HIST-1")
+				get_doc.assert_called_once_with("File", "FILE-1")
+				get_doc.return_value.insert.assert_not_called()
+
+				# File inserted concurrently (or same content under another URL) is returned
+				get_doc.reset_mock()
+				db.get_value.return_value = None
+				get_doc.return_value.insert.side_effect = frappe.DuplicateEntryError
+				save_response_as_file(ChunkedResponse(4, 1024), "SINV-1.pdf", "Circularo Documents", "HIST-1")
+				self.assertEqual(get_doc.call_args[0][0], "File")
+				self.assertEqual(get_doc.call_args[0][1].get("attached_to_name"), "HIST-1")
+				self.assertEqual(len(os.listdir(files_path)), 1)
+		finally:
+			shutil.rmtree(files_path)
+
+	def test_spool_pdf(self):
+		pdf_bytes = make_pdf(2)
+		for max_size in (len(pdf_bytes) - 1, len(pdf_bytes)):
+			with spool_pdf(pdf_bytes, max_size) as pdf_file:
+				self.assertEqual(pdf_file.read(), pdf_bytes)
+
+	def test_multipart_file_name(self):
+		stream = MultipartFileStream("file", "Invoice \"A\\B\"\r\n.pdf", io.BytesIO(b"%PDF-1.4"))
+		body = stream.read()
+
+		self.assertEqual(len(body), len(stream))
+		self.assertIn(b"name=\"file\"; filename=\"Invoice %22A\\\\B%22%0D%0A.pdf\"\r\n", body)
+		self.assertEqual(len(re.findall(b"\r\n", body.split(b"\r\n\r\n")[0])), 2)
+
+	def test_stand_in_round_trip(self):
+		pdf_bytes = make_pdf(2)
+
+		with StandInServer() as server:
+			r = call_rest_api("post", create_circularo_url(server.url, "files/saveFile", {"token": "test"}), {"fileName": "test.pdf"}, {"file": ("test.pdf", io.BytesIO(pdf_bytes))})
+			file_id = r.get("file").get("hash")
+
+			r = call_rest_api("post", create_circularo_url(server.url, "documents", {"token": "test"}), {"body": {"pdfFile": {"content": file_id}}})
+			document_id = r.get("results")[0].get("documentId")
+
+			r = call_rest_api("get", create_circularo_url(server.url, "documents/" + document_id, {"token": "test"}))
+			self.assertEqual(r.get("results")[0].get("pdfFile").get("content"), file_id)
+
+			with io.BytesIO() as downloaded_file:
+				download_url = create_circularo_url(server.url, "files/loadFile/hash/" + file_id, {"token": "test"})
+				file_size, content_hash = stream_to_file(call_rest_api("get", download_url, json_decode=False, stream=True), downloaded_file)
+
+		self.assertEqual(file_size, len(pdf_bytes))
+		self.assertEqual(content_hash, hashlib.md5(pdf_bytes).hexdigest())
+
+	def test_stand_in_failure_injection(self):
+		with StandInServer() as server:
+			ping_url = create_circularo_url(server.url, "ping")
+
+			server.fail_next(2, 503)
+			with self.assertRaises(requests.exceptions.HTTPError):
+				call_rest_api("get", ping_url)
+
+			server.fail_next(2)
+			with self.assertRaises(requests.exceptions.ConnectionError):
+				call_rest_api("get", ping_url)
+
+			self.assertEqual(call_rest_api("get", ping_url), {})
+			# Both failures were retried once
+			self.assertEqual(server.requests["GET ping"], 5)
+
+	def test_retry_idempotent_only(self):
+		with StandInServer() as server:
+			breaker = RecordingBreaker()
+
+			server.fail_next(1)
+			self.assertEqual(call_rest_api("get", create_circularo_url(server.url, "ping"), breaker=breaker), {})
+			self.assertEqual(server.requests["GET ping"], 2)
+			self.assertEqual(breaker.outcomes, ["failure", "success"])
+
+			server.fail_next(1, 503)
+			with self.assertRaises(requests.exceptions.HTTPError):
+				call_rest_api("post", create_circularo_url(server.url, "documents"), {"body": {"pdfFile": {"content": "x"}}}, breaker=breaker)
+			self.assertEqual(server.requests["POST documents"], 1)
+			self.assertEqual(breaker.outcomes[-1], "failure")
+
+	def test_open_circuit_fails_fast(self):
+		with StandInServer() as server:
+			with self.assertRaises(CircuitOpenError):
+				call_rest_api("get", create_circularo_url(server.url, "ping"), breaker=RecordingBreaker(allowed=False))
+
+			# Request was neither sent nor retried
+			self.assertEqual(server.requests["GET ping"], 0)
+
+	def test_read_timeout(self):
+		with StandInServer(latency=0.5) as server:
+			start = time.time()
+			with self.assertRaises(requests.exceptions.Timeout):
+				call_rest_api("post", create_circularo_url(server.url, "documents"), {"body": {"pdfFile": {"content": "x"}}}, timeout=(1, 0.1))
+			self.assertLess(time.time() - start, 0.4)
+
+	def test_deadline(self):
+		with StandInServer(latency=0.2) as server:
+			ping_url = create_circularo_url(server.url, "ping")
+
+			with self.assertRaises(DeadlineExceededError):
+				call_rest_api("get", ping_url, deadline=time.time() - 1)
+			self.assertEqual(server.requests["GET ping"], 0)
+
+			# Retries stop when the budget is exhausted
+			server.fail_next(2, 503)
+			start = time.time()
+			with self.assertRaises(requests.exceptions.RequestException):
+				call_rest_api("get", ping_url, deadline=time.time() + 0.3)
+			self.assertLess(time.time() - start, 0.45)
+			self.assertEqual(server.requests["GET ping"], 1)
+
+	def test_endpoint_template(self):
+		base_url = "https://sign.example.com/"
+		secrets = ["s3cr3t-t0ken", "d0c-1d-42", "f1le-h4sh", "us3r@example.com"]
+		urls = [
+			(create_circularo_url(base_url, "ping"), "ping"),
+			(create_circularo_url(base_url, "login"), "login"),
+			(create_circularo_url(base_url, "files/saveFile", {"token": secrets[0]}), "files/saveFile"),
+			(create_circularo_url(base_url, "documents", {"token": secrets[0]}), "documents"),
+			(create_circularo_url(base_url, "documents/" + secrets[1], {"token": secrets[0]}), "documents/{document_id}"),
+			(create_circularo_url(base_url, "documents/sign/" + secrets[1], {"token": secrets[0]}), "documents/sign/{version}"),
+			(create_circularo_url(base_url, "files/loadFile/hash/" + secrets[2], {"token": secrets[0]}), "files/loadFile/hash/{file_id}"),
+			(create_circularo_url(base_url, "api/key/" + secrets[0]), "api/key/{token}"),
+			(create_circularo_url(base_url, "users/" + secrets[3] + "/" + secrets[1]), "other"),
+			(create_circularo_url(base_url, secrets[0]), "other"),
+			(base_url + secrets[0] + "/api/v1/ping?token=" + secrets[0], "ping"),
+			("https://" + secrets[0] + "@sign.example.com/" + secrets[1], "other")
+		]
+		allowed = set(STATIC_ENDPOINTS) | set(template for _, template in ENDPOINT_TEMPLATES) | {"other"}
+
+		for url, expected in urls:
+			template = get_endpoint_template(url)
+			self.assertEqual(template, expected)
+			self.assertIn(template, allowed)
+			for secret in secrets:
+				self.assertNotIn(secret, template)
+
+	def test_bulk_send_deduplicates_docnames(self):
+		with mock.patch.object(frappe, "enqueue") as enqueue:
+			r = bulk_send("Sales Invoice", '["SINV-1", "SINV-2", "SINV-1"]', ACTION_SEND)
+
+		self.assertEqual(r.get("status"), 0)
+		self.assertEqual(r.get("message").get("total"), 2)
+		self.assertEqual(enqueue.call_args[1].get("docnames"), ["SINV-1", "SINV-2"])
+
+	def test_bulk_send_summary(self):
+		def send_document(doctype, docname, action, rendered=None, progress=None):
+			if docname == "SINV-2":
+				raise Exception("Upload failed")
+			return {"docname": docname}
+
+		settings = frappe._dict(bulk_send_concurrency=2, render_pool_size=0, render_batch_size=1)
+		with mock.patch.object(circularo_integration, "get_settings", return_value=settings), \
+				mock.patch.object(circularo_integration, "_send_document", side_effect=send_document), \
+				mock.patch.object(circularo_jobs, "run_in_site_context", side_effect=run_in_test_context), \
+				mock.patch.object(frappe, "cache"), mock.patch.object(frappe, "publish_realtime") as publish_realtime:
+			summary = bulk_send_job("test-job", "Sales Invoice", ["SINV-1", "SINV-2", "SINV-3"], ACTION_SEND, "Administrator")
+
+		self.assertEqual((summary.get("total"), summary.get("succeeded"), summary.get("failed")), (3, 2, 1))
+		self.assertEqual([(document.get("docname"), document.get("status")) for document in summary.get("documents")],
+			[("SINV-1", 0), ("SINV-2", 1), ("SINV-3", 0)])
+		self.assertEqual(summary.get("documents")[1].get("message"), "Upload failed")
+		publish_realtime.assert_any_call("circularo_bulk_send", summary, user="Administrator")
+
+	def test_settings_cache(self):
+		cache = FakeCache()
+		with mock.patch.object(frappe, "cache", return_value=cache), \
+				mock.patch.object(frappe, "get_doc", side_effect=lambda doctype: frappe._dict(doctype=doctype)) as get_doc:
+			try:
+				clear_settings_cache()
+				settings = get_settings()
+				self.assertEqual(get_doc.call_count, 1)
+
+				# Same request, then another request of the same worker
+				self.assertIs(get_settings(), settings)
+				frappe.local.circularo_settings = None
+				self.assertIs(get_settings(), settings)
+				self.assertEqual(get_doc.call_count, 1)
+
+				# Settings saved by another worker
+				cache.set_value(circularo_integration.SETTINGS_VERSION_KEY, "changed")
+				frappe.local.circularo_settings = None
+				self.assertIsNot(get_settings(), settings)
+				self.assertEqual(get_doc.call_count, 2)
+
+				# Settings saved by this worker
+				clear_settings_cache()
+				get_settings()
+				self.assertEqual(get_doc.call_count, 3)
+			finally:
+				clear_settings_cache()
+
+	def test_is_enabled(self):
+		settings = make_settings()
+		self.assertTrue(settings.is_enabled("Sales Invoice", "Form"))
+		self.assertTrue(settings.is_enabled("purchase order", "list"))
+		self.assertFalse(settings.is_enabled("Item", "Form"))
+		self.assertFalse(settings.is_enabled("Circularo Documents", "Form"))
+
+		self.assertFalse(make_settings(enabled=0).is_enabled("Sales Invoice", "Form"))
+		self.assertFalse(make_settings(circularo_api_token=None).is_enabled("Sales Invoice", "Form"))
+		self.assertFalse(make_settings(show_in_list_view=0).is_enabled("Sales Invoice", "List"))
+
+		# Allow-list follows changed settings
+		settings.show_in_doctypes = "Item"
+		self.assertTrue(settings.is_enabled("Item", "Form"))
+		self.assertFalse(settings.is_enabled("Sales Invoice", "Form"))
+
+		settings = make_settings(show_in_all_doctypes=1)
+		with mock.patch.object(frappe, "get_meta", side_effect=lambda doctype: frappe._dict(issingle=int(doctype == "System Settings"))):
+			self.assertTrue(settings.is_enabled("Item", "Form"))
+			self.assertFalse(settings.is_enabled("System Settings", "Form"))
+			self.assertTrue(settings.is_enabled("System Settings", "List"))
+
+	def test_is_enabled_batch(self):
+		def get_meta(doctype):
+			if doctype == "Missing DocType":
+				raise frappe.DoesNotExistError(doctype)
+			return frappe._dict(issingle=0)
+
+		items = [["Sales Invoice", "Form"], ["Item", "List"], ["Missing DocType", "Form"]]
+		with mock.patch.object(circularo_integration, "get_settings", return_value=make_settings(show_in_all_doctypes=1, show_in_list_view=0)), \
+				mock.patch.object(frappe, "get_meta", side_effect=get_meta):
+			r = is_enabled_batch(frappe.as_json(items))
+
+		self.assertEqual(r.get("status"), 0)
+		self.assertEqual(r.get("message"), [True, False, False])
+
+	def test_pdf_cache_key(self):
+		modified = {
+			"Sales Invoice": "2021-01-01 10:00:00",
+			"Print Format": "2021-01-01 09:00:00",
+			"Letter Head": ("Default", "2021-01-01 08:00:00"),
+			"Print Settings": "2021-01-01 07:00:00"
+		}
+		with mock.patch.object(frappe, "get_meta", return_value=frappe._dict(issingle=0, default_print_format="Invoice")), \
+				mock.patch.object(frappe, "db") as db:
+			db.get_value.side_effect = lambda doctype, filters, fields: modified.get(doctype)
+
+			key = get_cache_key("Sales Invoice", "SINV-1")
+			self.assertEqual(get_cache_key("Sales Invoice", "SINV-1"), key)
+			self.assertNotEqual(get_cache_key("Sales Invoice", "SINV-2"), key)
+			self.assertNotEqual(get_cache_key("Sales Invoice", "SINV-1", "optimized-150"), key)
+
+			for doctype, value in (("Sales Invoice", "2021-01-02 10:00:00"), ("Print Format", "2021-01-02 09:00:00"),
+					("Letter Head", ("Default", "2021-01-02 08:00:00")), ("Print Settings", "2021-01-02 07:00:00")):
+				modified[doctype] = value
+				changed_key = get_cache_key("Sales Invoice", "SINV-1")
+				self.assertNotEqual(changed_key, key)
+				key = changed_key
+
+	def test_pdf_cache_eviction(self):
+		cache_path = tempfile.mkdtemp()
+		try:
+			with mock.patch.object(circularo_pdf_cache, "_get_cache_path", return_value=cache_path), mock.patch.object(frappe, "cache"):
+				for age, key in enumerate(("new", "middle", "old")):
+					put_pdf(key, b"x" * 1000, age + 1, 10000)
+					used = time.time() - (age + 1) * 60
+					os.utime(os.path.join(cache_path, key + "-" + str(age + 1) + ".pdf"), (used, used))
+
+				# Hit marks the oldest file recently used
+				pdf_file, num_pages = get_cached_pdf("old")
+				pdf_file.close()
+				self.assertEqual(num_pages, 3)
+				self.assertIsNone(get_cached_pdf("missing"))
+
+				self.assertEqual(evict(2000), 1)
+				self.assertIsNone(get_cached_pdf("middle"))
+				self.assertEqual(sorted(os.listdir(cache_path)), ["new-1.pdf", "old-3.pdf"])
+
+				# Storing over the limit evicts least recently used files
+				put_pdf("newest", b"x" * 1000, 4, 2000)
+				self.assertEqual(sorted(os.listdir(cache_path)), ["newest-4.pdf", "old-3.pdf"])
+		finally:
+			shutil.rmtree(cache_path)
+
+	def test_upload_index(self):
+		pdf_bytes = make_pdf(2)
+		with StandInServer() as server, mock.patch.object(frappe, "cache", return_value=FakeCache()), \
+				_override_request_options(breaker=None, notify_listeners=False):
+			settings = frappe._dict(circularo_url=server.url, circularo_tenant="test", circularo_api_token="test", upload_index_ttl=1)
+
+			file_id = _upload_pdf(settings, io.BytesIO(pdf_bytes), "test.pdf")
+			self.assertEqual(_upload_pdf(settings, io.BytesIO(pdf_bytes), "test.pdf"), file_id)
+			self.assertEqual(server.requests["POST files/saveFile"], 1)
+
+			# File which Circularo does not know anymore is uploaded again
+			del server.files[file_id]
+			self.assertEqual(_upload_pdf(settings, io.BytesIO(pdf_bytes), "test.pdf"), file_id)
+			self.assertEqual(server.requests["POST files/saveFile"], 2)
+
+			# Availability is checked without downloading the file
+			self.assertEqual(server.requests["HEAD files/loadFile/hash/{file_id}"], 2)
+			self.assertEqual(server.requests["GET files/loadFile/hash/{file_id}"], 0)
+
+	def test_signature_webhook_token(self):
+		with mock.patch.object(circularo_integration, "get_settings", return_value=frappe._dict(webhook_token="webhook-secret")), \
+				mock.patch.object(frappe, "get_request_header", return_value=None), \
+				mock.patch.object(frappe, "db") as db, mock.patch.object(frappe, "enqueue") as enqueue:
+			for token in (None, "", "webhook-secreT", "webhook-secret-"):
+				with self.assertRaises(frappe.AuthenticationError):
+					signature_webhook(token, "doc-1")
+			db.set_value.assert_not_called()
+
+			db.get_value.return_value = None
+			self.assertEqual(signature_webhook("webhook-secret", "doc-unknown").get("status"), 1)
+
+			db.get_value.return_value = frappe._dict(name="HIST-1", is_downloaded=0)
+			self.assertEqual(signature_webhook("webhook-secret", documentId="doc-1").get("status"), 0)
+			db.set_value.assert_called_once_with("Circularo Documents", "HIST-1", "is_signed", 1)
+			self.assertEqual(enqueue.call_args[1].get("history_name"), "HIST-1")
+
+		# Token in header, webhook without configured token is refused
+		with mock.patch.object(frappe, "get_request_header", return_value="webhook-secret"), mock.patch.object(frappe, "db") as db, \
+				mock.patch.object(frappe, "enqueue"):
+			db.get_value.return_value = frappe._dict(name="HIST-1", is_downloaded=1)
+			with mock.patch.object(circularo_integration, "get_settings", return_value=frappe._dict(webhook_token="webhook-secret")):
+				self.assertEqual(signature_webhook(document_id="doc-1").get("status"), 0)
+			with mock.patch.object(circularo_integration, "get_settings", return_value=frappe._dict(webhook_token=None)):
+				with self.assertRaises(frappe.AuthenticationError):
+					signature_webhook(document_id="doc-1")
+
+	def test_reconcile_backoff(self):
+		now = datetime.datetime(2021, 6, 1, 12, 0, 0)
+		rows = [
+			frappe._dict(name="HIST-1", target_document_id="doc-signed", check_attempts=0),
+			frappe._dict(name="HIST-2", target_document_id="doc-unsigned", check_attempts=2),
+			frappe._dict(name="HIST-3", target_document_id="doc-failing", check_attempts=0),
+			frappe._dict(name="HIST-4", target_document_id="doc-unsigned", check_attempts=30)
+		]
+
+		def get_document_details(document_id, settings=None):
+			if document_id == "doc-failing":
+				raise requests.exceptions.ConnectionError("Connection refused")
+			return {"isSigned": document_id == "doc-signed"}
+
+		cache = FakeCache()
+		settings = frappe._dict(enabled=1, circularo_api_token="test", bulk_send_concurrency=2)
+		with mock.patch.object(circularo_integration, "get_settings", return_value=settings), \
+				mock.patch.object(circularo_integration, "_get_document_details", side_effect=get_document_details), \
+				mock.patch.object(circularo_jobs, "now_datetime", return_value=now), \
+				mock.patch.object(frappe, "cache", return_value=cache), mock.patch.object(frappe, "db") as db, \
+				mock.patch.object(frappe, "enqueue") as enqueue, mock.patch.object(frappe, "logger"):
+			db.sql.side_effect = [rows, []]
+			stats = reconcile_pending_documents()
+
+		self.assertEqual((stats.get("checked"), stats.get("signed"), stats.get("failed")), (4, 1, 1))
+		self.assertEqual(enqueue.call_args[1].get("history_name"), "HIST-1")
+		# Whole table was checked, next run starts from the beginning
+		self.assertEqual(db.sql.call_args_list[0][0][1].get("cursor"), "")
+		self.assertEqual(db.sql.call_args_list[1][0][1].get("cursor"), "HIST-4")
+		self.assertEqual(cache.get_value(RECONCILE_CURSOR_KEY), "")
+
+		values = dict((call[0][1], call[0][2]) for call in db.set_value.call_args_list)
+		self.assertEqual(values.get("HIST-1"), {"is_signed": 1, "next_check": None})
+		for name, attempts, delay in (("HIST-2", 3, 4 * RECONCILE_BASE_DELAY), ("HIST-3", 1, RECONCILE_BASE_DELAY), ("HIST-4", 31, RECONCILE_MAX_DELAY)):
+			self.assertEqual(values.get(name).get("check_attempts"), attempts)
+			# Delay doubles with every attempt up to the limit, with jitter
+			self.assertGreaterEqual(values.get(name).get("next_check"), now + datetime.timedelta(seconds=0.8 * delay))
+			self.assertLessEqual(values.get(name).get("next_check"), now + datetime.timedelta(seconds=1.2 * delay))
+
+	def test_bulk_send_render_pool(self):
+		def render_documents(doctype, docnames, pool_size, batch_size=1):
+			for docname in docnames:
+				with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as pdf_file:
+					pdf_file.write(make_pdf(1))
+				yield docname, pdf_file.name, 1, None
+
+		rendered = []
+
+		def send_document(doctype, docname, action, rendered_file=None, progress=None):
+			rendered.append(rendered_file is not None)
+			rendered_file[0].close()
+			return {"docname": docname}
+
+		# Single rendering process is a pool too, only 0 renders in sending threads
+		settings = frappe._dict(bulk_send_concurrency=2, render_pool_size=1, render_batch_size=1)
+		with mock.patch.object(circularo_integration, "get_settings", return_value=settings), \
+				mock.patch.object(circularo_integration, "_send_document", side_effect=send_document), \
+				mock.patch.object(circularo_jobs, "render_documents", side_effect=render_documents) as render, \
+				mock.patch.object(circularo_jobs, "run_in_site_context", side_effect=run_in_test_context), \
+				mock.patch.object(frappe, "cache"), mock.patch.object(frappe, "publish_realtime"):
+			summary = bulk_send_job("test-job", "Sales Invoice", ["SINV-1", "SINV-2"], ACTION_SEND, "Administrator")
+
+		self.assertEqual(summary.get("succeeded"), 2)
+		self.assertEqual(render.call_args[0][2], 1)
+		self.assertEqual(rendered, [True, True])
+
+	def test_create_api_token(self):
+		with StandInServer() as server, mock.patch.object(frappe, "cache"), mock.patch.object(frappe, "get_doc") as get_doc, \
+				mock.patch.object(circularo_integration, "get_settings", side_effect=AssertionError("Settings used during setup")), \
+				mock.patch.object(circularo_integration, "get_circuit_breaker", side_effect=AssertionError("Breaker used during setup")):
+			r = create_api_token(server.url.rstrip("/"), "test", "user@example.com", "password")
+
+			self.assertEqual(r.get("status"), 0, r.get("message"))
+			self.assertEqual(get_doc.return_value.circularo_url, server.url)
+			self.assertEqual(get_doc.return_value.signature_id, "stand-in-signature")
+			get_doc.return_value.save.assert_called_once_with()
+			self.assertEqual(server.requests["GET logout"], 1)
+
+			server.fail_next(2)
+			r = create_api_token(server.url, "test", "user@example.com", "password")
+			self.assertEqual(r.get("status"), 1)
+			self.assertIn("No ping response", r.get("message"))
+
+	def test_signed_document_email(self):
+		history_record = frappe._dict(name="HIST-1", author="user@example.com")
+		saved_file = frappe._dict(name="FILE-1")
+
+		with mock.patch.object(circularo_integration, "get_email", return_value="user@example.com"), \
+				mock.patch.object(frappe, "db") as db, mock.patch.object(frappe, "sendmail") as sendmail:
+			# Already e-mailed (or waiting for digest)
+			db.get_value.return_value = EMAIL_QUEUED
+			queue_signed_document_email(history_record, saved_file, frappe._dict(email_digest=0))
+			sendmail.assert_not_called()
+			db.get_value.assert_called_with("Circularo Documents", "HIST-1", "email_status", for_update=True)
+
+			db.get_value.return_value = None
+			queue_signed_document_email(history_record, saved_file, frappe._dict(email_digest=1))
+			sendmail.assert_not_called()
+			self.assertEqual(db.set_value.call_args[0][2].get("email_status"), EMAIL_PENDING)
+
+			queue_signed_document_email(history_record, saved_file, frappe._dict(email_digest=0))
+			self.assertEqual(sendmail.call_args[1].get("attachments"), [{"fid": "FILE-1"}])
+			db.set_value.assert_called_with("Circularo Documents", "HIST-1", "email_status", EMAIL_QUEUED, update_modified=False)
+
+	def test_email_digest(self):
+		rows = [
+			frappe._dict(name="HIST-1", target_doctype="Sales Invoice", target_docname="SINV-1", file_url="/files/a.pdf"),
+			frappe._dict(name="HIST-2", target_doctype="Sales Invoice", target_docname="<SINV-2>", file_url="/files/b.pdf"),
+			frappe._dict(name="HIST-3", target_doctype="Sales Invoice", target_docname="SINV-3", file_url="/files/a.pdf")
+		]
+		with mock.patch.object(circularo_integration, "get_email", return_value="user@example.com"), \
+				mock.patch.object(frappe, "db") as db, mock.patch.object(frappe, "sendmail") as sendmail, \
+				mock.patch.object(frappe, "get_all", return_value=[("HIST-1", "/files/a.pdf", "FILE-A"), ("HIST-2", "/files/b.pdf", "FILE-B"),
+					("HIST-3", "/files/a.pdf", "FILE-C")]) as get_all:
+			db.sql.side_effect = [rows, None]
+			self.assertEqual(send_digest("user@example.com"), 3)
+
+			db.sql.side_effect = [[]]
+			self.assertEqual(send_digest("user@example.com"), 0)
+
+		sendmail.assert_called_once()
+		self.assertEqual(sendmail.call_args[1].get("subject"), "3 documents signed")
+		# Documents with identical content are attached once
+		self.assertEqual(sendmail.call_args[1].get("attachments"), [{"fid": "FILE-A"}, {"fid": "FILE-B"}])
+		self.assertEqual(get_all.call_args[1].get("filters").get("attached_to_name"), ["in", ["HIST-1", "HIST-2", "HIST-3"]])
+		self.assertIn("&lt;SINV-2&gt;", sendmail.call_args[1].get("message"))
+		self.assertEqual(db.sql.call_args_list[1][0][1], {"queued": EMAIL_QUEUED, "names": ["HIST-1", "HIST-2", "HIST-3"]})
+
+	def test_discard_pending_emails(self):
+		with mock.patch.object(frappe, "db") as db:
+			db.sql_list.return_value = ["HIST-1", "HIST-2"]
+			self.assertEqual(discard_pending_emails(), 2)
+			self.assertEqual(db.sql.call_args[0][1], {"names": ["HIST-1", "HIST-2"]})
+
+			db.sql.reset_mock()
+			db.sql_list.return_value = []
+			self.assertEqual(discard_pending_emails(), 0)
+			db.sql.assert_not_called()
+
+		# E-mails turned off, documents waiting for a digest are discarded instead of sent
+		with mock.patch.object(circularo_integration, "get_settings", return_value=frappe._dict(enabled=1, send_to_email=0)), \
+				mock.patch.object(circularo_email, "discard_pending_emails") as discard, \
+				mock.patch.object(circularo_email, "send_digest") as digest, mock.patch.object(frappe, "db"):
+			self.assertEqual(send_email_digests(), 0)
+			discard.assert_called_once_with()
+			digest.assert_not_called()
+
+	def test_archive_old_documents(self):
+		now = datetime.datetime(2021, 6, 1, 12, 0, 0)
+		with mock.patch.object(circularo_integration, "get_settings", return_value=frappe._dict(history_retention_days=30)), \
+				mock.patch.object(circularo_jobs, "now_datetime", return_value=now), \
+				mock.patch.object(frappe, "db") as db, mock.patch.object(frappe, "logger"):
+			db.sql_list.side_effect = [["HIST-1", "HIST-2"], []]
+			self.assertEqual(archive_old_documents(), 2)
+
+		values = db.sql_list.call_args_list[0][0][1]
+		self.assertEqual(values.get("cutoff"), now - datetime.timedelta(days=30))
+		self.assertEqual(values.get("pending"), EMAIL_PENDING)
+
+		statements = [" ".join(call[0][0].split()) for call in db.sql.call_args_list]
+		self.assertTrue(statements[0].startswith("insert into `tabCircularo Documents Archive`"))
+		for table in ("`tabCircularo Documents`", "`tabVersion`", "`tabComment`"):
+			self.assertTrue([statement for statement in statements if statement.startswith("delete from " + table)], table)
+		# Files move with their history records
+		self.assertTrue([statement for statement in statements if statement.startswith("update `tabFile` "
+			"set attached_to_doctype = 'Circularo Documents Archive'")])
+		for call in db.sql.call_args_list:
+			self.assertEqual(call[0][1].get("names"), ["HIST-1", "HIST-2"])
+		db.commit.assert_called_once_with()
+
+		# Retention turned off
+		with mock.patch.object(circularo_integration, "get_settings", return_value=frappe._dict(history_retention_days=0)), \
+				mock.patch.object(frappe, "db") as db:
+			self.assertEqual(archive_old_documents(), 0)
+			db.sql_list.assert_not_called()
+
+	def test_operation_deadline(self):
+		with mock.patch.object(circularo_integration, "get_settings", return_value=frappe._dict(operation_timeout=10)):
+			self.assertIsNone(_get_deadline())
+
+			# Combined document gets budget of all its parts, nested operations keep it
+			with _operation_deadline(3):
+				deadline = _get_deadline()
+				self.assertAlmostEqual(deadline - time.time(), 30, delta=1)
+				with _operation_deadline():
+					self.assertEqual(_get_deadline(), deadline)
+
+			self.assertIsNone(_get_deadline())
+			with _operation_deadline():
+				self.assertAlmostEqual(_get_deadline() - time.time(), 10, delta=1)
+
+	def test_progress_coalescing(self):
+		clock = [1000.0]
+		cache = FakeCache()
+		with mock.patch.object(circularo_progress, "time") as fake_time, mock.patch.object(frappe, "cache", return_value=cache), \
+				mock.patch.object(frappe, "publish_realtime") as publish_realtime:
+			fake_time.time.side_effect = lambda: clock[0]
+			progress = ProgressReporter("test-job", "user@example.com", 3, [STAGE_UPLOADED, STAGE_CREATED], interval=1)
+			progress.start()
+
+			# Events within the interval are coalesced into the next snapshot
+			for _ in range(3):
+				progress.advance(STAGE_UPLOADED)
+			progress.advance("unknown stage")
+			self.assertEqual(publish_realtime.call_count, 1)
+
+			clock[0] += 1
+			progress.advance(STAGE_CREATED)
+			self.assertEqual(publish_realtime.call_count, 2)
+			snapshot = publish_realtime.call_args[0][1]
+			self.assertEqual(snapshot.get("counts"), {STAGE_UPLOADED: 3, STAGE_CREATED: 1})
+
+			progress.complete(True, 2)
+			progress.complete(False)
+			self.assertEqual(publish_realtime.call_count, 2)
+
+			# Final snapshot is published right away, published snapshots are not changed afterwards
+			progress.finish()
+			self.assertEqual(publish_realtime.call_count, 3)
+			publish_realtime.assert_called_with(PROGRESS_EVENT, mock.ANY, user="user@example.com")
+			final = publish_realtime.call_args[0][1]
+			self.assertEqual((final.get("succeeded"), final.get("failed"), final.get("finished")), (2, 1, True))
+			self.assertEqual(snapshot.get("counts").get(STAGE_CREATED), 1)
+			self.assertFalse(snapshot.get("finished"))
+
+			with mock.patch.object(frappe, "session", frappe._dict(user="user@example.com")):
+				self.assertEqual(get_job_progress("test-job").get("message"), final)
+			with mock.patch.object(frappe, "session", frappe._dict(user="other@example.com")), \
+					mock.patch.object(frappe, "get_roles", return_value=["Employee"]):
+				self.assertEqual(get_job_progress("test-job").get("status"), 1)
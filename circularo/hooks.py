@@ -15,4 +15,18 @@ required_apps = ['frappe']
 app_include_js = [
     "assets/circularo/js/circularo_utils.js",
     "assets/circularo/js/circularo_doctype_hooks.js"
-]
\ No newline at end of file
+]
+
+scheduler_events = {
+    "daily": [
+        "circularo.circularo.doctype.circularo_integration.circularo_jobs.archive_old_documents"
+    ],
+    "cron": {
+        "*/10 * * * *": [
+            "circularo.circularo.doctype.circularo_integration.circularo_jobs.reconcile_pending_documents"
+        ],
+        "*/5 * * * *": [
+            "circularo.circularo.doctype.circularo_integration.circularo_jobs.send_email_digests"
+        ]
+    }
+}
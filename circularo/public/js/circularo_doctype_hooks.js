@@ -8,9 +8,13 @@ const CIRCULARO_ACTIONS = Object.freeze({
     AUTOSIGN: 2
 })
 
+/** Running bulk send jobs are remembered, so their progress is shown again after page reload */
+const CIRCULARO_JOBS_KEY = "circularo_jobs";
+
 // Check for page changes
 $(window).on('hashchange', loadCircularoInForm);
 $(window).on('load', loadCircularoInForm);
+$(window).on('load', resumeBulkSendJobs);
 
 /**
  * Page changed
@@ -70,6 +74,9 @@ frappe.listview_settings = new Proxy(frappe.listview_settings, {
                 frm.page.add_action_item("Send to Circularo", function () {
                     circularoListAction(frm, CIRCULARO_ACTIONS.SEND);
                 });
+                frm.page.add_action_item("Send to Circularo as one document", function () {
+                    circularoListAction(frm, CIRCULARO_ACTIONS.SEND, true);
+                });
                 frm.page.add_action_item("Sign in Circularo", function () {
                     circularoListAction(frm, CIRCULARO_ACTIONS.SIGN);
                 });
@@ -99,7 +106,7 @@ function circularoFormAction(frm, actionType) {
     const doctype = frm.doctype;
     const docname = frm.docname;
 
-    sendToCircularo(doctype, docname, actionType, 0, 1).then(function ({ document, progressBar }) {
+    sendToCircularo(doctype, docname, actionType).then(function ({ document, progressBar }) {
         progressBar.hide();
 
         showCreatedMessage([document], actionType);
@@ -113,105 +120,254 @@ function circularoFormAction(frm, actionType) {
 
 /**
  * List view action
+ * Documents are sent by one background job, its summary is received as realtime event
  * @param frm {Object} Info about checked documents
  * @param actionType {number} Action type
+ * @param combined {boolean} Send documents as one combined Circularo document
  */
-function circularoListAction(frm, actionType) {
+function circularoListAction(frm, actionType, combined = false) {
     const doctype = frm.doctype;
+    const docnames = frm.get_checked_items().map(function (item) {
+        return item.name;
+    });
+
+    const doc = (docnames.length === 1) ? "document" : "documents";
+    const title = "Sending " + doc + " to Circularo";
+    const text = "Sending " + docnames.length + " " + doc + " in background...";
+    const progressBar = frappe.show_progress(title, 0, docnames.length, text);
+    progressBar.show();
+
+    let stopProgress = function () {};
+    const jobPromise = bulkSend(doctype, docnames, actionType, combined).then(function (job) {
+        rememberBulkSendJob(job.job_id, title, text);
+        stopProgress = followProgress(job.job_id, title, text);
+        return job;
+    });
+
+    waitForBulkSend(jobPromise).then(function (summary) {
+        stopProgress();
+        forgetBulkSendJob(summary.job_id);
+        progressBar.hide();
+
+        const createdDocuments = [];
+        const historyNames = new Set();
+        const errors = [];
+        for (const document of summary.documents) {
+            if (document.status === 0) {
+                //Combined documents share one Circularo document
+                if (!historyNames.has(document.message.history_name)) {
+                    historyNames.add(document.message.history_name);
+                    createdDocuments.push(document.message);
+                }
+            } else {
+                errors.push(document.docname + ": " + document.message);
+            }
+        }
+
+        if (createdDocuments.length > 0) {
+            showCreatedMessage(createdDocuments, actionType);
+        }
+        if (errors.length > 0) {
+            showErrorMessage(errors.join("<br>"));
+        }
+    }).catch(function (err) {
+        stopProgress();
+        progressBar.hide();
+        showErrorMessage(err.message || err);
+    });
+}
+
+/**
+ * Show progress of bulk send jobs started before the page was (re)loaded
+ */
+function resumeBulkSendJobs() {
+    const jobs = getBulkSendJobs();
+    for (const jobId of Object.keys(jobs)) {
+        getJobProgress(jobId).then(function (snapshot) {
+            if (!snapshot || snapshot.finished) {
+                forgetBulkSendJob(jobId);
+                return;
+            }
 
-    const items = frm.get_checked_items();
-    const createdDocuments = [];
-    let myProgressBar = void 0;
-
-    let p = Promise.resolve();
-    // Go through all checked documents
-    for (const [index, value] of Object.entries(items)) {
-        p = p.then(function() {
-            return sendToCircularo(doctype, value.name, actionType, index, items.length)
-        }).then(function ({ document, progressBar }) {
-            createdDocuments.push(document);
-            myProgressBar = progressBar;
+            const stopProgress = followProgress(jobId, jobs[jobId].title, jobs[jobId].text, function (snapshot) {
+                stopProgress();
+                forgetBulkSendJob(jobId);
+                frappe.hide_progress();
+                frappe.show_alert({
+                    message: snapshot.succeeded + " of " + snapshot.total + " documents sent to Circularo",
+                    indicator: (snapshot.failed > 0) ? "orange" : "green"
+                });
+            });
+        }).catch(function () {
+            forgetBulkSendJob(jobId);
         });
     }
+}
 
-    p.then(function() {
-        //All documents send
-        myProgressBar.hide();
-        showCreatedMessage(createdDocuments, actionType);
-    }).catch(function (e) {
-        //Error
-        if (e.progressBar) {
-            e.progressBar.hide();
+/**
+ * Show progress of running job in progress bar
+ * The last stored snapshot is loaded first, further snapshots are received as realtime events (no polling)
+ * @param jobId {string} Job ID
+ * @param title {string} Progress bar title
+ * @param text {string} Progress bar description
+ * @param onFinished {function | null} Called with the final snapshot
+ * @returns {function} Function to stop following the job
+ */
+function followProgress(jobId, title, text, onFinished = null) {
+    let lastValue = -1;
+
+    const handler = function (snapshot) {
+        if (!snapshot || (snapshot.job_id !== jobId)) {
+            return;
         }
-        showErrorMessage(e.err.message || e.err);
+
+        //Loaded snapshot may come after newer realtime event
+        const value = getProgressValue(snapshot);
+        if (value < lastValue) {
+            return;
+        }
+        lastValue = value;
+
+        const counts = snapshot.stages.map(function (stage) {
+            return snapshot.counts[stage] + " " + stage;
+        });
+        frappe.show_progress(title, value, snapshot.total * snapshot.stages.length,
+            text + " (" + counts.join(", ") + " of " + snapshot.total + ")");
+
+        if (snapshot.finished && onFinished) {
+            onFinished(snapshot);
+        }
+    };
+
+    frappe.realtime.on("circularo_progress", handler);
+    getJobProgress(jobId).then(handler).catch(function () {
+        //Realtime events are enough
+    });
+
+    return function () {
+        frappe.realtime.off("circularo_progress", handler);
+    };
+}
+
+/**
+ * Get count of passed stages of all documents
+ * Failed documents do not pass remaining stages, they are counted as done
+ * @param snapshot {Object} Progress snapshot
+ * @returns {number} Count of passed stages
+ */
+function getProgressValue(snapshot) {
+    let value = snapshot.failed * snapshot.stages.length;
+    for (const stage of snapshot.stages) {
+        value += snapshot.counts[stage];
+    }
+
+    return Math.min(value, snapshot.total * snapshot.stages.length);
+}
+
+/**
+ * Get remembered running bulk send jobs
+ * @returns {Object} Progress bar title and description by job ID
+ */
+function getBulkSendJobs() {
+    try {
+        return JSON.parse(localStorage.getItem(CIRCULARO_JOBS_KEY)) || {};
+    } catch (e) {
+        return {};
+    }
+}
+
+/**
+ * Remember running bulk send job
+ * @param jobId {string} Job ID
+ * @param title {string} Progress bar title
+ * @param text {string} Progress bar description
+ */
+function rememberBulkSendJob(jobId, title, text) {
+    const jobs = getBulkSendJobs();
+    jobs[jobId] = { title, text };
+    localStorage.setItem(CIRCULARO_JOBS_KEY, JSON.stringify(jobs));
+}
+
+/**
+ * Forget finished bulk send job
+ * @param jobId {string} Job ID
+ */
+function forgetBulkSendJob(jobId) {
+    const jobs = getBulkSendJobs();
+    delete jobs[jobId];
+    localStorage.setItem(CIRCULARO_JOBS_KEY, JSON.stringify(jobs));
+}
+
+/**
+ * Wait for summary of bulk send background job
+ * Listening starts before the job is enqueued, so fast jobs are not missed
+ * @param jobPromise {Promise<Object>} Promise of enqueued job
+ * @returns {Promise<Object>} Job summary
+ */
+function waitForBulkSend(jobPromise) {
+    return new Promise(function (resolve, reject) {
+        const summaries = {};
+        let jobId = null;
+
+        const check = function () {
+            if ((jobId !== null) && summaries[jobId]) {
+                frappe.realtime.off("circularo_bulk_send", handler);
+                resolve(summaries[jobId]);
+            }
+        };
+        const handler = function (summary) {
+            summaries[summary.job_id] = summary;
+            check();
+        };
+        frappe.realtime.on("circularo_bulk_send", handler);
+
+        jobPromise.then(function (job) {
+            jobId = job.job_id;
+            check();
+        }).catch(function (err) {
+            frappe.realtime.off("circularo_bulk_send", handler);
+            reject(err);
+        });
     });
 }
 
 /**
  * Sends document to Circularo
+ * Whole pipeline (upload, create and download) runs in one server call, its stages are received as realtime events
  * @param doctype {string} Frappe DocType
  * @param docname {string} Frappe DocName
  * @param actionType {number} Action type
- * @param index {number} Index of currently processed document
- * @param length {number} Count of processed documents
  * @returns {Promise<Object>}
  */
-function sendToCircularo(doctype, docname, actionType, index, length) {
-    //Check how many steps there will be
-    let actualStep, totalSteps;
-    if (length === 1) {
-        actualStep = 0;
-        totalSteps = 3;
-    } else {
-        actualStep = index * 3;
-        totalSteps = length * 3;
-    }
-
-    const progressText = (length === 1) ? "" : "(" + (parseInt(index) + 1) + "/" + length + ") ";
-    const doc = (length === 1) ? "document" : "documents";
-
+function sendToCircularo(doctype, docname, actionType) {
     //Archive parameters
-    let title = "Sending " + doc + " to Circularo";
-    let text = progressText + "Archiving document '" + docname + "'...";
-    let isSign = 0;
-    let isAutosign = 0;
+    let title = "Sending document to Circularo";
+    let text = "Archiving document '" + docname + "'...";
 
     if (actionType === CIRCULARO_ACTIONS.SIGN) {
         //Sign parameters
-        title = "Preparing " + doc + " to be signed";
-        text = progressText + "Preparing document '" + docname + "' to be signed...";
-        isSign = 1;
-        isAutosign = 0;
+        title = "Preparing document to be signed";
+        text = "Preparing document '" + docname + "' to be signed...";
 
     } else if (actionType === CIRCULARO_ACTIONS.AUTOSIGN) {
         //Autosign parameters
-        title = "Signing " + doc + " in Circularo";
-        text = progressText + "Signing document '" + docname + "'...";
-        isSign = 1;
-        isAutosign = 1;
+        title = "Signing document in Circularo";
+        text = "Signing document '" + docname + "'...";
     }
 
-    let progressBar = frappe.show_progress(title, actualStep++, totalSteps, text);
+    const progressBar = frappe.show_progress(title, 0, 1, text);
     progressBar.show();
 
-    let myDocument;
-    return new Promise(function(resolve, reject) {
-        //Upload given file to Circularo
-        uploadFile(doctype, docname).then(function (file) {
-            progressBar = frappe.show_progress(title, actualStep++, totalSteps, text);
-            //Create document in Circularo from uploaded file
-            return createDocument(doctype, docname, file.file_id, file.num_pages, isSign, isAutosign);
-
-        }).then(function (document) {
-            progressBar = frappe.show_progress(title, actualStep++, totalSteps, text);
-            myDocument = document;
-            //Download (signed) file from Circularo
-            return downloadFile(myDocument.history_name, 0)
+    const progressId = frappe.utils.get_random(10);
+    const stopProgress = followProgress(progressId, title, text);
 
-        }).then(function() {
-            resolve({ document: myDocument, progressBar });
+    return new Promise(function(resolve, reject) {
+        sendDocument(doctype, docname, actionType, progressId).then(function (document) {
+            stopProgress();
+            resolve({ document, progressBar });
 
         }).catch(function (err) {
+            stopProgress();
             reject({ err, progressBar });
         });
     });
@@ -297,18 +453,16 @@ function isEnabled(doctype, view, docname = null) {
 }
 
 /**
- * Upload document as PDF to Circularo
- * @param doctype {string} Frappe DocType
- * @param docname {string} Frappe DocName
- * @returns {Promise<Object>} Object with file ID
+ * Get the last progress snapshot of a job
+ * @param jobId {string} Job ID
+ * @returns {Promise<Object | null>} Progress snapshot
  */
-function uploadFile(doctype, docname) {
+function getJobProgress(jobId) {
     return new Promise(function (resolve, reject) {
         frappe.call({
-            method: "circularo.circularo.doctype.circularo_integration.circularo_integration.upload_file",
+            method: "circularo.circularo.doctype.circularo_integration.circularo_progress.get_job_progress",
             args: {
-                doctype: doctype,
-                docname: docname
+                job_id: jobId
             },
             callback: function (value) {
                 const args = value.message;
@@ -323,26 +477,22 @@ function uploadFile(doctype, docname) {
 }
 
 /**
- * Create document in Circularo
+ * Send many documents to Circularo in background job
  * @param doctype {string} Frappe DocType
- * @param docname {string} Frappe DocName
- * @param fileHash {string} File ID of Circularo file
- * @param numPages {number} Count of file pages
- * @param isSign {number} 1 if is sign action, 0 otherwise
- * @param isAutosign {number} 1 if is autosign action, 0 otherwise
- * @returns {Promise<Object>} Object with document details
+ * @param docnames {Array<string>} Frappe DocNames
+ * @param actionType {number} Action type
+ * @param combined {boolean} Send documents as one combined Circularo document
+ * @returns {Promise<Object>} Object with job ID
  */
-function createDocument(doctype, docname, fileHash, numPages, isSign, isAutosign) {
+function bulkSend(doctype, docnames, actionType, combined = false) {
     return new Promise(function (resolve, reject) {
         frappe.call({
-            method: "circularo.circularo.doctype.circularo_integration.circularo_integration.create_document",
+            method: "circularo.circularo.doctype.circularo_integration.circularo_integration.bulk_send",
             args: {
                 doctype: doctype,
-                docname: docname,
-                file_hash: fileHash,
-                sign_page: numPages,
-                is_sign: isSign,
-                is_autosign: isAutosign
+                docnames: docnames,
+                action: actionType,
+                combined: combined ? 1 : 0
             },
             callback: function (value) {
                 const args = value.message;
@@ -357,18 +507,22 @@ function createDocument(doctype, docname, fileHash, numPages, isSign, isAutosign
 }
 
 /**
- * Download PDF file from Circularo
- * @param historyName {string} History record DocName
- * @param downloadManualSign {number} 1 to try download manually signed PDF, 0 otherwise
- * @returns {Promise<Object>}
+ * Send document to Circularo (upload, create and download)
+ * @param doctype {string} Frappe DocType
+ * @param docname {string} Frappe DocName
+ * @param actionType {number} Action type
+ * @param progressId {string | null} ID to publish progress of the stages under
+ * @returns {Promise<Object>} Object with document details
  */
-function downloadFile(historyName, downloadManualSign) {
+function sendDocument(doctype, docname, actionType, progressId = null) {
     return new Promise(function (resolve, reject) {
         frappe.call({
-            method: "circularo.circularo.doctype.circularo_integration.circularo_integration.download_file",
+            method: "circularo.circularo.doctype.circularo_integration.circularo_integration.send_document",
             args: {
-                history_name: historyName,
-                download_manual_sign: downloadManualSign
+                doctype: doctype,
+                docname: docname,
+                action: actionType,
+                progress_id: progressId
             },
             callback: function (value) {
                 const args = value.message;